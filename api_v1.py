@@ -0,0 +1,310 @@
+"""Versioned JSON API for the broker mobile app.
+
+Clients exchange username/password for an access token at
+POST /api/v1/auth/token and send it as `Authorization: Bearer <token>`.
+Brokers see and change only their own leads; admins can read every lead.
+
+A client keeps its copy current with GET /api/v1/sync: the first call
+(without cursor) pages through every lead, later calls return only leads
+changed since the cursor, ordered by (updated_at, id), plus the ids removed
+from the broker's list (reassigned, merged or archived). `fields` limits the
+columns sent and POST /api/v1/leads/batch applies many updates in one request.
+"""
+import os
+import base64
+import logging
+from datetime import datetime, timedelta
+from flask import request, jsonify, g, Response
+from flask_jwt_extended import create_access_token
+from sqlalchemy import func, and_, or_, desc
+from sqlalchemy.orm import aliased
+from models import User, Lead, LeadAssignment, Notification, MergedLead, ArchivedLead
+from auth import api_login_required
+from lead_browser import parse_filters, browse_leads
+from lead_updates import parse_lead_changes, apply_lead_changes, serialize_value, serialize_changes
+from http_caching import conditional_json
+import lead_outbox
+import dashboard_counters
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SYNC_PAGE_SIZE = 500
+MAX_SYNC_PAGE_SIZE = 2000
+MAX_BATCH_UPDATES = 500
+# Rows are only synced once they are this old, so a transaction that commits
+# a little after its updated_at was taken is not skipped by a newer cursor
+SYNC_LAG = timedelta(seconds=int(os.environ.get('API_SYNC_LAG_SECONDS', 5)))
+
+LEAD_FIELDS = ('id', 'name', 'email', 'phone', 'message', 'status', 'notes', 'follow_up_date',
+               'assigned_to', 'meta_config_id', 'source_channel', 'source_campaign_name',
+               'last_message_status', 'last_message_at', 'score', 'created_at', 'updated_at')
+DEFAULT_FIELDS = ('id', 'name', 'email', 'phone', 'status', 'notes', 'follow_up_date',
+                  'created_at', 'updated_at')
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+def selected_fields():
+    """Columns named in ?fields=a,b (unknown names ignored); id and updated_at are always sent"""
+    requested = request.args.get('fields')
+    if not requested:
+        return DEFAULT_FIELDS
+    fields = [field for field in requested.split(',') if field in LEAD_FIELDS]
+    return tuple(dict.fromkeys(['id', 'updated_at'] + fields))
+
+def serialize_lead(lead, fields):
+    return {field: serialize_value(getattr(lead, field)) for field in fields}
+
+def page_size(default, maximum):
+    return max(1, min(request.args.get('limit', default, type=int), maximum))
+
+def scoped(query, user):
+    return query if user.is_admin() else query.filter(Lead.assigned_to == user.id)
+
+def encode_sync_cursor(updated_at, lead_id):
+    raw = f"{updated_at.isoformat()}|{lead_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_sync_cursor(cursor):
+    """(updated_at, id) of a sync cursor; raises ValueError when malformed"""
+    try:
+        updated_at, lead_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(updated_at), int(lead_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Cursor inválido: {cursor}")
+
+@app.route('/api/v1/auth/token', methods=['POST'])
+def api_token():
+    """Exchange username and password for an access token"""
+    data = request.get_json(silent=True) or {}
+    user = User.query.filter_by(username=data.get('username')).first()
+    if not user or not user.is_active or not user.check_password(data.get('password') or ''):
+        return api_error('Usuário ou senha inválidos', 401)
+
+    expires = app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    return jsonify({
+        'access_token': create_access_token(identity=str(user.id)),
+        'token_type': 'Bearer',
+        'expires_in': int(expires.total_seconds()),
+        'user': {'id': user.id, 'username': user.username, 'role': user.role.value}
+    })
+
+@app.route('/api/v1/leads')
+@api_login_required
+def api_leads():
+    """Newest-first page of leads; accepts the lead browser filters, cursor and fields"""
+    user = g.api_user
+    filters = parse_filters(request.args)
+    if not user.is_admin():
+        filters.update(broker_id=user.id, unassigned=False)
+
+    fields = selected_fields()
+    leads, next_cursor = browse_leads(filters, request.args.get('cursor'),
+                                      page_size(PAGE_SIZE, MAX_PAGE_SIZE))
+    return jsonify({
+        'leads': [serialize_lead(lead, fields) for lead in leads],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/v1/leads/<int:lead_id>')
+@api_login_required
+def api_lead(lead_id):
+    lead = scoped(Lead.query.filter(Lead.id == lead_id), g.api_user).first()
+    if not lead:
+        return api_error('Lead não encontrado', 404)
+    return jsonify(serialize_lead(lead, selected_fields()))
+
+@app.route('/api/v1/leads/<int:lead_id>', methods=['PATCH'])
+@api_login_required
+def api_update_lead(lead_id):
+    """Change status, notes and/or follow_up_date of one of the broker's leads"""
+    try:
+        values = parse_lead_changes(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return api_error(str(e), 400)
+    if not values:
+        return api_error('Nenhum campo para atualizar', 400)
+
+    now = datetime.utcnow()
+    if not apply_lead_changes([lead_id], g.api_user.id, values, now):
+        db.session.rollback()
+        return api_error('Lead não encontrado', 404)
+    db.session.commit()
+
+    return jsonify({'id': lead_id, 'changed': serialize_changes(values), 'updated_at': now.isoformat()})
+
+@app.route('/api/v1/leads/batch', methods=['POST'])
+@api_login_required
+def api_batch_update_leads():
+    """Apply many lead updates in one transaction
+
+    Body: {"updates": [{"id": 1, "status": "em_contato"}, ...]}. Updates that
+    set the same values (e.g. marking many leads as contacted) share a single
+    UPDATE. Invalid or foreign leads are reported in errors, the rest applied.
+    """
+    updates = (request.get_json(silent=True) or {}).get('updates')
+    if not isinstance(updates, list) or not updates:
+        return api_error('Informe a lista updates', 400)
+    if len(updates) > MAX_BATCH_UPDATES:
+        return api_error(f'No máximo {MAX_BATCH_UPDATES} atualizações por requisição', 400)
+
+    errors = []
+    groups = {}
+    for item in updates:
+        lead_id = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(lead_id, int):
+            errors.append({'id': lead_id, 'error': 'id inválido'})
+            continue
+        try:
+            values = parse_lead_changes(item)
+        except ValueError as e:
+            errors.append({'id': lead_id, 'error': str(e)})
+            continue
+        if not values:
+            errors.append({'id': lead_id, 'error': 'Nenhum campo para atualizar'})
+            continue
+        groups.setdefault(tuple(sorted(values.items())), []).append(lead_id)
+
+    now = datetime.utcnow()
+    updated = []
+    for values, lead_ids in groups.items():
+        changed = apply_lead_changes(lead_ids, g.api_user.id, dict(values), now)
+        updated += changed
+        missing = set(lead_ids) - set(changed)
+        errors += [{'id': lead_id, 'error': 'Lead não encontrado'} for lead_id in sorted(missing)]
+    db.session.commit()
+
+    return jsonify({'updated': sorted(updated), 'errors': errors, 'updated_at': now.isoformat()})
+
+@app.route('/api/v1/sync')
+@api_login_required
+def api_sync():
+    """Leads changed since the cursor, oldest change first, plus removed lead ids
+
+    Clients apply `removed` before `leads` and call again with `cursor` until
+    has_more is false; the last cursor is kept for the next sync.
+    """
+    user = g.api_user
+    cursor = request.args.get('cursor')
+    try:
+        position = decode_sync_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    fields = selected_fields()
+    limit = page_size(SYNC_PAGE_SIZE, MAX_SYNC_PAGE_SIZE)
+    until = datetime.utcnow() - SYNC_LAG
+
+    # Only the requested columns are read; keyset on the (assigned_to, updated_at, id) index
+    query = scoped(db.session.query(*[Lead.__table__.c[field] for field in fields]), user)\
+        .filter(Lead.updated_at < until)
+    if position:
+        updated_at, lead_id = position
+        query = query.filter(or_(
+            Lead.updated_at > updated_at,
+            and_(Lead.updated_at == updated_at, Lead.id > lead_id)
+        ))
+    rows = query.order_by(Lead.updated_at, Lead.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_sync_cursor(rows[-1].updated_at, rows[-1].id) if rows else cursor
+
+    return jsonify({
+        'leads': [serialize_lead(row, fields) for row in rows],
+        'removed': removed_lead_ids(user, position[0], until) if position else [],
+        'cursor': next_cursor,
+        'has_more': has_more
+    })
+
+def removed_lead_ids(user, since, until):
+    """Leads that left the user's list between since and until"""
+    def window(column):
+        return and_(column > since, column <= until)
+
+    removed = {row[0] for row in db.session.query(MergedLead.merged_lead_id)
+                                           .filter(window(MergedLead.merged_at),
+                                                   MergedLead.merged_lead_id.isnot(None))}
+
+    archived = db.session.query(ArchivedLead.id).filter(window(ArchivedLead.archived_at))
+    if not user.is_admin():
+        archived = archived.filter(ArchivedLead.assigned_to == user.id)
+    removed.update(row[0] for row in archived)
+
+    if not user.is_admin():
+        # Assigned to someone else after having been this broker's
+        previous = aliased(LeadAssignment)
+        removed.update(row[0] for row in db.session.query(LeadAssignment.lead_id)
+                       .join(Lead, Lead.id == LeadAssignment.lead_id)
+                       .filter(window(LeadAssignment.assigned_at),
+                               LeadAssignment.broker_id != user.id,
+                               or_(Lead.assigned_to.is_(None), Lead.assigned_to != user.id),
+                               db.session.query(previous.id).filter(
+                                   previous.lead_id == LeadAssignment.lead_id,
+                                   previous.broker_id == user.id,
+                                   previous.assigned_at <= LeadAssignment.assigned_at
+                               ).exists()))
+    return sorted(removed)
+
+@app.route('/api/v1/events')
+@api_login_required
+def api_events():
+    """Lead events after ?cursor= as NDJSON, for BI/CRM consumers (admins only)
+
+    The next cursor is in X-Next-Cursor (unchanged when there is nothing new).
+    Store it only once the batch is processed: delivery is at-least-once.
+    """
+    if not g.api_user.is_admin():
+        return api_error('Acesso restrito a administradores', 403)
+    cursor = request.args.get('cursor', '0')
+    try:
+        lead_outbox.parse_cursor(cursor)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    events = lead_outbox.read_events(cursor, page_size(lead_outbox.BATCH_SIZE, lead_outbox.MAX_BATCH_SIZE))
+
+    response = Response(lead_outbox.to_ndjson(events), mimetype='application/x-ndjson')
+    response.headers['X-Next-Cursor'] = lead_outbox.format_cursor(events[-1]) if events else cursor
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/v1/notifications')
+@api_login_required
+def api_notifications():
+    """Unread notifications and the broker's new-lead count (revalidated with ETag)"""
+    user = g.api_user
+    new_leads = 0 if user.is_admin() else dashboard_counters.broker_metrics(user.id)['new_leads']
+    latest_unread, unread_count = db.session.query(
+        func.max(Notification.id), func.count(Notification.id)
+    ).filter(Notification.user_id == user.id, Notification.is_read.is_(False)).one()
+
+    def build():
+        unread = Notification.query.filter_by(user_id=user.id, is_read=False)\
+                                   .order_by(desc(Notification.created_at)).limit(50).all()
+        return {
+            'new_leads': new_leads,
+            'unread': [{
+                'id': notification.id,
+                'type': notification.type,
+                'message': notification.message,
+                'lead_id': notification.lead_id,
+                'created_at': serialize_value(notification.created_at)
+            } for notification in unread]
+        }
+
+    return conditional_json((user.id, new_leads, latest_unread, unread_count), build)
+
+@app.route('/api/v1/notifications/read', methods=['POST'])
+@api_login_required
+def api_mark_notifications_read():
+    """Mark the given notification ids (or all) as read"""
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    query = Notification.query.filter_by(user_id=g.api_user.id, is_read=False)
+    if ids:
+        query = query.filter(Notification.id.in_(ids))
+    marked = query.update({'is_read': True}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({'marked': marked})
@@ -1,19 +1,23 @@
 import os
 import logging
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import timedelta
+from database import build_engine_options, configure_engine
+from http_caching import init_http_caching
+from read_replicas import RoutingSession, replica_binds, init_read_replicas, read_only_request
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (LOG_LEVEL=DEBUG for verbose local debugging)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 # Create the app
 app = Flask(__name__)
@@ -25,22 +29,56 @@ app.config["JWT_SECRET_KEY"] = os.environ.get("SESSION_SECRET", "fallback_jwt_se
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=24)
 jwt = JWTManager(app)
 
+# Fingerprinted static URLs, response compression
+init_http_caching(app)
+
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = build_engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+# Optional read replicas for reports and dashboards (DATABASE_REPLICA_URLS)
+app.config["SQLALCHEMY_BINDS"] = replica_binds()
 
 # Initialize the app with the extension
 db.init_app(app)
 
 with app.app_context():
+    configure_engine(db.engine, read_only=read_only_request)
+
+init_read_replicas(app, db)
+
+def init_db():
+    """Create or upgrade tables and create the default admin user (run once per deploy, not per worker)"""
     # Import models to create tables
     import models  # noqa: F401
     db.create_all()
     logging.info("Database tables created")
     
+    # Columns and indexes added to tables that already existed
+    from schema_migrations import upgrade_schema
+    upgrade_schema()
+    
+    from lead_search import init_search_index
+    init_search_index()
+    
+    from lead_browser import backfill_browse_columns
+    backfill_browse_columns()
+    
+    from follow_up_reminders import backfill_reminders
+    backfill_reminders()
+    
+    from dashboard_counters import init_counters
+    init_counters()
+    
+    from lead_outbox import init_outbox
+    init_outbox()
+    
+    from campaign_analytics import init_rollups
+    init_rollups()
+    
+    from config_registry import create_default_distribution, init_config_versions
+    create_default_distribution()
+    init_config_versions()
+    
     # Create default admin user if none exists
     from models import User, UserRole
     admin_user = User.query.filter_by(role=UserRole.ADMIN).first()
@@ -56,3 +94,194 @@ with app.app_context():
         db.session.add(admin)
         db.session.commit()
         logging.info("Default admin user created: admin/admin123")
+
+def create_app():
+    """Application entry point: register routes without any DDL or seed work"""
+    import routes  # noqa: F401
+    import api_v1  # noqa: F401
+    from lead_scoring import register_scoring
+    register_scoring()
+    return app
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade database tables and create the default admin user"""
+    init_db()
+
+@app.cli.command('migrate')
+@click.option('--dry-run', is_flag=True, help='Only print what would change')
+def migrate_command(dry_run):
+    """Create missing tables and add missing columns and indexes (init-db does this too)"""
+    from schema_migrations import missing_tables, pending_upgrades, upgrade_schema
+    tables = missing_tables()
+    if dry_run:
+        statements = pending_upgrades()
+    else:
+        db.session.rollback()  # create_all() runs on its own connection
+        db.create_all()
+        statements = upgrade_schema()
+    for table in tables:
+        click.echo(f"CREATE TABLE {table}")
+    for statement in statements:
+        click.echo(f"{statement};")
+    click.echo(f"{len(tables)} tables and {len(statements)} statements {'pending' if dry_run else 'applied'}")
+
+@app.cli.command('archive-leads')
+@click.option('--days', type=int, default=None, help='Archive closed leads untouched for this many days')
+def archive_leads_command(days):
+    """Move old closed leads into the archive tables"""
+    from lead_archive import archive_closed_leads
+    stats = archive_closed_leads(older_than=timedelta(days=days) if days else None,
+                                 max_seconds=float('inf'))
+    click.echo(f"Archived {stats['archived']} leads in {stats['duration_seconds']}s")
+
+@app.cli.command('sweep-leads')
+def sweep_leads_command():
+    """Reassign leads left in NOVO with the same broker for too long"""
+    from lead_sweeper import LeadSweeper
+    stats = LeadSweeper().sweep()
+    click.echo(f"Reassigned {stats['swept']} of {stats['scanned']} stale leads in {stats['duration_seconds']}s")
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the dashboard counters and repair drift"""
+    from dashboard_counters import reconcile_counters
+    drift = reconcile_counters()
+    for (scope, key), (stored, actual) in sorted(drift.items()):
+        click.echo(f"{scope}:{key} {stored} -> {actual}")
+    click.echo(f"{len(drift)} counters corrected")
+
+@app.cli.command('dedupe-leads')
+def dedupe_leads_command():
+    """Merge duplicate leads already in the table, in bounded batches"""
+    from lead_dedup import dedupe_existing
+    stats = dedupe_existing()
+    click.echo(f"Merged {stats['merged']} duplicate leads in {stats['duration_seconds']}s")
+
+@app.cli.command('rescore-leads')
+@click.option('--full', is_flag=True, help='Rescore every open lead, not only those whose weights moved')
+def rescore_leads_command(full):
+    """Refit the lead scoring weights and rescore open leads"""
+    from lead_scoring import rescore_leads
+    stats = rescore_leads(full=full)
+    click.echo(f"Rescored {stats['rescored']} of {stats['scanned']} leads in {stats['duration_seconds']}s")
+
+@app.cli.command('simulate-distribution')
+@click.option('--days', type=int, default=365, help='Replay the leads created in the last N days')
+@click.option('--scenarios', 'scenarios_path', type=click.Path(exists=True), default=None,
+              help='JSON list of distribution configs to compare with the current one')
+@click.option('--workers', type=int, default=None, help='Processes running scenarios in parallel')
+@click.option('--details', is_flag=True, help='Also print per-broker results')
+def simulate_distribution_command(days, scenarios_path, workers, details):
+    """Replay historical leads through distribution configs and compare the outcomes"""
+    import json
+    import distribution_simulator as simulator
+    current = simulator.current_scenario()
+    scenarios = [current]
+    if scenarios_path:
+        with open(scenarios_path) as f:
+            scenarios += simulator.parse_scenarios(json.load(f), current)
+    history = simulator.load_history(days)
+    results = simulator.run_scenarios(history, scenarios, workers=workers or simulator.WORKERS)
+    
+    click.echo(f"{'cenário':<24} {'leads':>8} {'s/ corretor':>11} {'carga máx/média':>15} "
+               f"{'espera média h':>14} {'espera p90 h':>12} {'conversões':>10}")
+    for name, result in results.items():
+        click.echo(f"{name[:24]:<24} {result['leads']:>8} {result['unassigned']:>11} "
+                   f"{result['max_load_ratio']:>15} {result['avg_wait_hours']:>14} "
+                   f"{result['p90_wait_hours']:>12} {result['expected_conversions']:>10}")
+        if details:
+            for broker in result['per_broker']:
+                click.echo(f"    corretor {broker['broker_id']:>5}: {broker['leads']:>7} leads, "
+                           f"espera média {broker['avg_wait_hours']}h, p90 {broker['p90_wait_hours']}h, "
+                           f"{broker['expected_conversions']} conversões")
+
+@app.cli.command('stream-events')
+@click.option('--cursor-file', type=click.Path(), required=True,
+              help='File holding the id of the last delivered event (created if missing)')
+@click.option('--sink', default='-', help="'-' for stdout, file:PATH to append NDJSON, spool:DIR for one file per batch")
+@click.option('--follow', is_flag=True, help='Keep polling for new events')
+@click.option('--interval', type=float, default=2.0, help='Seconds between polls with --follow')
+def stream_events_command(cursor_file, sink, follow, interval):
+    """Deliver lead events after the saved cursor to a sink (at-least-once)"""
+    import sys
+    import time
+    import lead_outbox
+    if sink == '-':
+        target = lead_outbox.StreamSink(sys.stdout)
+    elif sink.startswith('file:'):
+        target = lead_outbox.FileSink(sink[len('file:'):])
+    elif sink.startswith('spool:'):
+        target = lead_outbox.SpoolSink(sink[len('spool:'):])
+    else:
+        raise click.BadParameter(f"unknown sink {sink}", param_hint='--sink')
+    
+    cursor = lead_outbox.read_cursor(cursor_file)
+    while True:
+        cursor = lead_outbox.drain(target, cursor, lambda value: lead_outbox.write_cursor(cursor_file, value))
+        if not follow:
+            break
+        time.sleep(interval)
+
+@app.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run the periodic jobs and follow-up reminders until SIGTERM (one process per deployment)"""
+    import signal
+    import threading
+    import scheduler
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+    
+    scheduler.start_scheduler()
+    click.echo("Scheduler running, stop with SIGTERM")
+    try:
+        while not stopping.wait(1):
+            pass
+    finally:
+        scheduler.stop_scheduler()
+
+# Local development convenience; deployments run `flask --app main init-db` instead
+if os.environ.get("AUTO_INIT_DB", "false").lower() == "true":
+    with app.app_context():
+        init_db()
+
+if __name__ == '__main__':
+    # Cold start of a web worker, as gunicorn boots one (no --preload): each run
+    # is a fresh interpreter that imports main and serves its first request.
+    #   DATABASE_URL=... python app.py
+    import sys
+    import json
+    import time
+    import statistics
+    import subprocess
+
+    RUNS = int(os.environ.get('BENCH_RUNS', 10))
+    DEFERRED = ['scheduler', 'apscheduler', 'meta_integration', 'meta_sync', 'requests', 'numpy']
+    WORKER = f"""
+import sys, time, json
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+status = app.test_client().get('/login').status_code
+responded = time.perf_counter()
+print(json.dumps({{'import': imported - started, 'first_response': responded - imported, 'status': status,
+                  'loaded': [name for name in {DEFERRED!r} if name in sys.modules]}}))
+"""
+
+    runs = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', WORKER], capture_output=True, text=True, check=True,
+                                env={**os.environ, 'LOG_LEVEL': 'WARNING'}).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        run['process'] = time.perf_counter() - started
+        runs.append(run)
+
+    def median_ms(key):
+        return statistics.median(run[key] for run in runs) * 1000
+
+    print(f"worker cold start, median of {RUNS}: import main {median_ms('import'):.0f} ms, "
+          f"first response {median_ms('first_response'):.0f} ms (HTTP {runs[-1]['status']}), "
+          f"process start to first response {median_ms('process'):.0f} ms")
+    print(f"deferred modules loaded by then: {', '.join(runs[-1]['loaded']) or 'none'}")
@@ -0,0 +1,298 @@
+"""Optional ASGI entry point for high-concurrency webhook ingestion.
+
+Run with:  uvicorn asgi:application --host 0.0.0.0 --port $PORT --workers 2
+
+Load test the fast path against the gunicorn (WSGI) deployment, one process
+each, with the same WhatsApp webhook deliveries on the same database:
+    DATABASE_URL=postgresql://... python asgi.py
+
+POSTs to /webhook/meta and /webhook/whatsapp are read and acknowledged on the
+event loop and processed by a bounded pool of worker threads, so thousands of
+concurrent deliveries are held by a few processes. Signatures are checked
+on the loop against the cached app secrets before a delivery is queued, so
+forged or duplicate deliveries never reach the worker threads. Every other request
+(including the GET verification handshakes) is served by the unchanged Flask
+app through an ASGI-to-WSGI adapter.
+"""
+import os
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.wsgi import WsgiToAsgi
+from app import app, create_app
+from config_registry import config_registry
+from webhook_security import verify_webhook, INVALID, DUPLICATE
+import routes
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 10000))
+MAX_BODY_BYTES = 1024 * 1024
+WEBHOOK_HANDLERS = {'/webhook/meta': 'meta', '/webhook/whatsapp': 'whatsapp'}
+
+flask_application = WsgiToAsgi(create_app())
+
+def process_webhook(path, body):
+    """Process a webhook payload inside an app context (runs in a worker thread)"""
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        logger.warning(f"Discarding webhook with invalid JSON on {path}")
+        return
+
+    with app.app_context():
+        if path == '/webhook/meta':
+            routes.process_meta_webhook(data)
+        else:
+            routes.handle_whatsapp_webhook(data)
+
+def header_value(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+class WebhookServer:
+    """ASGI application: async webhook fast path in front of the Flask app"""
+
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS,
+                                           thread_name_prefix='webhook')
+        self.queue = None
+        self.workers = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif (scope['type'] == 'http' and scope['method'] == 'POST'
+                and scope['path'] in WEBHOOK_HANDLERS):
+            await self.handle_webhook(scope, receive, send)
+        else:
+            await self.wsgi_application(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start_workers()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop_workers()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start_workers(self):
+        self.queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(WEBHOOK_WORKERS)]
+        logger.info(f"Webhook fast path started with {WEBHOOK_WORKERS} workers")
+
+    async def stop_workers(self):
+        # Drain what was already acknowledged before shutting down
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            path, body = await self.queue.get()
+            try:
+                await loop.run_in_executor(self.executor, process_webhook, path, body)
+            except Exception as e:
+                logger.error(f"Error processing webhook on {path}: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def handle_webhook(self, scope, receive, send):
+        if self.queue is None:
+            self.start_workers()
+
+        body = await self.read_body(receive)
+        if body is None:
+            await self.respond(send, 413, b'Payload Too Large')
+            return
+
+        source = WEBHOOK_HANDLERS[scope['path']]
+        if config_registry.needs_refresh():
+            # Checking config versions queries the database; keep it off the loop
+            await asyncio.get_running_loop().run_in_executor(self.executor, config_registry.refresh, (source,))
+        outcome = verify_webhook(source, body, header_value(scope, b'x-hub-signature-256'))
+        if outcome == INVALID:
+            logger.warning(f"Rejected {source} webhook with invalid signature")
+            await self.respond(send, 403, b'Forbidden')
+            return
+        if outcome == DUPLICATE:
+            await self.respond(send, 200, b'OK')
+            return
+
+        # Backpressure: waits only when the bounded queue is full
+        await self.queue.put((scope['path'], body))
+        await self.respond(send, 200, b'OK')
+
+    async def respond(self, send, status, body):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                        (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+application = WebhookServer(flask_application)
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import random
+    import socket
+    import subprocess
+    from sqlalchemy import func
+    from app import db, init_db
+    from models import Lead
+
+    CONNECTIONS = int(os.environ.get('BENCH_CONNECTIONS', 64))
+    SECONDS = float(os.environ.get('BENCH_SECONDS', 15))
+    THREADS = int(os.environ.get('GUNICORN_THREADS', WEBHOOK_WORKERS))
+    DRAIN_TIMEOUT = 120
+
+    with app.app_context():
+        init_db()
+
+    def free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def start_server(command, port):
+        env = dict(os.environ, GUNICORN_THREADS=str(THREADS))
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.kill()
+        raise SystemExit(f"Server did not start: {' '.join(command)}")
+
+    def delivery(phone):
+        return json.dumps({'entry': [{'changes': [{'field': 'messages', 'value': {
+            'metadata': {'phone_number_id': 'bench'},
+            'contacts': [{'wa_id': phone, 'profile': {'name': f'Bench {phone}'}}],
+            'messages': [{'from': phone, 'id': f'wamid.{phone}', 'type': 'text',
+                          'text': {'body': 'Olá, quero saber mais'}}]
+        }}]}]}).encode()
+
+    async def post(port, prefix, sequence, connection):
+        """POST one delivery on a keep-alive connection; returns (seconds, status)"""
+        body = delivery(f'55{prefix}{sequence:08d}')
+        request = (f'POST /webhook/whatsapp HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                   f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body
+        started = time.perf_counter()
+        if not connection:
+            connection[:] = await asyncio.open_connection('127.0.0.1', port)
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        length, close = 0, False
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+            elif name.lower() == 'connection' and value.strip().lower() == 'close':
+                close = True
+        await reader.readexactly(length)
+        if close:
+            writer.close()
+            connection.clear()
+        return time.perf_counter() - started, int(status_line.split()[1])
+
+    async def load(port, prefix):
+        deadline = time.monotonic() + SECONDS
+        results = []
+
+        async def client(index):
+            connection = []  # reader, writer while open
+            sequence = index * 10 ** 6
+            while time.monotonic() < deadline:
+                sequence += 1
+                try:
+                    results.append(await post(port, prefix, sequence, connection))
+                except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+                    results.append((0.0, 599))
+                    if connection:
+                        connection[1].close()
+                        connection.clear()
+            if connection:
+                connection[1].close()
+
+        await asyncio.gather(*(client(i) for i in range(CONNECTIONS)))
+        return results
+
+    def stored_leads(prefix):
+        with app.app_context():
+            return db.session.query(func.count(Lead.id)).filter(Lead.phone.like(f'55{prefix}%')).scalar()
+
+    servers = [
+        ('wsgi (gunicorn)', lambda port: [sys.executable, '-m', 'gunicorn', 'main:app', '--workers', '1',
+                                          '--threads', str(THREADS), '--bind', f'127.0.0.1:{port}']),
+        ('asgi (uvicorn)', lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:application', '--workers', '1',
+                                         '--port', str(port), '--log-level', 'warning']),
+    ]
+
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{CONNECTIONS} connections, {SECONDS:g}s, {THREADS} threads or webhook workers, "
+          f"{app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]}")
+    for name, command in servers:
+        port = free_port()
+        prefix = f'{random.randrange(10 ** 4):04d}'
+        process = start_server(command(port), port)
+        try:
+            started = time.perf_counter()
+            results = asyncio.run(load(port, prefix))
+            acknowledged = time.perf_counter() - started
+
+            # The fast path acknowledges before processing: wait for the queue to drain
+            accepted = sum(1 for _, status in results if status == 200)
+            stored, last_change = stored_leads(prefix), time.perf_counter()
+            while stored < accepted and time.perf_counter() - last_change < DRAIN_TIMEOUT:
+                time.sleep(0.5)
+                count = stored_leads(prefix)
+                if count != stored:
+                    stored, last_change = count, time.perf_counter()
+            processed = time.perf_counter() - started
+        finally:
+            process.terminate()
+            process.wait()
+
+        latencies = sorted(seconds for seconds, status in results if status < 599)
+        errors = sum(1 for _, status in results if status != 200)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        print(f"  {name:<16} {len(results) / acknowledged:7.0f} req/s acknowledged, p50 {p50:.1f} ms, "
+              f"p99 {p99:.1f} ms, {errors} errors; {stored / processed:6.0f} leads/s stored "
+              f"({stored} of {accepted})")
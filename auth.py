@@ -1,6 +1,6 @@
 from functools import wraps
-from flask import request, jsonify, session, redirect, url_for, flash
-from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
+from flask import request, jsonify, session, redirect, url_for, flash, g
+from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token, verify_jwt_in_request
 from models import User
 
 def login_required(f):
@@ -28,6 +28,18 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def api_login_required(f):
+    """Decorator for JSON API routes: require a bearer token of an active user (set as g.api_user)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        verify_jwt_in_request()
+        user = User.query.get(int(get_jwt_identity()))
+        if not user or not user.is_active:
+            return jsonify({'error': 'Usuário inativo ou inexistente'}), 401
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated_function
+
 def get_current_user():
     """Get current logged in user"""
     if 'user_id' in session:
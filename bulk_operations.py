@@ -0,0 +1,303 @@
+import io
+import os
+import csv
+import logging
+from itertools import islice
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import insert, update, or_, and_
+from models import Lead, LeadStatus, BulkJob, IntegrationLog
+from lead_distributor import LeadDistributor
+from lead_dedup import split_duplicates
+from lead_scoring import score_rows
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+MAX_IMPORT_BYTES = int(os.environ.get('BULK_IMPORT_MAX_MB', 50)) * 1024 * 1024
+# A job whose heartbeat is older than this lost its process (restart, crash)
+STALE_AFTER = timedelta(minutes=int(os.environ.get('BULK_JOB_STALE_MINUTES', 10)))
+
+# Jobs run in the process that accepted the request; two at a time is enough
+# to keep admin actions responsive without competing with web threads.
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BULK_JOB_WORKERS', 2)),
+                              thread_name_prefix='bulk-job')
+
+OPEN_STATUSES = [LeadStatus.NOVO.value, LeadStatus.EM_CONTATO.value]
+
+# Spreadsheet header aliases for offline lead imports
+IMPORT_FIELDS = {
+    'name': ('name', 'nome', 'full_name', 'nome completo'),
+    'email': ('email', 'e-mail'),
+    'phone': ('phone', 'telefone', 'celular', 'whatsapp'),
+    'message': ('message', 'mensagem', 'observacao', 'observação'),
+}
+
+ImportedLead = namedtuple('ImportedLead', 'id name assigned_to')
+
+def create_job(kind, params, created_by=None, upload=None):
+    """Persist a bulk job (and the file an import reads) and start it in the background"""
+    job = BulkJob(kind=kind, params=params, created_by=created_by, status='pending', upload=upload)
+    db.session.add(job)
+    db.session.commit()
+
+    executor.submit(run_job, job.id)
+    logger.info(f"Bulk job {job.id} ({kind}) queued")
+    return job
+
+def run_job(job_id):
+    """Execute a bulk job, recording progress on the job row"""
+    with app.app_context():
+        # Claim the job: a recovered job may also still sit in another process's queue
+        claimed = db.session.execute(
+            update(BulkJob).where(BulkJob.id == job_id, BulkJob.status == 'pending')
+                           .values(status='running', heartbeat_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(BulkJob, job_id)
+
+        try:
+            JOB_HANDLERS[job.kind](job)
+            job.status = 'done'
+        except Exception as e:
+            logger.error(f"Bulk job {job_id} failed: {str(e)}")
+            db.session.rollback()
+            job = db.session.get(BulkJob, job_id)
+            job.status = 'error'
+            job.error = str(e)
+
+        job.finished_at = datetime.utcnow()
+        db.session.add(IntegrationLog(
+            action=f'bulk_{job.kind}',
+            status='success' if job.status == 'done' else 'error',
+            message=f'Operação em massa {job.id}: {job.processed} processados, {job.skipped} ignorados',
+            details=job.to_dict()
+        ))
+        if job.kind == 'import':
+            # Finished either way: a failed import is started again with a new upload
+            db.session.execute(update(BulkJob).where(BulkJob.id == job_id).values(upload=None))
+        db.session.commit()
+
+def recover_interrupted_jobs():
+    """Requeue jobs whose process died: running ones that stopped beating and
+    pending ones that were never started. Imports continue after the last
+    committed file row with their counters; the other handlers resume from
+    the leads still matching and restart their counters."""
+    cutoff = datetime.utcnow() - STALE_AFTER
+    stale = db.session.query(BulkJob.id).filter(or_(
+        and_(BulkJob.status == 'running', BulkJob.heartbeat_at < cutoff),
+        and_(BulkJob.status == 'pending', BulkJob.created_at < cutoff,
+             or_(BulkJob.heartbeat_at.is_(None), BulkJob.heartbeat_at < cutoff))
+    )).order_by(BulkJob.id).all()
+
+    requeued = []
+    for (job_id,) in stale:
+        # Conditional UPDATE so two recovering processes don't both take a job
+        taken = db.session.execute(
+            update(BulkJob).where(BulkJob.id == job_id, BulkJob.status.in_(['running', 'pending']),
+                                  or_(BulkJob.heartbeat_at.is_(None), BulkJob.heartbeat_at < cutoff))
+                           .values(status='pending', heartbeat_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if taken:
+            executor.submit(run_job, job_id)
+            requeued.append(job_id)
+
+    if requeued:
+        logger.warning(f"Requeued interrupted bulk jobs {requeued}")
+    return requeued
+
+def reassign_leads(job):
+    """Spread a broker's leads across the remaining roster, one chunk per transaction"""
+    broker_id = job.params['broker_id']
+    statuses = job.params.get('statuses') or OPEN_STATUSES
+
+    base = db.session.query(Lead.id, Lead.name, Lead.assigned_to, Lead.meta_config_id).filter(
+        Lead.assigned_to == broker_id,
+        Lead.status.in_([LeadStatus(status) for status in statuses])
+    )
+
+    job.total = base.count()
+    job.processed = job.skipped = 0
+    db.session.commit()
+
+    distributor = LeadDistributor(batch_mode=True)
+    distributor.load_config()
+
+    last_id = 0
+    while True:
+        rows = base.filter(Lead.id > last_id).order_by(Lead.id).limit(CHUNK_SIZE).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        assigned, skipped = distributor.bulk_assign(
+            rows,
+            reassigned_message='O lead {name} foi transferido para outro corretor',
+            received_message='Você recebeu o lead {name} (transferência)'
+        )
+        job.processed += assigned
+        job.skipped += skipped
+        job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+
+def update_statuses(job):
+    """Set a new status on filtered leads with chunked UPDATE ... WHERE id IN statements"""
+    new_status = LeadStatus(job.params['to_status'])
+
+    base = db.session.query(Lead.id)
+    if job.params.get('broker_id'):
+        base = base.filter(Lead.assigned_to == job.params['broker_id'])
+    if job.params.get('from_status'):
+        base = base.filter(Lead.status == LeadStatus(job.params['from_status']))
+
+    job.total = base.count()
+    job.processed = job.skipped = 0
+    db.session.commit()
+
+    last_id = 0
+    while True:
+        ids = [row.id for row in base.filter(Lead.id > last_id).order_by(Lead.id).limit(CHUNK_SIZE)]
+        if not ids:
+            break
+        last_id = ids[-1]
+
+        db.session.execute(
+            update(Lead).where(Lead.id.in_(ids))
+                        .values(status=new_status, updated_at=datetime.utcnow()),
+            execution_options={'synchronize_session': False}
+        )
+        job.processed += len(ids)
+        job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+
+def import_leads(job):
+    """Insert leads from an uploaded CSV/XLSX file and distribute them
+
+    Each chunk commits with the number of file rows it covers, so a resumed
+    job skips those rows instead of reading them again as duplicates.
+    """
+    data = db.session.query(BulkJob.upload).filter(BulkJob.id == job.id).scalar()
+    if data is None:
+        raise RuntimeError("O arquivo da importação não está mais disponível")
+    rows = read_xlsx(data) if job.params['filename'].lower().endswith('.xlsx') else read_csv(data)
+
+    job.total = job.params.get('row_count', 0)
+    db.session.commit()
+
+    distributor = LeadDistributor(batch_mode=True)
+    distributor.load_config()
+
+    rows_read = job.rows_read or 0
+    chunk = []
+    for rows_read, row in enumerate(islice(rows, rows_read, None), start=rows_read + 1):
+        lead_data = parse_import_row(row)
+        if not lead_data:
+            job.skipped += 1
+            continue
+        chunk.append(lead_data)
+        if len(chunk) >= CHUNK_SIZE:
+            _import_chunk(job, distributor, chunk, rows_read)
+            chunk = []
+    if chunk:
+        _import_chunk(job, distributor, chunk, rows_read)
+    db.session.commit()
+
+def _import_chunk(job, distributor, chunk, rows_read):
+    now = datetime.utcnow()
+    job.heartbeat_at = now
+    job.rows_read = rows_read
+    for lead_data in chunk:
+        lead_data.update(status=LeadStatus.NOVO, source_channel='import',
+                         created_at=now, updated_at=now)
+
+    # Rows for people already in the table are merged into their lead instead
+    new_rows = split_duplicates(chunk)
+    job.skipped += len(chunk) - len(new_rows)
+    chunk = new_rows
+    if not chunk:
+        db.session.commit()
+        return
+    score_rows(chunk)
+
+    # sort_by_parameter_order: batched executemany RETURNING rows are otherwise unordered
+    ids = db.session.execute(insert(Lead).returning(Lead.id, sort_by_parameter_order=True),
+                             chunk).scalars().all()
+    imported = [ImportedLead(lead_id, data['name'], None) for lead_id, data in zip(ids, chunk)]
+    distributor.bulk_assign(imported)
+
+    job.processed += len(imported)
+    db.session.commit()
+
+def parse_import_row(row):
+    """Map a spreadsheet row to Lead columns; returns None for unusable rows"""
+    normalized = {str(key).strip().lower(): value for key, value in row.items() if key}
+    lead_data = {}
+    for field, aliases in IMPORT_FIELDS.items():
+        for alias in aliases:
+            value = normalized.get(alias)
+            if value not in (None, ''):
+                lead_data[field] = str(value).strip()
+                break
+
+    if not lead_data.get('phone') and not lead_data.get('email'):
+        return None
+
+    lead_data.setdefault('name', lead_data.get('email') or lead_data['phone'])
+    lead_data['name'] = lead_data['name'][:256]
+    if lead_data.get('phone'):
+        lead_data['phone'] = lead_data['phone'][:20]
+    lead_data.setdefault('email', None)
+    lead_data.setdefault('message', None)
+    return lead_data
+
+def read_csv(data):
+    f = io.StringIO(data.decode('utf-8-sig'), newline='')
+    try:
+        dialect = csv.Sniffer().sniff(f.read(4096), delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    f.seek(0)
+    yield from csv.DictReader(f, dialect=dialect)
+
+def read_xlsx(data):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("Importação de XLSX requer o pacote openpyxl")
+
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        sheet_rows = workbook.active.iter_rows(values_only=True)
+        headers = next(sheet_rows, None)
+        if not headers:
+            return
+        for values in sheet_rows:
+            yield dict(zip(headers, values))
+    finally:
+        workbook.close()
+
+def count_rows(data, filename):
+    """Count data rows so progress can be reported while streaming the file"""
+    if filename.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            return 0
+        workbook = load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            return max((workbook.active.max_row or 1) - 1, 0)
+        finally:
+            workbook.close()
+
+    return max(len(data.splitlines()) - 1, 0)
+
+JOB_HANDLERS = {
+    'reassign': reassign_leads,
+    'status_update': update_statuses,
+    'import': import_leads,
+}
@@ -0,0 +1,137 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, case, insert
+from models import Lead, LeadStatus, CampaignDailyRollup, CampaignSpend, RollupState
+from lead_archive import lead_table
+from sql_functions import day_of
+from app import db
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_NAME = 'campaign_daily'
+DAYS_PER_REFRESH_CHUNK = 31
+# Each refresh re-scans rows changed this long before the previous one started,
+# so a transaction that commits a little after its updated_at was taken is not skipped
+ROLLUP_LAG = timedelta(seconds=int(os.environ.get('ROLLUP_LAG_SECONDS', 300)))
+
+def refresh_rollups(full=False):
+    """Recompute campaign × day × broker rollups for days touched since the last run
+
+    Only days that contain leads created or updated after the watermark are
+    rebuilt, so a refresh costs a scan of recently changed rows plus those
+    days' leads instead of the whole table. The state row stays locked until
+    the commit, so concurrent refreshes run one after the other instead of
+    rebuilding the same day twice.
+    """
+    state = RollupState.query.filter_by(name=ROLLUP_NAME).with_for_update().first()
+    if not state:
+        # Only before init_rollups() has run
+        state = RollupState(name=ROLLUP_NAME)
+        db.session.add(state)
+
+    # Taken before reading, less the lag, so rows changed during the refresh or
+    # committed late are picked up next time
+    started = datetime.utcnow() - ROLLUP_LAG
+    lead_day = day_of(Lead.created_at)
+
+    days_query = db.session.query(lead_day).distinct()
+    if state.watermark and not full:
+        days_query = days_query.filter(Lead.updated_at >= state.watermark)
+    days = [row[0] for row in days_query.all()]
+
+    # A rebuilt day must still count its leads that were archived since
+    all_leads = lead_table(include_archived=True).c
+    all_lead_day = day_of(all_leads.created_at)
+
+    for i in range(0, len(days), DAYS_PER_REFRESH_CHUNK):
+        chunk = days[i:i + DAYS_PER_REFRESH_CHUNK]
+        rows = db.session.query(
+            all_lead_day,
+            all_leads.source_channel,
+            all_leads.source_campaign_id,
+            func.max(all_leads.source_campaign_name),
+            all_leads.assigned_to,
+            func.count(all_leads.id),
+            func.sum(case((all_leads.status == LeadStatus.CONVERTIDO, 1), else_=0)),
+            func.sum(case((all_leads.status == LeadStatus.PERDIDO, 1), else_=0))
+        ).filter(all_lead_day.in_(chunk))\
+         .group_by(all_lead_day, all_leads.source_channel, all_leads.source_campaign_id, all_leads.assigned_to).all()
+
+        CampaignDailyRollup.query.filter(
+            CampaignDailyRollup.day.in_(chunk)
+        ).delete(synchronize_session=False)
+
+        if rows:
+            db.session.execute(insert(CampaignDailyRollup), [{
+                'day': day,
+                'channel': channel,
+                'campaign_id': campaign_id,
+                'campaign_name': campaign_name,
+                'broker_id': broker_id,
+                'leads': leads,
+                'converted': converted or 0,
+                'lost': lost or 0
+            } for day, channel, campaign_id, campaign_name, broker_id, leads, converted, lost in rows])
+
+    state.watermark = started
+    db.session.commit()
+
+    if days:
+        logger.info(f"Campaign rollups refreshed for {len(days)} days")
+    return len(days)
+
+def init_rollups():
+    """Create the rollup state row refresh_rollups() locks"""
+    if not RollupState.query.filter_by(name=ROLLUP_NAME).first():
+        db.session.add(RollupState(name=ROLLUP_NAME))
+        db.session.commit()
+        logger.info("Campaign rollup state created")
+
+def campaign_report(start_day, group_by='campaign'):
+    """Aggregate rollups since start_day, grouped by campaign and optionally day or broker"""
+    dimensions = [CampaignDailyRollup.channel, CampaignDailyRollup.campaign_id]
+    if group_by == 'day':
+        dimensions.append(CampaignDailyRollup.day)
+    elif group_by == 'broker':
+        dimensions.append(CampaignDailyRollup.broker_id)
+
+    rows = db.session.query(
+        *dimensions,
+        func.max(CampaignDailyRollup.campaign_name).label('campaign_name'),
+        func.sum(CampaignDailyRollup.leads).label('leads'),
+        func.sum(CampaignDailyRollup.converted).label('converted'),
+        func.sum(CampaignDailyRollup.lost).label('lost')
+    ).filter(CampaignDailyRollup.day >= start_day)\
+     .group_by(*dimensions)\
+     .order_by(func.sum(CampaignDailyRollup.leads).desc()).all()
+
+    spend = campaign_spend(start_day, by_day=(group_by == 'day'))
+
+    report = []
+    for row in rows:
+        item = dict(row._mapping)
+        item['conversion_rate'] = (item['converted'] / item['leads'] * 100) if item['leads'] else 0
+        key = (row.campaign_id, row.day) if group_by == 'day' else row.campaign_id
+        item['spend'] = spend.get(key) if group_by != 'broker' else None
+        item['cost_per_lead'] = (item['spend'] / item['leads']) if item['spend'] and item['leads'] else None
+        report.append(item)
+    return report
+
+def campaign_spend(start_day, by_day=False):
+    """Recorded spend per campaign (or per campaign and day) since start_day"""
+    query = CampaignSpend.query.filter(CampaignSpend.day >= start_day)
+    spend = {}
+    for entry in query.all():
+        key = (entry.campaign_id, entry.day) if by_day else entry.campaign_id
+        spend[key] = spend.get(key, 0) + float(entry.amount)
+    return spend
+
+def record_spend(campaign_id, day, amount):
+    """Create or replace the spend of a campaign on a day"""
+    entry = CampaignSpend.query.filter_by(campaign_id=campaign_id, day=day).first()
+    if not entry:
+        entry = CampaignSpend(campaign_id=campaign_id, day=day)
+        db.session.add(entry)
+    entry.amount = amount
+    db.session.commit()
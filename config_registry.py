@@ -0,0 +1,168 @@
+"""Process-wide cache of the singleton integration config rows.
+
+The active Meta page configs, the distribution configs (the default one plus
+one per page that has its own broker pool) and WhatsAppConfig change only when an admin
+saves them, yet used to be queried by every webhook, sync cycle and dashboard
+load. The registry keeps read-only snapshots of them in memory. Save routes
+call bump(), which increments a row in config_versions in the same
+transaction; every process compares versions at most once per
+CONFIG_VERSION_CHECK_SECONDS (one query for all configs) and reloads only the
+configs whose version moved.
+
+Snapshots are plain attribute objects, not ORM instances: they can be shared
+across threads and sessions but must not be modified. Code that writes to a
+config row loads it as an ORM instance instead, e.g. LeadDistributor.state
+locks the DistributionConfig row holding the round-robin index in the
+caller's db.session.
+"""
+import os
+import time
+import logging
+import threading
+from types import SimpleNamespace
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from models import MetaConfig, DistributionConfig, WhatsAppConfig, ConfigVersion
+from app import db
+
+logger = logging.getLogger(__name__)
+
+VERSION_CHECK_SECONDS = float(os.environ.get('CONFIG_VERSION_CHECK_SECONDS', 5))
+
+MISSING = object()
+
+def _load_meta():
+    return MetaConfig.query.filter_by(is_active=True).order_by(MetaConfig.id).all()
+
+def _load_distribution():
+    configs = DistributionConfig.query.order_by(DistributionConfig.id).all()
+    if not any(config.meta_config_id is None for config in configs):
+        configs.append(create_default_distribution())
+    return configs
+
+def create_default_distribution():
+    """Create the default distribution config if it is missing (init-db does this)
+
+    Runs in its own transaction, never the caller's: the loader can be
+    reached in the middle of a batch job's or the writer thread's transaction.
+    Returns the default config as a transient DistributionConfig.
+    """
+    table = DistributionConfig.__table__
+    with db.engine.begin() as connection:
+        row = connection.execute(table.select().where(table.c.meta_config_id.is_(None))
+                                 .order_by(table.c.id).limit(1)).first()
+        if row is None:
+            row = connection.execute(insert(table).returning(*table.c)).first()
+            logger.info("Default distribution config created")
+    return DistributionConfig(**row._mapping)
+
+def _load_whatsapp():
+    return WhatsAppConfig.query.first()
+
+LOADERS = {
+    'meta': _load_meta,
+    'distribution': _load_distribution,
+    'whatsapp': _load_whatsapp,
+}
+
+def init_config_versions():
+    """Create the config_versions row of every cached config (init-db does this)
+
+    bump() then only ever updates an existing row.
+    """
+    existing = {name for name, in db.session.query(ConfigVersion.name)}
+    missing = [name for name in LOADERS if name not in existing]
+    if missing:
+        db.session.execute(insert(ConfigVersion), [{'name': name, 'version': 0} for name in missing])
+        db.session.commit()
+        logger.info(f"Config versions created for {', '.join(missing)}")
+
+def snapshot(row):
+    if row is None:
+        return None
+    if isinstance(row, list):
+        return [snapshot(item) for item in row]
+    return SimpleNamespace(**{column.name: getattr(row, column.name) for column in row.__table__.columns})
+
+class ConfigRegistry:
+    def __init__(self):
+        self._snapshots = {}
+        self._versions = {}
+        self._checked_at = None
+        self._lock = threading.RLock()
+
+    def needs_refresh(self):
+        return self._checked_at is None or time.monotonic() - self._checked_at > VERSION_CHECK_SECONDS
+
+    def get(self, name):
+        """Current snapshot of 'whatsapp' (or None), or the list of 'meta' pages / 'distribution' configs"""
+        current = self._snapshots.get(name, MISSING)
+        if current is MISSING or self.needs_refresh():
+            # What the refresh loaded: a concurrent bump() may drop it from _snapshots right after
+            current = self.refresh(names=[name])[name]
+        return current
+
+    def refresh(self, names=()):
+        """Reload configs whose version changed, plus any in names not loaded yet
+
+        Returns the snapshots of names as of this refresh.
+        """
+        from flask import has_app_context
+
+        if has_app_context():
+            return self._refresh(names)
+        # Called from a thread without a request (e.g. the ASGI fast path)
+        from app import app
+        with app.app_context():
+            return self._refresh(names)
+
+    def _refresh(self, names):
+        with self._lock:
+            if not self.needs_refresh() and all(name in self._snapshots for name in names):
+                return {name: self._snapshots[name] for name in names}
+
+            versions = dict(db.session.query(ConfigVersion.name, ConfigVersion.version).all())
+            for name in LOADERS:
+                version = versions.get(name, 0)
+                if name in self._snapshots and self._versions.get(name) == version:
+                    continue
+                if name not in self._snapshots and name not in names:
+                    continue
+                self._snapshots[name] = snapshot(LOADERS[name]())
+                self._versions[name] = version
+                logger.debug(f"Config '{name}' loaded at version {version}")
+            self._checked_at = time.monotonic()
+            return {name: self._snapshots[name] for name in names}
+
+    def bump(self, name):
+        """Record a change to a config in the caller's transaction and drop the local copy
+
+        Other processes pick the change up on their next version check.
+        """
+        increment = update(ConfigVersion).where(ConfigVersion.name == name)\
+                                         .values(version=ConfigVersion.version + 1)
+        result = db.session.execute(increment, execution_options={'synchronize_session': False})
+        if not result.rowcount:
+            # Only before init-db seeded the row (init_config_versions)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(ConfigVersion(name=name, version=1))
+            except IntegrityError:
+                # A concurrent bump() created it first
+                db.session.execute(increment, execution_options={'synchronize_session': False})
+        with self._lock:
+            self._snapshots.pop(name, None)
+            self._versions.pop(name, None)
+
+    def meta_page(self, meta_config_id):
+        return next((page for page in self.get('meta') if page.id == meta_config_id), None)
+
+    def distribution_config(self, meta_config_id=None):
+        """The page's own distribution config, falling back to the default one"""
+        configs = self.get('distribution')
+        default = next(config for config in configs if config.meta_config_id is None)
+        if meta_config_id is None:
+            return default
+        return next((config for config in configs if config.meta_config_id == meta_config_id), default)
+
+config_registry = ConfigRegistry()
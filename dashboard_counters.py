@@ -0,0 +1,324 @@
+"""Incrementally maintained dashboard counters.
+
+Lead totals per status and per source, per-broker lead counts per status
+and broker totals live in dashboard_counters and are kept current by
+database triggers on leads, leads_archive and users, in the same transaction
+as the change. Like the search index, that covers every ingest path, bulk
+statement, archive and merge without application code. The dashboards read
+a handful of primary-key rows instead of counting the leads table.
+
+Archived leads are counted in scopes of their own: moving a lead into the
+archive leaves the dashboard totals unchanged, while the lead browser facets
+(which list only the leads table) drop it.
+
+PostgreSQL uses statement-level triggers with transition tables, so a bulk
+INSERT/UPDATE of thousands of leads applies one aggregated upsert per counter.
+SQLite uses row-level triggers. `flask reconcile-counters` recomputes every
+counter from the base tables and repairs any drift (e.g. after a TRUNCATE or
+a restore).
+
+Concurrency check on a scratch database:  python dashboard_counters.py
+"""
+import logging
+from sqlalchemy import text
+from models import LeadStatus, DashboardCounter, IntegrationLog
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# (scope, key expression, row condition) per tracked table; {row} is the row alias
+COUNTERS = {
+    'leads': {
+        'columns': ['status', 'assigned_to', 'source_channel', 'meta_lead_id', 'message'],
+        'counters': [
+            ('status', "coalesce(CAST({row}.status AS TEXT), 'NONE')", "1 = 1"),
+            ('broker_status', "CAST({row}.assigned_to AS TEXT) || ':' || "
+                              "coalesce(CAST({row}.status AS TEXT), 'NONE')",
+             "{row}.assigned_to IS NOT NULL"),
+            # Same classification as lead_browser.legacy_source (backfilled into source_channel)
+            ('source', "coalesce({row}.source_channel, CASE WHEN {row}.meta_lead_id IS NOT NULL THEN 'meta' "
+                       "WHEN {row}.message LIKE 'Mensagem via WhatsApp%' THEN 'whatsapp' ELSE 'manual' END)",
+             "1 = 1"),
+        ],
+    },
+    # Dashboard totals include archived leads; the lead browser facets don't
+    'leads_archive': {
+        'columns': ['status', 'assigned_to'],
+        'counters': [
+            ('archived_status', "coalesce(CAST({row}.status AS TEXT), 'NONE')", "1 = 1"),
+            ('archived_broker', "CAST({row}.assigned_to AS TEXT) || ':' || "
+                                "coalesce(CAST({row}.status AS TEXT), 'NONE')",
+             "{row}.assigned_to IS NOT NULL"),
+        ],
+    },
+    'users': {
+        'columns': ['role', 'is_active'],
+        'counters': [
+            ('brokers', "'total'", "{row}.role = 'BROKER'"),
+            ('brokers', "'active'", "{row}.role = 'BROKER' AND {row}.is_active"),
+        ],
+    },
+}
+
+UPSERT = "ON CONFLICT (scope, key) DO UPDATE SET value = dashboard_counters.value + excluded.value"
+
+def _pg_changes(sources, counters):
+    """One aggregated upsert for a statement; sources are (transition table, +1/-1)"""
+    parts = [
+        f"SELECT '{scope}' AS scope, {key.format(row='r')} AS key, {sign} AS delta "
+        f"FROM {table} r WHERE {condition.format(row='r')}"
+        for table, sign in sources
+        for scope, key, condition in counters
+    ]
+    # Ordered so concurrent statements lock the counter rows in the same order
+    return (f"INSERT INTO dashboard_counters (scope, key, value) "
+            f"SELECT scope, key, sum(delta) FROM ({' UNION ALL '.join(parts)}) changes "
+            f"GROUP BY scope, key HAVING sum(delta) <> 0 ORDER BY scope, key {UPSERT}")
+
+def _pg_ddl(table, spec):
+    operations = {
+        'insert': ('INSERT', 'REFERENCING NEW TABLE AS new_rows', [('new_rows', 1)]),
+        'delete': ('DELETE', 'REFERENCING OLD TABLE AS old_rows', [('old_rows', -1)]),
+        'update': ('UPDATE', 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+                   [('old_rows', -1), ('new_rows', 1)]),
+    }
+    statements = []
+    for name, (event, referencing, sources) in operations.items():
+        function = f"{table}_counters_{name}"
+        statements += [
+            f"""CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    {_pg_changes(sources, spec['counters'])};
+                    RETURN NULL;
+                END $$""",
+            f"DROP TRIGGER IF EXISTS {function} ON {table}",
+            f"CREATE TRIGGER {function} AFTER {event} ON {table} {referencing} "
+            f"FOR EACH STATEMENT EXECUTE PROCEDURE {function}()",
+        ]
+    return statements
+
+def _sqlite_changes(row, sign, counters):
+    return ''.join(
+        f"INSERT INTO dashboard_counters (scope, key, value) "
+        f"SELECT '{scope}', {key.format(row=row)}, {sign} WHERE {condition.format(row=row)} {UPSERT};\n"
+        for scope, key, condition in counters
+    )
+
+def _sqlite_ddl(table, spec):
+    counters = spec['counters']
+    changed = ' OR '.join(f"old.{column} IS NOT new.{column}" for column in spec['columns'])
+    return [
+        f"DROP TRIGGER IF EXISTS {table}_counters_insert",
+        f"""CREATE TRIGGER {table}_counters_insert AFTER INSERT ON {table} BEGIN
+            {_sqlite_changes('new', 1, counters)}
+        END""",
+        f"DROP TRIGGER IF EXISTS {table}_counters_delete",
+        f"""CREATE TRIGGER {table}_counters_delete AFTER DELETE ON {table} BEGIN
+            {_sqlite_changes('old', -1, counters)}
+        END""",
+        f"DROP TRIGGER IF EXISTS {table}_counters_update",
+        f"""CREATE TRIGGER {table}_counters_update AFTER UPDATE OF {', '.join(spec['columns'])} ON {table}
+            WHEN {changed} BEGIN
+            {_sqlite_changes('old', -1, counters)}
+            {_sqlite_changes('new', 1, counters)}
+        END""",
+    ]
+
+def init_counters():
+    """Create the counter triggers and fill the counters the first time"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        build = _pg_ddl
+    elif dialect == 'sqlite':
+        build = _sqlite_ddl
+    else:
+        logger.warning(f"No counter triggers for dialect {dialect}; run reconcile-counters to refresh them")
+        return
+
+    for table, spec in COUNTERS.items():
+        for statement in build(table, spec):
+            db.session.execute(text(statement))
+    db.session.commit()
+    logger.info("Dashboard counter triggers ready")
+
+    # A scope counting every row of its table that has no counters while the table
+    # has rows was added after the counters were filled
+    stored = {scope for (scope,) in db.session.query(DashboardCounter.scope).distinct()}
+    missing = any(scope not in stored and db.session.execute(text(f"SELECT 1 FROM {table} LIMIT 1")).first()
+                  for table, spec in COUNTERS.items()
+                  for scope, _, condition in spec['counters'] if condition == '1 = 1')
+    if not stored or missing:
+        reconcile_counters()
+
+def reconcile_counters():
+    """Recompute every counter from leads and users and fix the ones that drifted
+
+    Writers are blocked for the duration of the recount so no change lands
+    between the count and the fix. Returns {(scope, key): (stored, actual)}.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text(f"LOCK TABLE {', '.join(COUNTERS)} IN SHARE MODE"))
+
+    actual = {}
+    for table, spec in COUNTERS.items():
+        for scope, key, condition in spec['counters']:
+            rows = db.session.execute(text(
+                f"SELECT {key.format(row=table)}, count(*) FROM {table} "
+                f"WHERE {condition.format(row=table)} GROUP BY 1"
+            ))
+            actual.update(((scope, row_key), count) for row_key, count in rows)
+
+    stored = {(counter.scope, counter.key): counter.value for counter in DashboardCounter.query}
+    drift = {}
+    for counter_key in stored.keys() | actual.keys():
+        stored_value, actual_value = stored.get(counter_key, 0), actual.get(counter_key, 0)
+        if stored_value != actual_value:
+            drift[counter_key] = (stored_value, actual_value)
+            scope, key = counter_key
+            db.session.merge(DashboardCounter(scope=scope, key=key, value=actual_value))
+
+    if drift and stored:
+        db.session.add(IntegrationLog(
+            action='counters_reconcile',
+            status='warning',
+            message=f"{len(drift)} contadores do painel corrigidos",
+            details={f"{scope}:{key}": values for (scope, key), values in drift.items()}
+        ))
+    db.session.commit()
+
+    logger.info(f"Dashboard counters reconciled, {len(drift)} corrected")
+    return drift
+
+def status_counts():
+    """[(LeadStatus, count)] of every status with leads, archived included, in workflow order"""
+    counters = {}
+    for counter in DashboardCounter.query.filter(DashboardCounter.scope.in_(['status', 'archived_status'])):
+        counters[counter.key] = counters.get(counter.key, 0) + counter.value
+    return [(status, counters[status.name]) for status in LeadStatus if counters.get(status.name)]
+
+def total_leads():
+    return sum(counter.value for counter in
+               DashboardCounter.query.filter(DashboardCounter.scope.in_(['status', 'archived_status'])))
+
+def broker_status_counts(broker_id):
+    """{LeadStatus: count} of a broker's leads, archived included, read by primary key"""
+    keys = {f"{broker_id}:{status.name}": status for status in LeadStatus}
+    counters = DashboardCounter.query.filter(DashboardCounter.scope.in_(['broker_status', 'archived_broker']),
+                                             DashboardCounter.key.in_(keys))
+    counts = {status: 0 for status in LeadStatus}
+    for counter in counters:
+        counts[keys[counter.key]] += counter.value
+    return counts
+
+def broker_lead_totals():
+    """{broker_id: number of leads} of every broker with leads, archived included, in one query"""
+    totals = {}
+    for counter in DashboardCounter.query.filter(DashboardCounter.scope.in_(['broker_status', 'archived_broker'])):
+        broker_id = int(counter.key.split(':', 1)[0])
+        totals[broker_id] = totals.get(broker_id, 0) + counter.value
+    return totals
+
+def lead_facets():
+    """Lead counts by status, broker (None: unassigned) and source, shaped like
+    lead_browser.get_facets(), in one query"""
+    facets = {'total': 0, 'status': {}, 'broker': {}, 'source': {}}
+    counters = DashboardCounter.query.filter(DashboardCounter.scope.in_(['status', 'broker_status', 'source']),
+                                             DashboardCounter.value != 0)
+    for counter in counters:
+        if counter.scope == 'status':
+            facets['total'] += counter.value
+            status = None if counter.key == 'NONE' else LeadStatus[counter.key].value
+            facets['status'][status] = counter.value
+        elif counter.scope == 'broker_status':
+            broker_id = int(counter.key.split(':', 1)[0])
+            facets['broker'][broker_id] = facets['broker'].get(broker_id, 0) + counter.value
+        else:
+            facets['source'][counter.key] = counter.value
+
+    unassigned = facets['total'] - sum(facets['broker'].values())
+    if unassigned:
+        facets['broker'][None] = unassigned
+    return facets
+
+def broker_totals():
+    """(total, active) broker accounts"""
+    counters = {counter.key: counter.value for counter in DashboardCounter.query.filter_by(scope='brokers')}
+    return counters.get('total', 0), counters.get('active', 0)
+
+def admin_metrics():
+    """Headline numbers of the admin dashboard, keyed by the cards' data-metric names"""
+    counts = dict(status_counts())
+    total_brokers, active_brokers = broker_totals()
+    return {
+        'total_leads': sum(counts.values()),
+        'new_leads': counts.get(LeadStatus.NOVO, 0),
+        'total_brokers': total_brokers,
+        'active_brokers': active_brokers
+    }
+
+def broker_metrics(broker_id):
+    """Headline numbers of a broker's dashboard, keyed by the cards' data-metric names"""
+    counts = broker_status_counts(broker_id)
+    return {
+        'total_leads': sum(counts.values()),
+        'new_leads': counts[LeadStatus.NOVO],
+        'converted_leads': counts[LeadStatus.CONVERTIDO]
+    }
+
+if __name__ == '__main__':
+    # Concurrent inserts, status changes, reassignments and deletes from
+    # several threads, then a recount: the counters must not have drifted.
+    import os
+    import random
+    import threading
+    from sqlalchemy import insert, update, delete
+    from models import Lead, User, UserRole
+    from app import app
+
+    THREADS = int(os.environ.get('CHECK_THREADS', 8))
+    OPERATIONS = int(os.environ.get('CHECK_OPERATIONS', 200))
+
+    def worker(seed, brokers):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(OPERATIONS):
+                operation = rng.random()
+                if operation < 0.4:
+                    db.session.execute(insert(Lead), [{
+                        'name': f'Check {seed}', 'status': rng.choice(list(LeadStatus)),
+                        'assigned_to': rng.choice(brokers + [None])
+                    } for _ in range(rng.randint(1, 20))])
+                else:
+                    ids = [row.id for row in db.session.query(Lead.id).order_by(db.func.random()).limit(5)]
+                    if operation < 0.7:
+                        db.session.execute(update(Lead).where(Lead.id.in_(ids))
+                                           .values(status=rng.choice(list(LeadStatus))))
+                    elif operation < 0.9:
+                        db.session.execute(update(Lead).where(Lead.id.in_(ids))
+                                           .values(assigned_to=rng.choice(brokers)))
+                    else:
+                        db.session.execute(delete(Lead).where(Lead.id.in_(ids)))
+                db.session.commit()
+
+    with app.app_context():
+        db.create_all()
+        init_counters()
+        if not User.query.filter_by(role=UserRole.BROKER).count():
+            db.session.execute(insert(User), [{
+                'username': f'check{n}', 'email': f'check{n}@example.com', 'password_hash': '-',
+                'role': UserRole.BROKER, 'is_active': n % 3 != 0
+            } for n in range(10)])
+            db.session.commit()
+        brokers = [user.id for user in User.query.filter_by(role=UserRole.BROKER)]
+        reconcile_counters()
+
+    threads = [threading.Thread(target=worker, args=(seed, brokers)) for seed in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        drift = reconcile_counters()
+        print(f"{THREADS} threads x {OPERATIONS} operations: "
+              f"{'consistent' if not drift else f'{len(drift)} counters drifted: {drift}'}")
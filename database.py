@@ -0,0 +1,294 @@
+import os
+import time
+import logging
+import threading
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, NullPool
+
+logger = logging.getLogger(__name__)
+
+class PoolMetrics:
+    """Thread-safe counters for connection pool checkouts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checked_out = 0
+            self.peak_checked_out = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+            self.timeouts = 0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def record_checkin(self):
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def snapshot(self, capacity=None):
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'avg_wait_ms': round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'timeouts': self.timeouts,
+            }
+        if capacity:
+            data['capacity'] = capacity
+            data['saturation'] = round(data['checked_out'] / capacity, 3)
+        return data
+
+pool_metrics = PoolMetrics()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+
+    metrics = pool_metrics
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.metrics.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.record_wait(time.perf_counter() - started)
+        return connection
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+def get_process_type():
+    """Process model this interpreter runs as: web, worker or scheduler"""
+    return os.environ.get('PROCESS_TYPE', 'web').lower()
+
+def scheduler_threads():
+    """Threads of the scheduler process that hold a connection while they run"""
+    # One thread per job (each has max_instances=1), the Meta sync job's page
+    # workers (meta_sync.py) and the reminder thread (follow_up_reminders.py)
+    from scheduler import JOBS
+    return len(JOBS) + _env_int('META_SYNC_WORKERS', 4) + 1
+
+def default_pool_size(process_type):
+    """Size the pool to the number of threads that can hold a connection at once"""
+    # Bulk jobs run in the process that accepted them, and in the scheduler's when recovered
+    bulk_threads = _env_int('BULK_JOB_WORKERS', 2)
+    if process_type == 'web':
+        # One connection per request thread; web workers never run the scheduler
+        return _env_int('GUNICORN_THREADS', 1) + bulk_threads
+    if process_type == 'scheduler':
+        return scheduler_threads() + bulk_threads
+    # Background workers (bulk jobs, dispatchers) run a small fixed thread pool
+    return _env_int('WORKER_THREADS', 4)
+
+def build_engine_options(database_uri, process_type=None):
+    """Build SQLALCHEMY_ENGINE_OPTIONS for the current process model
+
+    Environment variables:
+        DB_POOL_MODE            queue (default) or null for PgBouncer-style external pooling
+        DB_POOL_SIZE            overrides the per-process-type default
+        DB_MAX_OVERFLOW         extra connections allowed under bursts (default 2)
+        DB_POOL_TIMEOUT         seconds to wait for a free connection (default 10)
+        DB_POOL_RECYCLE         seconds before a connection is recycled (default 300)
+        DB_POOL_PRE_PING        ping connections on checkout (default true)
+        DB_STATEMENT_TIMEOUT_MS PostgreSQL statement_timeout (default 30000, 0 disables)
+
+    SQLite files get a plain pool sized the same way; see configure_sqlite()
+    for their per-connection settings.
+    """
+    process_type = process_type or get_process_type()
+    options = {}
+
+    if (database_uri or '').startswith('sqlite'):
+        if is_memory_sqlite(database_uri):
+            return options
+        # One file, one writer at a time: a connection per thread is all that helps,
+        # plus one for the ingestion writer thread (write_queue.py)
+        options['poolclass'] = InstrumentedQueuePool
+        options['pool_size'] = _env_int('DB_POOL_SIZE', default_pool_size(process_type) + 1)
+        options['max_overflow'] = _env_int('DB_MAX_OVERFLOW', 2)
+        options['pool_timeout'] = _env_int('DB_POOL_TIMEOUT', 10)
+        return options
+
+    if os.environ.get('DB_POOL_MODE', 'queue').lower() == 'null':
+        # The external pooler owns the connections; don't keep any here
+        options['poolclass'] = NullPool
+    else:
+        options['poolclass'] = InstrumentedQueuePool
+        options['pool_size'] = _env_int('DB_POOL_SIZE', default_pool_size(process_type))
+        options['max_overflow'] = _env_int('DB_MAX_OVERFLOW', 2)
+        options['pool_timeout'] = _env_int('DB_POOL_TIMEOUT', 10)
+        options['pool_recycle'] = _env_int('DB_POOL_RECYCLE', 300)
+        options['pool_pre_ping'] = _env_bool('DB_POOL_PRE_PING', True)
+
+    logger.info(f"Database engine profile for {process_type}: "
+                f"{ {k: getattr(v, '__name__', v) for k, v in options.items()} }")
+    return options
+
+def configure_engine(engine, metrics=pool_metrics, read_only=None):
+    """Attach pool instrumentation and per-connection settings to an engine
+
+    read_only, for SQLite, is called when a transaction begins and tells
+    whether it may start DEFERRED (see configure_sqlite).
+    """
+    statement_timeout = _env_int('DB_STATEMENT_TIMEOUT_MS', 30000)
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.metrics = metrics
+    if engine.dialect.name == 'sqlite':
+        configure_sqlite(engine, read_only)
+
+    @event.listens_for(engine, 'connect')
+    def set_session_settings(dbapi_connection, connection_record):
+        if engine.dialect.name != 'postgresql' or not statement_timeout:
+            return
+        # Set per connection rather than as a startup option so it also works
+        # behind PgBouncer, which rejects unknown startup parameters
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET statement_timeout = {int(statement_timeout)}")
+        cursor.close()
+        dbapi_connection.commit()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.record_checkout()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.record_checkin()
+
+def is_memory_sqlite(database_uri):
+    return database_uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in database_uri
+
+def sqlite_pragmas():
+    """Per-connection settings for SQLite
+
+    Environment variables:
+        SQLITE_JOURNAL_MODE     WAL (default): readers never block the writer or each other
+        SQLITE_SYNCHRONOUS      NORMAL (default): durable at checkpoints, safe with WAL
+        SQLITE_BUSY_TIMEOUT_MS  how long a writer waits for the write lock (default 10000)
+        SQLITE_CACHE_SIZE_KB    page cache per connection (default 32768)
+        SQLITE_MMAP_SIZE_MB     memory-mapped I/O (default 256, 0 disables)
+    """
+    return [
+        f"PRAGMA journal_mode = {os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous = {os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA busy_timeout = {_env_int('SQLITE_BUSY_TIMEOUT_MS', 10000)}",
+        f"PRAGMA cache_size = -{_env_int('SQLITE_CACHE_SIZE_KB', 32768)}",
+        f"PRAGMA mmap_size = {_env_int('SQLITE_MMAP_SIZE_MB', 256) * 1024 * 1024}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+def configure_sqlite(engine, read_only=None):
+    """Pragmas and BEGIN IMMEDIATE transactions for a SQLite engine
+
+    A deferred transaction that reads and then writes fails at once with
+    "database is locked" when another connection committed in between; the
+    busy timeout does not apply to that upgrade. Transactions therefore take
+    the write lock when they begin (waiting up to SQLITE_BUSY_TIMEOUT_MS),
+    unless read_only() says the transaction only reads: those begin DEFERRED
+    and, under WAL, never wait. SQLITE_BEGIN=deferred restores the driver's
+    behaviour for every transaction.
+    """
+    begin_mode = os.environ.get('SQLITE_BEGIN', 'immediate').upper()
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # Let SQLAlchemy's begin event emit BEGIN instead of the driver
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin_sqlite_transaction(connection):
+        deferred = begin_mode == 'DEFERRED' or (read_only is not None and read_only())
+        connection.exec_driver_sql('BEGIN DEFERRED' if deferred else 'BEGIN IMMEDIATE')
+
+def get_pool_metrics(engine, metrics=pool_metrics):
+    """Pool checkout wait time and saturation for the metrics endpoint"""
+    pool = engine.pool
+    capacity = None
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + pool._max_overflow
+    data = metrics.snapshot(capacity)
+    data['pool_class'] = type(pool).__name__
+    data['status'] = pool.status()
+    return data
+
+if __name__ == '__main__':
+    # Connection checkout cost with and without pre-ping, and how each pool copes
+    # when the server drops its idle connections (a PostgreSQL restart or failover):
+    #   DATABASE_URL=postgresql://... python database.py
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import create_engine, text
+
+    DATABASE_URL = os.environ.get('DATABASE_URL', '')
+    THREADS = _env_int('BENCH_THREADS', 8)
+    CHECKOUTS = _env_int('BENCH_CHECKOUTS', 2000)
+
+    for process_type in ('web', 'scheduler', 'worker'):
+        print(f"pool_size for {process_type}: {default_pool_size(process_type)}")
+    if not DATABASE_URL.startswith('postgresql'):
+        raise SystemExit("Pre-ping only applies to PostgreSQL: set DATABASE_URL=postgresql://...")
+
+    def checkout(engine):
+        started = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return time.perf_counter() - started, False
+        except Exception:
+            return time.perf_counter() - started, True
+
+    def run(engine, count):
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            return list(pool.map(lambda _: checkout(engine), range(count)))
+
+    for pre_ping in (False, True):
+        options = build_engine_options(DATABASE_URL, 'web')
+        options.update(pool_size=THREADS, max_overflow=0, pool_pre_ping=pre_ping)
+        engine = create_engine(DATABASE_URL, **options)
+        run(engine, THREADS * 4)  # fill the pool
+
+        started = time.perf_counter()
+        results = run(engine, CHECKOUTS)
+        elapsed = time.perf_counter() - started
+        latencies = sorted(seconds for seconds, _ in results)
+
+        # Drop every connection the pool holds, as a server restart would
+        with create_engine(DATABASE_URL, poolclass=NullPool).connect() as admin:
+            admin.execute(text("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                               "WHERE datname = current_database() AND pid <> pg_backend_pid()"))
+        failures = sum(1 for _, failed in run(engine, THREADS * 4) if failed)
+        engine.dispose()
+
+        print(f"pre_ping={str(pre_ping):<5} {CHECKOUTS / elapsed:8.0f} checkouts/s, "
+              f"p50 {statistics.median(latencies) * 1000:.3f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.3f} ms, "
+              f"{failures} of {THREADS * 4} requests failed after the server dropped the connections")
@@ -0,0 +1,298 @@
+"""What-if simulator for lead distribution configs.
+
+Historical leads (hot and archived) are loaded once into arrays: arrival
+hour, Meta page and conversion probability (the lead score, or the overall
+rate for unscored leads), plus each broker's measured pace and conversion
+lift from the leads they were given. Every scenario replays those arrivals
+through the same rotation LeadDistributor applies (round-robin over the
+available brokers by id, manual over broker_order skipping unavailable
+brokers, page configs rotating within their broker pool) as array
+operations, and reports per-broker load, queue wait (each broker works
+their queue in arrival order at their historical pace) and expected
+conversions. Scenarios run in parallel processes.
+
+    flask simulate-distribution --days 365 --scenarios scenarios.json
+
+scenarios.json is a list of configs; omitted keys keep today's value:
+
+    [{"name": "manual", "mode": "manual", "broker_order": [3, 5, 3, 7]},
+     {"name": "sem equipes", "brokers": [3, 5, 7, 9], "pages": {}}]
+
+`pages` maps meta_config_id to {"mode", "broker_order", "broker_pool"}.
+Requires numpy (the `simulation` extra). Benchmark:  python distribution_simulator.py
+"""
+import os
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select, union_all, case, func
+from models import (LeadStatus, LeadAssignment, ArchivedLeadAssignment, DistributionConfig,
+                    DistributionMode, User, UserRole)
+from lead_archive import lead_table
+from app import db
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('SIMULATION_WORKERS', os.cpu_count() or 1))
+# Closed leads a broker's conversion rate is pulled towards the overall rate with
+PRIOR_WEIGHT = 20
+# Pace assumed for brokers without history (leads worked per hour)
+DEFAULT_LEADS_PER_HOUR = 1.0
+
+# Arrays are indexed by lead (hours, pages, probabilities, actual) or by broker position
+History = namedtuple('History', 'start days hours pages probabilities actual broker_ids paces lifts')
+Scenario = namedtuple('Scenario', 'name mode broker_order brokers pages')
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError("O simulador de distribuição requer o pacote numpy")
+
+def load_history(days=365):
+    """Arrays of the leads created in the last `days` days, oldest first"""
+    _require_numpy()
+    start = datetime.utcnow() - timedelta(days=days)
+    leads = lead_table(include_archived=True).c
+
+    rows = db.session.execute(
+        select(leads.id, leads.created_at, leads.meta_config_id, leads.score)
+        .where(leads.created_at >= start).order_by(leads.created_at)
+    ).all()
+
+    first_assignments = union_all(*[
+        select(table.c.lead_id, table.c.broker_id)
+        .where(func.coalesce(table.c.assignment_order, 1) == 1)
+        for table in (LeadAssignment.__table__, ArchivedLeadAssignment.__table__)
+    ]).subquery()
+    first_broker = dict(db.session.execute(
+        select(first_assignments.c.lead_id, first_assignments.c.broker_id)
+        .join(leads, leads.id == first_assignments.c.lead_id)
+        .where(leads.created_at >= start)
+    ).all())
+
+    # Per broker: leads received, leads worked (left NOVO), converted and closed
+    outcomes = db.session.execute(
+        select(leads.assigned_to,
+               func.count(),
+               func.sum(case((leads.status != LeadStatus.NOVO, 1), else_=0)),
+               func.sum(case((leads.status == LeadStatus.CONVERTIDO, 1), else_=0)),
+               func.sum(case((leads.status.in_([LeadStatus.CONVERTIDO, LeadStatus.PERDIDO]), 1), else_=0)))
+        .where(leads.created_at >= start, leads.assigned_to.isnot(None))
+        .group_by(leads.assigned_to)
+    ).all()
+
+    broker_ids = sorted({row.assigned_to for row in outcomes}
+                        | {user.id for user in User.query.filter_by(role=UserRole.BROKER)})
+    position = {broker_id: i for i, broker_id in enumerate(broker_ids)}
+
+    converted = sum(row[3] or 0 for row in outcomes)
+    closed = sum(row[4] or 0 for row in outcomes)
+    overall = (converted + 1) / (closed + 2)
+
+    window_hours = days * 24
+    paces = numpy.zeros(len(broker_ids))
+    lifts = numpy.ones(len(broker_ids))
+    for broker_id, _, worked, broker_converted, broker_closed in outcomes:
+        i = position[broker_id]
+        paces[i] = (worked or 0) / window_hours
+        rate = ((broker_converted or 0) + PRIOR_WEIGHT * overall) / ((broker_closed or 0) + PRIOR_WEIGHT)
+        lifts[i] = rate / overall
+    known = paces[paces > 0]
+    paces[paces <= 0] = numpy.median(known) if known.size else DEFAULT_LEADS_PER_HOUR
+
+    ids, created, pages, scores = zip(*rows) if rows else ((), (), (), ())
+    return History(
+        start=start,
+        days=days,
+        hours=numpy.array([(created_at - start).total_seconds() / 3600 for created_at in created]),
+        pages=numpy.array([page or 0 for page in pages], dtype=numpy.int32),
+        probabilities=numpy.array([overall if score is None else score / 100 for score in scores]),
+        actual=numpy.array([position.get(first_broker.get(lead_id), -1) for lead_id in ids],
+                           dtype=numpy.int32),
+        broker_ids=broker_ids,
+        paces=paces,
+        lifts=lifts
+    )
+
+def current_scenario():
+    """Today's distribution configs and broker availability as a scenario"""
+    available = [user.id for user in User.query.filter_by(role=UserRole.BROKER, is_active=True,
+                                                           can_receive_leads=True)]
+    default, pages = None, {}
+    for config in DistributionConfig.query:
+        spec = {'mode': config.mode.value, 'broker_order': config.broker_order or [],
+                'broker_pool': config.broker_pool or []}
+        if config.meta_config_id is None:
+            default = spec
+        else:
+            pages[config.meta_config_id] = spec
+    default = default or {'mode': DistributionMode.ROUND_ROBIN.value, 'broker_order': [], 'broker_pool': []}
+    if default['broker_pool']:
+        available = [broker_id for broker_id in available if broker_id in default['broker_pool']]
+    return Scenario('atual', default['mode'], default['broker_order'], available, pages)
+
+def parse_scenarios(specs, base):
+    """Scenarios from JSON specs, each falling back to base for omitted keys"""
+    scenarios = []
+    for i, spec in enumerate(specs):
+        mode = spec.get('mode', base.mode)
+        DistributionMode(mode)  # Raises ValueError on an unknown mode
+        pages = spec.get('pages', base.pages)
+        scenarios.append(Scenario(
+            name=spec.get('name') or f'cenario {i + 1}',
+            mode=mode,
+            broker_order=spec.get('broker_order', base.broker_order),
+            brokers=spec.get('brokers', base.brokers),
+            pages={int(page): rotation for page, rotation in pages.items()}
+        ))
+    return scenarios
+
+def rotation(mode, broker_order, available):
+    """Brokers in the order LeadDistributor hands leads to them"""
+    if mode == DistributionMode.MANUAL.value and broker_order:
+        return [broker_id for broker_id in broker_order if broker_id in available]
+    return sorted(available)
+
+def assign(history, scenario):
+    """Broker position of every lead under scenario (-1 when nobody could take it)"""
+    position = {broker_id: i for i, broker_id in enumerate(history.broker_ids)}
+    available = {broker_id for broker_id in scenario.brokers if broker_id in position}
+    assigned = numpy.full(history.hours.size, -1, dtype=numpy.int32)
+
+    default_leads = numpy.ones(history.hours.size, dtype=bool)
+    for page, config in scenario.pages.items():
+        pool = available & set(config.get('broker_pool') or available)
+        leads = history.pages == page
+        default_leads &= ~leads
+        _rotate(assigned, leads, rotation(config.get('mode'), config.get('broker_order'), pool), position)
+    _rotate(assigned, default_leads, rotation(scenario.mode, scenario.broker_order, available), position)
+    return assigned
+
+def _rotate(assigned, leads, brokers, position):
+    if not brokers:
+        return
+    order = numpy.array([position[broker_id] for broker_id in brokers])
+    assigned[leads] = order[numpy.arange(numpy.count_nonzero(leads)) % order.size]
+
+def evaluate(history, assigned):
+    """Per-broker leads, expected conversions and queue waits (hours) of an assignment"""
+    brokers = len(history.broker_ids)
+    taken = assigned >= 0
+    loads = numpy.bincount(assigned[taken], minlength=brokers)
+    conversions = numpy.bincount(assigned[taken], minlength=brokers,
+                                 weights=history.probabilities[taken] * history.lifts[assigned[taken]])
+
+    # Leads grouped by broker, in arrival order within each broker (a stable
+    # sort of 16-bit keys is a radix sort)
+    order = numpy.argsort(assigned.astype(numpy.int16), kind='stable')[numpy.count_nonzero(~taken):]
+    brokers_of = assigned[order]
+    arrivals = history.hours[order]
+    group_starts = numpy.cumsum(loads) - loads
+
+    # Each broker works their leads in arrival order, one every `service`
+    # hours: lead n starts at n*service + max over k<=n of (arrival_k - k*service).
+    # The running max restarts per broker by lifting each broker's values
+    # above every earlier broker's.
+    offsets = (numpy.arange(order.size) - group_starts[brokers_of]) / history.paces[brokers_of]
+    slack = arrivals - offsets
+    lift = brokers_of * (slack.max() - slack.min() + 1) if order.size else 0
+    starts = offsets + numpy.maximum.accumulate(slack + lift) - lift
+    waits = starts - arrivals
+
+    per_broker = []
+    for broker in numpy.flatnonzero(loads):
+        broker_waits = waits[group_starts[broker]:group_starts[broker] + loads[broker]]
+        per_broker.append({
+            'broker_id': history.broker_ids[broker],
+            'leads': int(loads[broker]),
+            'expected_conversions': round(float(conversions[broker]), 1),
+            'avg_wait_hours': round(float(broker_waits.mean()), 2),
+            'p90_wait_hours': round(float(numpy.percentile(broker_waits, 90)), 2),
+        })
+
+    active_loads = loads[loads > 0]
+    return {
+        'leads': int(history.hours.size),
+        'unassigned': int(numpy.count_nonzero(~taken)),
+        'brokers': int(active_loads.size),
+        # Busiest broker against the average and spread of loads
+        'max_load_ratio': round(float(active_loads.max() / active_loads.mean()), 2) if active_loads.size else 0,
+        'load_cv': round(float(active_loads.std() / active_loads.mean()), 3) if active_loads.size else 0,
+        'expected_conversions': round(float(conversions.sum()), 1),
+        'avg_wait_hours': round(float(waits.mean()), 2) if waits.size else 0,
+        'p90_wait_hours': round(float(numpy.percentile(waits, 90)), 2) if waits.size else 0,
+        'per_broker': per_broker,
+    }
+
+def simulate(history, scenario):
+    return evaluate(history, assign(history, scenario))
+
+_history = None
+
+def _init_worker(history):
+    global _history
+    _history = history
+
+def _simulate_in_worker(scenario):
+    return simulate(_history, scenario)
+
+def run_scenarios(history, scenarios, workers=WORKERS):
+    """{scenario name: results}, with the recorded first assignments as 'historico'
+
+    The history is sent once per worker process, not once per scenario.
+    """
+    _require_numpy()
+    results = {'historico': evaluate(history, history.actual)}
+    if workers > 1 and len(scenarios) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(scenarios)),
+                                 initializer=_init_worker, initargs=(history,)) as pool:
+            outcomes = list(pool.map(_simulate_in_worker, scenarios))
+    else:
+        outcomes = [simulate(history, scenario) for scenario in scenarios]
+    results.update(zip((scenario.name for scenario in scenarios), outcomes))
+    return results
+
+if __name__ == '__main__':
+    # A synthetic year of leads replayed through many scenarios, serial and
+    # across processes. No database needed.
+    _require_numpy()
+    ROWS = int(os.environ.get('BENCH_ROWS', 500000))
+    BROKERS = int(os.environ.get('BENCH_BROKERS', 40))
+    SCENARIOS = int(os.environ.get('BENCH_SCENARIOS', 48))
+
+    rng = numpy.random.default_rng(42)
+    broker_ids = list(range(1, BROKERS + 1))
+    history = History(
+        start=datetime.utcnow() - timedelta(days=365),
+        days=365,
+        hours=numpy.sort(rng.uniform(0, 365 * 24, ROWS)),
+        pages=rng.integers(0, 6, ROWS),
+        probabilities=rng.beta(2, 12, ROWS),
+        actual=rng.integers(0, BROKERS, ROWS),
+        broker_ids=broker_ids,
+        paces=rng.uniform(ROWS / (365 * 24 * BROKERS), 3 * ROWS / (365 * 24 * BROKERS), BROKERS),
+        lifts=rng.uniform(0.7, 1.3, BROKERS)
+    )
+    scenarios = []
+    for i in range(SCENARIOS):
+        brokers = sorted(rng.choice(broker_ids, size=int(rng.integers(BROKERS // 2, BROKERS + 1)),
+                                    replace=False).tolist())
+        pages = {page: {'mode': 'round_robin', 'broker_pool': brokers[page::3]}
+                 for page in range(1, 6) if i % 2}
+        scenarios.append(Scenario(f'cenario {i}', 'manual' if i % 4 == 1 else 'round_robin',
+                                  list(rng.permutation(brokers)), brokers, pages))
+
+    for workers in (1, WORKERS):
+        started = time.perf_counter()
+        results = run_scenarios(history, scenarios, workers=workers)
+        elapsed = time.perf_counter() - started
+        print(f"{ROWS} leads x {SCENARIOS} scenarios, {workers} workers: {elapsed:.2f}s")
+    best = min((name for name in results if name != 'historico'), key=lambda name: results[name]['p90_wait_hours'])
+    print(f"lowest p90 wait: {best} ({results[best]['p90_wait_hours']}h, "
+          f"{results[best]['expected_conversions']} expected conversions)")
@@ -0,0 +1,75 @@
+"""Local stand-in for the WhatsApp Cloud API send endpoint.
+
+    python fake_whatsapp_api.py  # listens on :5055
+    WHATSAPP_API_BASE=http://localhost:5055 gunicorn main:app ...
+
+Accepts POST /<phone_number_id>/messages, answers like the Cloud API and,
+when FAKE_WHATSAPP_WEBHOOK is set (e.g. http://localhost:5000/webhook/whatsapp),
+posts 'sent' and 'delivered' status callbacks for each message. Set
+FAKE_WHATSAPP_FAILURE_RATE (0-1) to simulate 500s and exercise retries, and
+FAKE_WHATSAPP_APP_SECRET to the configured app secret to sign the callbacks.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import requests
+from flask import Flask, request, jsonify
+from webhook_security import compute_signature
+
+fake_api = Flask(__name__)
+
+WEBHOOK_URL = os.environ.get('FAKE_WHATSAPP_WEBHOOK')
+FAILURE_RATE = float(os.environ.get('FAKE_WHATSAPP_FAILURE_RATE', 0))
+APP_SECRET = os.environ.get('FAKE_WHATSAPP_APP_SECRET')
+
+sent_messages = []
+
+def post_statuses(phone_number_id, message_id, recipient):
+    for status in ('sent', 'delivered'):
+        time.sleep(0.5)
+        body = json.dumps({
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'field': 'messages', 'value': {
+                'metadata': {'phone_number_id': phone_number_id},
+                'statuses': [{
+                    'id': message_id,
+                    'status': status,
+                    'timestamp': str(int(time.time())),
+                    'recipient_id': recipient
+                }]
+            }}]}]
+        }).encode()
+        headers = {'Content-Type': 'application/json'}
+        if APP_SECRET:
+            headers['X-Hub-Signature-256'] = compute_signature(APP_SECRET, body)
+        requests.post(WEBHOOK_URL, data=body, headers=headers, timeout=5)
+
+@fake_api.route('/<phone_number_id>/messages', methods=['POST'])
+def send(phone_number_id):
+    if random.random() < FAILURE_RATE:
+        return jsonify({'error': {'message': 'Simulated failure', 'code': 1}}), 500
+
+    payload = request.get_json()
+    message_id = f'wamid.{uuid.uuid4().hex}'
+    sent_messages.append({'id': message_id, 'payload': payload})
+
+    if WEBHOOK_URL:
+        threading.Thread(target=post_statuses,
+                         args=(phone_number_id, message_id, payload.get('to')),
+                         daemon=True).start()
+
+    return jsonify({
+        'messaging_product': 'whatsapp',
+        'contacts': [{'input': payload.get('to'), 'wa_id': payload.get('to')}],
+        'messages': [{'id': message_id}]
+    })
+
+@fake_api.route('/_sent')
+def list_sent():
+    return jsonify(sent_messages)
+
+if __name__ == '__main__':
+    fake_api.run(port=int(os.environ.get('FAKE_WHATSAPP_PORT', 5055)))
@@ -0,0 +1,236 @@
+import os
+import heapq
+import logging
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from sqlalchemy import insert, update, select, delete
+from models import Lead, LeadStatus, User, FollowUpReminder, Notification
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+# Each load reads reminders due before now + LOOKAHEAD; reloading every
+# RELOAD_INTERVAL means a reminder is in memory well before its due time.
+RELOAD_INTERVAL = timedelta(seconds=int(os.environ.get('FOLLOW_UP_RELOAD_SECONDS', 60)))
+LOOKAHEAD = RELOAD_INTERVAL * 2
+MAX_LOADED = int(os.environ.get('FOLLOW_UP_MAX_LOADED', 10000))
+
+EMAIL_ENABLED = os.environ.get('FOLLOW_UP_EMAIL', 'false').lower() == 'true'
+SMTP_HOST = os.environ.get('SMTP_HOST')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_FROM = os.environ.get('SMTP_FROM', SMTP_USER or 'no-reply@localhost')
+
+OPEN_STATUSES = [LeadStatus.NOVO, LeadStatus.EM_CONTATO]
+
+def schedule_reminder(lead):
+    """Create, move or cancel the reminder of a lead after its follow-up date changed
+
+    Runs in the caller's transaction; the engine notices the change on its next
+    load, and a moved reminder never fires at its old time.
+    """
+    due_at = lead.follow_up_date if lead.status in OPEN_STATUSES else None
+    if due_at is None:
+        # One statement whether or not there was a reminder
+        db.session.execute(delete(FollowUpReminder).where(FollowUpReminder.lead_id == lead.id))
+        return
+
+    reminder = FollowUpReminder.query.filter_by(lead_id=lead.id).first()
+
+    if not reminder:
+        reminder = FollowUpReminder(lead_id=lead.id)
+        db.session.add(reminder)
+    elif reminder.due_at == due_at:
+        return
+
+    reminder.due_at = due_at
+    reminder.fired_at = None
+    if reminder_engine.running:
+        db.session.flush()
+        # Pushed after commit would be more exact; an early push is harmless
+        # because firing re-checks due_at against the row.
+        reminder_engine.push(reminder.id, due_at)
+
+def backfill_reminders():
+    """Create reminders for open leads with a future follow-up and no reminder yet"""
+    pending = select(Lead.id, Lead.follow_up_date).where(
+        Lead.follow_up_date >= datetime.utcnow(),
+        Lead.status.in_(OPEN_STATUSES),
+        ~select(FollowUpReminder.id).where(FollowUpReminder.lead_id == Lead.id).exists()
+    )
+    result = db.session.execute(
+        insert(FollowUpReminder).from_select(['lead_id', 'due_at'], pending)
+    )
+    db.session.commit()
+    if result.rowcount:
+        logger.info(f"Backfilled {result.rowcount} follow-up reminders")
+
+def send_email(to_address, subject, body):
+    if not (EMAIL_ENABLED and SMTP_HOST and to_address):
+        return
+    message = EmailMessage()
+    message['From'] = SMTP_FROM
+    message['To'] = to_address
+    message['Subject'] = subject
+    message.set_content(body)
+    try:
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=15) as smtp:
+            smtp.starttls()
+            if SMTP_USER:
+                smtp.login(SMTP_USER, SMTP_PASSWORD)
+            smtp.send_message(message)
+    except (smtplib.SMTPException, OSError) as e:
+        logger.warning(f"Follow-up email to {to_address} failed: {str(e)}")
+
+class ReminderEngine:
+    """Fires follow-up reminders at their due time from an in-memory heap
+
+    The heap only holds the next window of reminders; it is refilled with one
+    range query on the (fired_at, due_at) index per reload interval, however
+    many reminders are scheduled further out.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+        self._loaded_until = None
+        self._next_load = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run, name='follow-up-reminders', daemon=True)
+        self._thread.start()
+        logger.info("Follow-up reminder engine started")
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def push(self, reminder_id, due_at):
+        """Queue a reminder that falls inside the loaded window"""
+        with self._condition:
+            if self._loaded_until is None or due_at >= self._loaded_until:
+                return
+            if (reminder_id, due_at) in self._queued:
+                return
+            self._queued.add((reminder_id, due_at))
+            heapq.heappush(self._heap, (due_at, reminder_id))
+            self._condition.notify()
+
+    def run(self):
+        while not self._stopped:
+            try:
+                with app.app_context():
+                    self.tick()
+            except Exception as e:
+                logger.error(f"Error in follow-up reminder engine: {str(e)}")
+                with app.app_context():
+                    db.session.rollback()
+
+            with self._condition:
+                if self._stopped:
+                    break
+                self._condition.wait(timeout=self.seconds_until_next_event())
+
+    def tick(self):
+        now = datetime.utcnow()
+        if self._next_load is None or now >= self._next_load:
+            self.load_window(now)
+
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, reminder_id = heapq.heappop(self._heap)
+                self._queued.discard((reminder_id, due_at))
+                due.append((reminder_id, due_at))
+        if due:
+            self.fire(due, now)
+
+    def seconds_until_next_event(self):
+        now = datetime.utcnow()
+        next_event = self._next_load or now
+        if self._heap:
+            next_event = min(next_event, self._heap[0][0])
+        return max((next_event - now).total_seconds(), 0.05)
+
+    def load_window(self, now):
+        """Read pending reminders due before the end of the next window (overdue ones included)"""
+        until = now + LOOKAHEAD
+        rows = db.session.query(FollowUpReminder.id, FollowUpReminder.due_at).filter(
+            FollowUpReminder.fired_at.is_(None),
+            FollowUpReminder.due_at < until
+        ).order_by(FollowUpReminder.due_at).limit(MAX_LOADED).all()
+        db.session.commit()
+
+        with self._condition:
+            for reminder_id, due_at in rows:
+                if (reminder_id, due_at) not in self._queued:
+                    self._queued.add((reminder_id, due_at))
+                    heapq.heappush(self._heap, (due_at, reminder_id))
+            # A full page means more are due; stop the window at the last one read
+            # and come back for the rest as soon as the heap reaches it
+            self._loaded_until = rows[-1].due_at if len(rows) == MAX_LOADED else until
+            self._next_load = min(now + RELOAD_INTERVAL, self._loaded_until)
+
+    def fire(self, due, now):
+        """Mark reminders fired and notify the lead's current broker
+
+        The UPDATE only matches a pending reminder still due at the queued time,
+        so a reminder fires once even with several engines, and a rescheduled
+        one waits for its new time.
+        """
+        fired_ids = []
+        for reminder_id, due_at in due:
+            result = db.session.execute(
+                update(FollowUpReminder).where(
+                    FollowUpReminder.id == reminder_id,
+                    FollowUpReminder.due_at == due_at,
+                    FollowUpReminder.fired_at.is_(None)
+                ).values(fired_at=now),
+                execution_options={'synchronize_session': False}
+            )
+            if result.rowcount:
+                fired_ids.append(reminder_id)
+
+        if not fired_ids:
+            db.session.commit()
+            return
+
+        leads = db.session.query(Lead.id, Lead.name, Lead.assigned_to, User.email, FollowUpReminder.due_at)\
+                          .join(FollowUpReminder, FollowUpReminder.lead_id == Lead.id)\
+                          .join(User, User.id == Lead.assigned_to)\
+                          .filter(FollowUpReminder.id.in_(fired_ids),
+                                  Lead.status.in_(OPEN_STATUSES)).all()
+
+        if leads:
+            db.session.execute(insert(Notification), [{
+                'user_id': lead.assigned_to,
+                'lead_id': lead.id,
+                'type': 'follow_up_due',
+                'message': f'Follow-up agendado com {lead.name}',
+                'is_read': False,
+                'created_at': now
+            } for lead in leads])
+        db.session.commit()
+
+        for lead in leads:
+            send_email(lead.email, f'Follow-up: {lead.name}',
+                       f"Você tem um follow-up agendado com {lead.name} "
+                       f"para {lead.due_at.strftime('%d/%m/%Y %H:%M')}.")
+
+        logger.info(f"Fired {len(leads)} follow-up reminders")
+
+reminder_engine = ReminderEngine()
@@ -0,0 +1,189 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete, update, union_all, literal, or_
+from models import (Lead, LeadStatus, LeadAssignment, Notification, FollowUpReminder, OutboundMessage,
+                    MergedLead, ArchivedLead, ArchivedLeadAssignment, IntegrationLog)
+from app import db
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('LEAD_ARCHIVE_AFTER_DAYS', 180))
+CHUNK_SIZE = int(os.environ.get('LEAD_ARCHIVE_CHUNK_SIZE', 1000))
+MAX_SECONDS = int(os.environ.get('LEAD_ARCHIVE_MAX_SECONDS', 900))
+
+CLOSED_STATUSES = [LeadStatus.CONVERTIDO, LeadStatus.PERDIDO]
+
+LEAD_COLUMNS = [column.name for column in Lead.__table__.columns]
+ASSIGNMENT_COLUMNS = [column.name for column in LeadAssignment.__table__.columns]
+
+# Columns available to reports over hot and archived leads alike
+REPORT_COLUMNS = ['id', 'status', 'assigned_to', 'meta_config_id', 'source_channel',
+                  'source_campaign_id', 'source_campaign_name', 'score', 'created_at', 'updated_at']
+
+def archive_closed_leads(older_than=None, max_seconds=MAX_SECONDS):
+    """Move closed leads untouched for older_than into the archive tables, one chunk per transaction
+
+    Returns run metrics; stops early when the time budget is spent and
+    continues from the start on the next run.
+    """
+    started = time.monotonic()
+    cutoff = datetime.utcnow() - (older_than or timedelta(days=ARCHIVE_AFTER_DAYS))
+    stats = {'archived': 0, 'chunks': 0}
+
+    try:
+        # One status at a time, so a chunk is the oldest range of the (status,
+        # updated_at, id) index; archived rows leave it, the next chunk starts over
+        for status in CLOSED_STATUSES:
+            candidates = db.session.query(Lead.id).filter(Lead.status == status, Lead.updated_at < cutoff)\
+                                                  .order_by(Lead.updated_at, Lead.id).limit(CHUNK_SIZE)
+            while time.monotonic() - started < max_seconds:
+                ids = [row.id for row in candidates]
+                if not ids:
+                    break
+
+                archive_chunk(ids)
+                db.session.commit()
+                stats['archived'] += len(ids)
+                stats['chunks'] += 1
+
+    except Exception as e:
+        logger.error(f"Error archiving leads: {str(e)}")
+        db.session.rollback()
+        stats['error'] = str(e)
+
+    stats['duration_seconds'] = round(time.monotonic() - started, 3)
+    if stats['archived'] or 'error' in stats:
+        db.session.add(IntegrationLog(
+            action='lead_archive',
+            status='error' if 'error' in stats else 'success',
+            message=f"Arquivados {stats['archived']} leads encerrados",
+            details=stats
+        ))
+        db.session.commit()
+
+    logger.info(f"Lead archive finished: {stats}")
+    return stats
+
+def archive_chunk(lead_ids):
+    """Copy leads and their assignment history to the archive and remove them from the hot tables"""
+    now = datetime.utcnow()
+
+    db.session.execute(insert(ArchivedLead).from_select(
+        LEAD_COLUMNS + ['archived_at'],
+        select(*[Lead.__table__.c[name] for name in LEAD_COLUMNS], literal(now))
+            .where(Lead.id.in_(lead_ids))
+    ))
+    db.session.execute(insert(ArchivedLeadAssignment).from_select(
+        ASSIGNMENT_COLUMNS,
+        select(*[LeadAssignment.__table__.c[name] for name in ASSIGNMENT_COLUMNS])
+            .where(LeadAssignment.lead_id.in_(lead_ids))
+    ))
+
+    # Rows referencing the leads: history is archived, transient state is dropped
+    db.session.execute(delete(LeadAssignment).where(LeadAssignment.lead_id.in_(lead_ids)))
+    db.session.execute(delete(Notification).where(Notification.lead_id.in_(lead_ids)))
+    db.session.execute(delete(FollowUpReminder).where(FollowUpReminder.lead_id.in_(lead_ids)))
+    db.session.execute(update(OutboundMessage).where(OutboundMessage.lead_id.in_(lead_ids))
+                                              .values(lead_id=None))
+    db.session.execute(update(MergedLead).where(MergedLead.lead_id.in_(lead_ids))
+                                         .values(lead_id=None))
+    db.session.execute(delete(Lead).where(Lead.id.in_(lead_ids)))
+
+def lead_table(include_archived=False):
+    """Selectable for reports: the leads table, or leads plus the archive
+
+    Both expose the REPORT_COLUMNS through .c, so report queries are written
+    once and the archive is only read when asked for.
+    """
+    if not include_archived:
+        return Lead.__table__
+    return union_all(
+        select(*[Lead.__table__.c[name] for name in REPORT_COLUMNS]),
+        select(*[ArchivedLead.__table__.c[name] for name in REPORT_COLUMNS])
+    ).subquery('all_leads')
+
+def search_archived_leads(query, limit=50):
+    """Substring search over archived leads (not full-text indexed; on demand only)"""
+    from lead_search import _escape_like
+
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    like = f"%{_escape_like(query)}%"
+    return ArchivedLead.query.filter(or_(
+        ArchivedLead.name.ilike(like, escape='\\'),
+        ArchivedLead.email.ilike(like, escape='\\'),
+        ArchivedLead.phone.ilike(like, escape='\\')
+    )).order_by(ArchivedLead.created_at.desc()).limit(limit).all()
+
+if __name__ == '__main__':
+    # Hot-path latency before and after archiving 80% of a synthetic table.
+    # Run against a scratch database only, e.g.
+    #   DATABASE_URL=postgresql://.../bench BENCH_ROWS=10000000 python lead_archive.py
+    import random
+    from sqlalchemy import func
+    from models import User, UserRole
+    from app import app
+
+    ROWS = int(os.environ.get('BENCH_ROWS', 100000))
+    BROKERS = 50
+    BATCH = 10000
+
+    def timed(label, query, repeat=5):
+        best = min(_elapsed(query) for _ in range(repeat))
+        print(f"  {label:<28} {best * 1000:8.2f} ms")
+
+    def _elapsed(query):
+        started = time.perf_counter()
+        query()
+        return time.perf_counter() - started
+
+    def hot_path():
+        now = datetime.utcnow()
+        broker = random.choice(brokers)
+        timed('broker NOVO count', lambda: Lead.query.filter_by(
+            assigned_to=broker, status=LeadStatus.NOVO).count())
+        timed('broker recent leads', lambda: Lead.query.filter_by(assigned_to=broker)
+              .order_by(Lead.created_at.desc(), Lead.id.desc()).limit(20).all())
+        timed('admin status counts', lambda: db.session.query(Lead.status, func.count(Lead.id))
+              .group_by(Lead.status).all())
+        timed('sweeper batch', lambda: db.session.query(Lead.id).filter(
+            Lead.status == LeadStatus.NOVO, Lead.updated_at < now - timedelta(hours=24))
+              .order_by(Lead.updated_at, Lead.id).limit(500).all())
+
+    with app.app_context():
+        db.create_all()
+        if not User.query.filter_by(role=UserRole.BROKER).count():
+            db.session.execute(insert(User), [{
+                'username': f'bench{n}', 'email': f'bench{n}@example.com', 'password_hash': '-',
+                'role': UserRole.BROKER, 'is_active': True
+            } for n in range(BROKERS)])
+            db.session.commit()
+        brokers = [user.id for user in User.query.filter_by(role=UserRole.BROKER)]
+
+        print(f"Inserting {ROWS} leads (80% closed and older than {ARCHIVE_AFTER_DAYS} days)")
+        now = datetime.utcnow()
+        for start in range(0, ROWS, BATCH):
+            rows = []
+            for n in range(start, min(start + BATCH, ROWS)):
+                closed = n % 5 != 0
+                created = now - timedelta(days=ARCHIVE_AFTER_DAYS + 30 if closed else random.randint(0, 30))
+                rows.append({
+                    'name': f'Lead {n}', 'phone': f'55119{n:08d}', 'email': f'lead{n}@example.com',
+                    'status': random.choice(CLOSED_STATUSES) if closed else random.choice(
+                        [LeadStatus.NOVO, LeadStatus.EM_CONTATO]),
+                    'assigned_to': random.choice(brokers), 'source_channel': 'meta',
+                    'created_at': created, 'updated_at': created
+                })
+            db.session.execute(insert(Lead), rows)
+            db.session.commit()
+
+        print("Before archiving:")
+        hot_path()
+        stats = archive_closed_leads(max_seconds=float('inf'))
+        print(f"Archived {stats['archived']} leads in {stats['duration_seconds']}s")
+        print("After archiving:")
+        hot_path()
@@ -0,0 +1,319 @@
+import time
+import base64
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, and_, or_, case, update
+from models import Lead, LeadStatus, User
+from dashboard_counters import lead_facets
+from app import db
+
+logger = logging.getLogger(__name__)
+
+FACET_CACHE_TTL = 30  # seconds
+PAGE_SIZE = 50
+NOTES_PREVIEW_CHARS = 120
+
+# What list pages render: plain rows without message and notes (Text, often
+# kilobytes per lead), which only lead_detail loads
+LIST_COLUMNS = (Lead.id, Lead.name, Lead.email, Lead.phone, Lead.status, Lead.score,
+                Lead.assigned_to, Lead.follow_up_date, Lead.created_at, Lead.updated_at)
+
+BACKFILL_BATCH = 5000
+
+# Origin of rows created before source attribution, from the data each ingest
+# path writes (the 'source' dashboard counters use the same rules)
+legacy_source = case(
+    (Lead.meta_lead_id.isnot(None), 'meta'),
+    (Lead.message.like('Mensagem via WhatsApp%'), 'whatsapp'),
+    else_='manual'
+)
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry"""
+
+    def __init__(self, ttl, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            self._data.pop(key, None)
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                # Drop the entry closest to expiry
+                oldest = min(self._data, key=lambda k: self._data[k][0])
+                self._data.pop(oldest, None)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+facet_cache = TTLCache(FACET_CACHE_TTL)
+
+def lead_rows(*columns):
+    """Query of LIST_COLUMNS plus columns, returning named rows instead of Lead entities"""
+    return db.session.query(*LIST_COLUMNS, *columns)
+
+def lead_rows_with_broker(*columns):
+    """lead_rows() with the assigned broker's username as broker_username (None if unassigned)"""
+    return lead_rows(User.username.label('broker_username'), *columns)\
+        .outerjoin(User, User.id == Lead.assigned_to)
+
+def notes_preview():
+    return func.substr(Lead.notes, 1, NOTES_PREVIEW_CHARS).label('notes')
+
+def parse_filters(args):
+    """Read lead browser filters from request args"""
+    filters = {
+        'status': args.get('status') or None,
+        'broker_id': args.get('broker_id', type=int),
+        'page_id': args.get('page_id', type=int),
+        'source': args.get('source') or None,
+        'date_from': _parse_date(args.get('date_from')),
+        'date_to': _parse_date(args.get('date_to')),
+        'unassigned': args.get('unassigned') == '1',
+    }
+    if filters['status']:
+        try:
+            filters['status'] = LeadStatus(filters['status'])
+        except ValueError:
+            filters['status'] = None
+    return filters
+
+def filter_signature(filters):
+    """Stable cache key for a filter set"""
+    return tuple(sorted((k, str(v)) for k, v in filters.items() if v))
+
+def apply_filters(query, filters):
+    if filters['status']:
+        query = query.filter(Lead.status == filters['status'])
+    if filters['unassigned']:
+        query = query.filter(Lead.assigned_to.is_(None))
+    elif filters['broker_id']:
+        query = query.filter(Lead.assigned_to == filters['broker_id'])
+    if filters['page_id']:
+        # Backed by the (meta_config_id, created_at, id) index
+        query = query.filter(Lead.meta_config_id == filters['page_id'])
+    if filters['source']:
+        # Backed by the (source_channel, created_at, id) index
+        query = query.filter(Lead.source_channel == filters['source'])
+    if filters['date_from']:
+        query = query.filter(Lead.created_at >= filters['date_from'])
+    if filters['date_to']:
+        query = query.filter(Lead.created_at < filters['date_to'] + timedelta(days=1))
+    return query
+
+def browse_leads(filters, cursor=None, page_size=PAGE_SIZE):
+    """Return one page of leads (newest first) and the cursor of the next page"""
+    query = apply_filters(lead_rows_with_broker(), filters)
+
+    position = decode_cursor(cursor)
+    if position:
+        created_at, lead_id = position
+        query = query.filter(or_(
+            Lead.created_at < created_at,
+            and_(Lead.created_at == created_at, Lead.id < lead_id)
+        ))
+
+    leads = query.order_by(Lead.created_at.desc(), Lead.id.desc()).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(leads) > page_size:
+        leads = leads[:page_size]
+        next_cursor = encode_cursor(leads[-1])
+    return leads, next_cursor
+
+def get_facets(filters):
+    """Status, broker and source counts for a filter set in a single aggregate query
+
+    Without filters they are read from the dashboard counters instead of
+    grouping the whole leads table.
+    """
+    key = filter_signature(filters)
+    if not key:
+        return lead_facets()
+
+    facets = facet_cache.get(key)
+    if facets is None:
+        facets = aggregate_facets(filters)
+        facet_cache.set(key, facets)
+    return facets
+
+def aggregate_facets(filters):
+    rows = apply_filters(
+        db.session.query(Lead.status, Lead.assigned_to, Lead.source_channel, func.count(Lead.id)),
+        filters
+    ).group_by(Lead.status, Lead.assigned_to, Lead.source_channel).all()
+
+    facets = {'total': 0, 'status': {}, 'broker': {}, 'source': {}}
+    for status, broker_id, source_name, count in rows:
+        status_key = status.value if status else None
+        facets['total'] += count
+        facets['status'][status_key] = facets['status'].get(status_key, 0) + count
+        facets['broker'][broker_id] = facets['broker'].get(broker_id, 0) + count
+        facets['source'][source_name] = facets['source'].get(source_name, 0) + count
+    return facets
+
+def backfill_browse_columns(batch_size=BACKFILL_BATCH):
+    """Fill the NULL source_channel and created_at of leads stored by older versions
+
+    The source filter and the keyset cursor read those columns as stored, so
+    legacy rows get their classified source and, lacking a creation time,
+    their last update. Runs from init-db in batches found through the
+    (source_channel, ...) and (created_at, ...) indexes; updated_at is left
+    alone so sync clients don't download the rows again.
+    """
+    filled = 0
+    for column, value in ((Lead.source_channel, legacy_source),
+                          (Lead.created_at, func.coalesce(Lead.updated_at, func.now()))):
+        while True:
+            ids = [row.id for row in db.session.query(Lead.id).filter(column.is_(None)).limit(batch_size)]
+            if not ids:
+                break
+            db.session.execute(update(Lead).where(Lead.id.in_(ids)).values({column: value}),
+                               execution_options={'synchronize_session': False})
+            db.session.commit()
+            filled += len(ids)
+    if filled:
+        logger.info(f"Backfilled {filled} legacy lead columns")
+    return filled
+
+def encode_cursor(lead):
+    # created_at is set on insert and backfilled for legacy rows (backfill_browse_columns)
+    raw = f"{lead.created_at.isoformat()}|{lead.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        created_at, lead_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(lead_id)
+    except (ValueError, UnicodeDecodeError):
+        logger.warning(f"Ignoring invalid lead browser cursor: {cursor}")
+        return None
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+if __name__ == '__main__':
+    # Render the broker leads page for 1,000 leads carrying large message and
+    # notes, loaded as Lead entities and as list rows. Seeds its own broker
+    # and leads (removed afterwards); point DATABASE_URL at a scratch database.
+    import os
+    import random
+    import statistics
+    import tracemalloc
+    from flask import render_template, session
+    from sqlalchemy import insert, delete, desc, text
+    from app import app, create_app
+    from models import UserRole
+
+    ROWS = int(os.environ.get('BENCH_ROWS', 1000))
+    TEXT_CHARS = int(os.environ.get('BENCH_TEXT_CHARS', 20000))
+    RUNS = int(os.environ.get('BENCH_RUNS', 10))
+    FACET_ROWS = int(os.environ.get('BENCH_FACET_ROWS', 200000))
+
+    create_app()
+    with app.app_context():
+        db.create_all()
+        broker = User(username=f'bench-{random.randrange(10 ** 9)}', email='bench@example.com',
+                      password_hash='-', role=UserRole.BROKER, is_active=True)
+        db.session.add(broker)
+        db.session.commit()
+        broker_id = broker.id
+        now = datetime.utcnow()
+        db.session.execute(insert(Lead), [{
+            'name': f'Lead {n}', 'email': f'lead{n}@example.com', 'phone': f'5511{n:09d}',
+            'message': 'Mensagem ' * (TEXT_CHARS // 9), 'notes': 'Observação ' * (TEXT_CHARS // 11),
+            'status': LeadStatus.NOVO, 'assigned_to': broker_id, 'score': n % 100,
+            'created_at': now - timedelta(minutes=n), 'updated_at': now
+        } for n in range(ROWS)])
+        db.session.commit()
+
+    def entities():
+        return Lead.query.filter_by(assigned_to=broker_id)\
+                         .order_by(desc(Lead.score), desc(Lead.created_at)).all()
+
+    def rows():
+        return lead_rows().filter(Lead.assigned_to == broker_id)\
+                          .order_by(desc(Lead.score), desc(Lead.created_at)).all()
+
+    def render(load):
+        # A fresh request (and session) per run, as in production
+        with app.test_request_context('/broker/leads'):
+            session['user_id'] = broker_id
+            return render_template('broker_leads.html', leads=load(), current_status=None,
+                                   current_order='score')
+
+    def facet_timings():
+        # Facet counts of the admin lead browser over FACET_ROWS more leads: unfiltered
+        # from the counters and by aggregate, filtered by aggregate (the cache is bypassed)
+        from werkzeug.datastructures import MultiDict
+        with app.app_context():
+            now = datetime.utcnow()
+            statuses, sources = list(LeadStatus), ['meta', 'whatsapp', 'import', 'manual']
+            for start in range(0, FACET_ROWS, 10000):
+                db.session.execute(insert(Lead), [{
+                    'name': f'Lead {n}', 'phone': f'5521{n:09d}', 'status': statuses[n % len(statuses)],
+                    'source_channel': sources[n % len(sources)], 'assigned_to': broker_id,
+                    'created_at': now - timedelta(hours=n % 4000), 'updated_at': now
+                } for n in range(start, min(start + 10000, FACET_ROWS))])
+                db.session.commit()
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute(text('ANALYZE leads'))
+                db.session.commit()
+
+            week_ago = (now - timedelta(days=7)).strftime('%Y-%m-%d')
+            cases = [
+                ('unfiltered, counters', get_facets, {}),
+                ('unfiltered, aggregate', aggregate_facets, {}),
+                ('status', aggregate_facets, {'status': LeadStatus.NOVO.value}),
+                ('broker', aggregate_facets, {'broker_id': broker_id}),
+                ('source', aggregate_facets, {'source': 'meta'}),
+                ('last 7 days', aggregate_facets, {'date_from': week_ago}),
+            ]
+            for name, facets, args in cases:
+                filters = parse_filters(MultiDict(args))
+                timings = []
+                for _ in range(RUNS):
+                    started = time.perf_counter()
+                    result = facets(filters)
+                    timings.append(time.perf_counter() - started)
+                print(f"facets {name:>22}: {statistics.median(timings) * 1000:8.2f} ms ({result['total']} leads)")
+
+    try:
+        for name, load in (('Lead entities', entities), ('list rows', rows)):
+            render(load)
+            timings = []
+            for _ in range(RUNS):
+                started = time.perf_counter()
+                render(load)
+                timings.append(time.perf_counter() - started)
+            tracemalloc.start()
+            render(load)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:>13}: {statistics.median(timings) * 1000:7.1f} ms, peak {peak / 2 ** 20:6.1f} MiB "
+                  f"({ROWS} rows, {TEXT_CHARS} chars of message and notes each)")
+        facet_timings()
+    finally:
+        with app.app_context():
+            db.session.execute(delete(Lead).where(Lead.assigned_to == broker_id))
+            db.session.execute(delete(User).where(User.id == broker_id))
+            db.session.commit()
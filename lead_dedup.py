@@ -0,0 +1,331 @@
+"""Duplicate-lead detection and merging.
+
+Every lead stores a normalized phone key (digits without country code or the
+Brazilian mobile ninth digit) and e-mail key (lowercase, without +tags, Gmail
+dots folded). Candidates are only the leads sharing one of those keys, found
+with index lookups, never by comparing leads pairwise.
+Each candidate is scored: both keys equal is a match; one key equal scores
+by how similar the names are. Matches at or above DEDUP_MERGE_THRESHOLD are
+merged into the older lead, which keeps its broker and status and takes
+over the duplicate's notes, history and follow-up.
+"""
+import os
+import re
+import time
+import logging
+import unicodedata
+from difflib import SequenceMatcher
+from datetime import datetime
+from sqlalchemy import event, func, update, delete, or_
+from models import (Lead, LeadAssignment, Notification, FollowUpReminder, OutboundMessage,
+                    MergedLead, IntegrationLog)
+from follow_up_reminders import schedule_reminder
+from app import db
+
+logger = logging.getLogger(__name__)
+
+MERGE_THRESHOLD = float(os.environ.get('DEDUP_MERGE_THRESHOLD', 0.9))
+BATCH_SIZE = int(os.environ.get('DEDUP_BATCH_SIZE', 500))
+# Keys shared by more leads than this (e.g. a placeholder phone) are not candidates
+MAX_GROUP_SIZE = int(os.environ.get('DEDUP_MAX_GROUP_SIZE', 20))
+
+# A single matching key is worth KEY_WEIGHT; the name similarity adds the rest
+KEY_WEIGHT = 0.6
+
+PLACEHOLDER_NAMES = re.compile(r'^(contato|unknown|lead)\b|@|^[\d\s()+-]+$', re.IGNORECASE)
+
+def phone_key(phone):
+    digits = re.sub(r'\D', '', phone or '').lstrip('0')
+    if len(digits) in (12, 13) and digits.startswith('55'):
+        digits = digits[2:]
+    if len(digits) == 11 and digits[2] == '9':
+        # Brazilian mobile: older records were stored without the ninth digit
+        digits = digits[:2] + digits[3:]
+    return digits[-20:] if len(digits) >= 8 else None
+
+def email_key(email):
+    email = (email or '').strip().lower()
+    local, _, domain = email.rpartition('@')
+    local = local.split('+', 1)[0]
+    if not local or not domain:
+        return None
+    if domain in ('gmail.com', 'googlemail.com'):
+        local, domain = local.replace('.', ''), 'gmail.com'
+    return f'{local}@{domain}'[:256]
+
+def set_keys(lead):
+    lead.phone_key = phone_key(lead.phone)
+    lead.email_key = email_key(lead.email)
+
+@event.listens_for(Lead, 'before_insert')
+@event.listens_for(Lead, 'before_update')
+def _maintain_keys(mapper, connection, lead):
+    set_keys(lead)
+
+def normalize_name(name):
+    name = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode().lower()
+    return ' '.join(re.findall(r'[a-z0-9]+', name))
+
+def is_placeholder(name):
+    """Names generated when the real one is unknown (WhatsApp number, import e-mail)"""
+    return not name or bool(PLACEHOLDER_NAMES.search(name.strip()))
+
+def name_similarity(a, b):
+    """Similarity of two names from 0 to 1, or None when either is a placeholder
+
+    Takes the better of the character ratio and the share of the shorter
+    name's words found in the other, so "Ana Souza" matches "Ana Paula Souza".
+    """
+    if is_placeholder(a) or is_placeholder(b):
+        return None
+    a, b = normalize_name(a), normalize_name(b)
+    if not a or not b:
+        return None
+    words_a, words_b = set(a.split()), set(b.split())
+    overlap = len(words_a & words_b) / min(len(words_a), len(words_b))
+    return max(overlap, SequenceMatcher(None, a, b).ratio())
+
+def match_score(lead, candidate):
+    phone_match = bool(lead.phone_key) and lead.phone_key == candidate.phone_key
+    email_match = bool(lead.email_key) and lead.email_key == candidate.email_key
+    if phone_match and email_match:
+        return 1.0
+    if not (phone_match or email_match):
+        return 0.0
+    similarity = name_similarity(lead.name, candidate.name)
+    # Nothing contradicts the key when one side has no real name
+    return KEY_WEIGHT + (1 - KEY_WEIGHT) * (1.0 if similarity is None else similarity)
+
+def find_duplicate(lead):
+    """Best-scoring existing lead sharing a phone or e-mail key with lead; returns (lead, score)"""
+    filters = []
+    if lead.phone_key:
+        filters.append(Lead.phone_key == lead.phone_key)
+    if lead.email_key:
+        filters.append(Lead.email_key == lead.email_key)
+    if not filters:
+        return None, 0.0
+
+    query = Lead.query.filter(or_(*filters))
+    if lead.id:
+        query = query.filter(Lead.id != lead.id)
+
+    best, best_score = None, 0.0
+    # Oldest first, so ties keep the original lead
+    for candidate in query.order_by(Lead.created_at, Lead.id).limit(MAX_GROUP_SIZE):
+        score = match_score(lead, candidate)
+        if score > best_score:
+            best, best_score = candidate, score
+    return best, best_score
+
+def absorb_duplicate(lead, notify=True):
+    """Merge a new, not yet added lead into an existing high-confidence duplicate
+
+    Returns the existing lead (the new one must then not be added), or None.
+    The existing lead's broker is told the contact came back.
+    """
+    set_keys(lead)
+    existing, score = find_duplicate(lead)
+    if not existing or score < MERGE_THRESHOLD:
+        return None
+
+    merge_into(existing, lead, score)
+    if notify and existing.assigned_to:
+        db.session.add(Notification(
+            user_id=existing.assigned_to,
+            lead_id=existing.id,
+            type='lead_returned',
+            message=f'{existing.name} entrou em contato novamente ({lead.source_channel or "manual"})'
+        ))
+    return existing
+
+def merge_into(lead, duplicate, score):
+    """Fold duplicate into lead, keeping lead's broker, status and attribution
+
+    A stored duplicate's notes, assignment history, sent messages and
+    follow-up move to lead; its status and broker are kept on the MergedLead row.
+    """
+    if not lead.email and duplicate.email:
+        lead.email = duplicate.email
+    if not lead.phone and duplicate.phone:
+        lead.phone = duplicate.phone
+    if is_placeholder(lead.name) and not is_placeholder(duplicate.name):
+        lead.name = duplicate.name
+    # The earlier follow-up wins
+    follow_up_moved = bool(duplicate.follow_up_date) and (not lead.follow_up_date
+                                                          or duplicate.follow_up_date < lead.follow_up_date)
+    if follow_up_moved:
+        lead.follow_up_date = duplicate.follow_up_date
+
+    received = (duplicate.created_at or datetime.utcnow()).strftime('%d/%m/%Y %H:%M')
+    note = f"[{received}] Contato duplicado via {duplicate.source_channel or 'manual'}"
+    if duplicate.message:
+        note += f": {duplicate.message}"
+    if duplicate.notes:
+        note += f"\n{duplicate.notes}"
+    lead.notes = f"{lead.notes}\n{note}" if lead.notes else note
+
+    db.session.add(MergedLead(
+        lead_id=lead.id,
+        merged_lead_id=duplicate.id,
+        meta_lead_id=duplicate.meta_lead_id,
+        name=duplicate.name,
+        email=duplicate.email,
+        phone=duplicate.phone,
+        source_channel=duplicate.source_channel,
+        status=duplicate.status,
+        assigned_to=duplicate.assigned_to,
+        score=round(score, 3)
+    ))
+
+    if duplicate.id:
+        # Stored duplicate: its history follows the kept lead, only its notifications go
+        for model in (LeadAssignment, OutboundMessage, MergedLead):
+            db.session.execute(update(model).where(model.lead_id == duplicate.id).values(lead_id=lead.id))
+        # One reminder per lead: the kept lead adopts the duplicate's unless it has its own
+        if FollowUpReminder.query.filter_by(lead_id=lead.id).first():
+            db.session.execute(delete(FollowUpReminder).where(FollowUpReminder.lead_id == duplicate.id))
+        else:
+            db.session.execute(update(FollowUpReminder).where(FollowUpReminder.lead_id == duplicate.id)
+                                                       .values(lead_id=lead.id))
+        db.session.execute(delete(Notification).where(Notification.lead_id == duplicate.id))
+        # A loaded collection would still hold the moved assignments and null them out
+        db.session.expire(duplicate, ['assignments'])
+        db.session.delete(duplicate)
+
+    if follow_up_moved or duplicate.id:
+        schedule_reminder(lead)
+
+def split_duplicates(rows):
+    """Drop rows (column dicts for insert(Lead)) that duplicate a stored lead, merging them in
+
+    Two IN queries fetch every candidate of the chunk; returns the rows to insert.
+    Duplicates within the chunk itself are left to dedupe_existing.
+    """
+    for row in rows:
+        row['phone_key'] = phone_key(row.get('phone'))
+        row['email_key'] = email_key(row.get('email'))
+
+    phone_keys = {row['phone_key'] for row in rows if row['phone_key']}
+    email_keys = {row['email_key'] for row in rows if row['email_key']}
+    candidates = {}
+    if phone_keys:
+        candidates.update((lead.id, lead) for lead in Lead.query.filter(Lead.phone_key.in_(phone_keys)))
+    if email_keys:
+        candidates.update((lead.id, lead) for lead in Lead.query.filter(Lead.email_key.in_(email_keys)))
+    if not candidates:
+        return rows
+
+    by_phone, by_email = {}, {}
+    for lead in sorted(candidates.values(), key=lambda lead: (lead.created_at or datetime.min, lead.id)):
+        by_phone.setdefault(lead.phone_key, []).append(lead)
+        by_email.setdefault(lead.email_key, []).append(lead)
+
+    new_rows = []
+    for row in rows:
+        incoming = Lead(**row)
+        best, best_score = None, 0.0
+        for candidate in by_phone.get(row['phone_key'], []) + by_email.get(row['email_key'], []):
+            score = match_score(incoming, candidate)
+            if score > best_score:
+                best, best_score = candidate, score
+        if best and best_score >= MERGE_THRESHOLD:
+            merge_into(best, incoming, best_score)
+        else:
+            new_rows.append(row)
+    return new_rows
+
+def dedupe_existing(max_seconds=None):
+    """Batch mode: fill missing keys, then merge duplicates already in the table
+
+    Works through keys in chunks of BATCH_SIZE with one transaction each, so
+    memory stays bounded by BATCH_SIZE × MAX_GROUP_SIZE leads.
+    """
+    started = time.monotonic()
+    stats = {'keyed': 0, 'groups': 0, 'merged': 0}
+
+    def out_of_time():
+        return max_seconds is not None and time.monotonic() - started > max_seconds
+
+    try:
+        stats['keyed'] = backfill_keys()
+        for key_column in (Lead.phone_key, Lead.email_key):
+            for keys in iter_duplicate_keys(key_column):
+                stats['groups'] += len(keys)
+                stats['merged'] += merge_groups(key_column, keys)
+                db.session.commit()
+                if out_of_time():
+                    break
+            if out_of_time():
+                break
+    except Exception as e:
+        logger.error(f"Error deduplicating leads: {str(e)}")
+        db.session.rollback()
+        stats['error'] = str(e)
+
+    stats['duration_seconds'] = round(time.monotonic() - started, 3)
+    db.session.add(IntegrationLog(
+        action='lead_dedup',
+        status='error' if 'error' in stats else 'success',
+        message=f"{stats['merged']} leads duplicados mesclados",
+        details=stats
+    ))
+    db.session.commit()
+
+    logger.info(f"Lead dedup finished: {stats}")
+    return stats
+
+def backfill_keys():
+    """Compute keys of leads stored before deduplication existed, one chunk per transaction"""
+    missing = db.session.query(Lead.id, Lead.phone, Lead.email, Lead.updated_at).filter(or_(
+        Lead.phone.isnot(None) & Lead.phone_key.is_(None),
+        Lead.email.isnot(None) & Lead.email_key.is_(None)
+    ))
+    keyed = 0
+    last_id = 0
+    while True:
+        rows = missing.filter(Lead.id > last_id).order_by(Lead.id).limit(BATCH_SIZE).all()
+        if not rows:
+            return keyed
+        last_id = rows[-1].id
+        db.session.execute(update(Lead), [{
+            'id': row.id,
+            'phone_key': phone_key(row.phone),
+            'email_key': email_key(row.email),
+            'updated_at': row.updated_at  # Not a change the sweeper or archive should see
+        } for row in rows])
+        db.session.commit()
+        keyed += len(rows)
+
+def iter_duplicate_keys(key_column):
+    """Yield chunks of key values shared by 2..MAX_GROUP_SIZE leads, in key order
+
+    Each chunk is a range scan of the key's btree index from the last key.
+    """
+    last_key = ''
+    while True:
+        keys = [row[0] for row in db.session.query(key_column)
+                .filter(key_column.isnot(None), key_column > last_key)
+                .group_by(key_column)
+                .having(func.count(Lead.id).between(2, MAX_GROUP_SIZE))
+                .order_by(key_column).limit(BATCH_SIZE)]
+        if not keys:
+            return
+        last_key = keys[-1]
+        yield keys
+
+def merge_groups(key_column, keys):
+    leads = Lead.query.filter(key_column.in_(keys)).order_by(key_column, Lead.created_at, Lead.id).all()
+    groups = {}
+    for lead in leads:
+        groups.setdefault(getattr(lead, key_column.key), []).append(lead)
+
+    merged = 0
+    for group in groups.values():
+        original = group[0]
+        for duplicate in group[1:]:
+            score = match_score(duplicate, original)
+            if score >= MERGE_THRESHOLD:
+                merge_into(original, duplicate, score)
+                merged += 1
+    return merged
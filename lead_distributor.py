@@ -1,23 +1,49 @@
 import logging
-from models import Lead, User, DistributionConfig, LeadAssignment, DistributionMode
+from datetime import datetime
+from sqlalchemy import func, insert, update
+from models import (Lead, User, DistributionConfig, LeadAssignment, DistributionMode, UserRole,
+                    Notification)
+from config_registry import config_registry
 from app import db
 
 logger = logging.getLogger(__name__)
 
 class LeadDistributor:
-    def __init__(self):
+    def __init__(self, batch_mode=False, meta_config_id=None):
+        # Leads of a Meta page with its own distribution config rotate within
+        # that page's broker pool; everything else uses the default config.
+        self.meta_config_id = meta_config_id
         self.config = None
+        # The config row itself, loaded (and locked) only when the round-robin index moves
+        self._state = None
+        self._state_transaction = None
+        # In batch mode the broker roster is loaded once per instance and
+        # commits are left to the caller, so large jobs don't pay a query
+        # and a commit per lead.
+        self.batch_mode = batch_mode
+        self._brokers = None
+        self._page_distributors = {}
     
     def load_config(self):
         """Load distribution configuration"""
-        from flask import current_app
-        with current_app.app_context():
-            self.config = DistributionConfig.query.first()
-            if not self.config:
-                # Create default config
-                self.config = DistributionConfig()
-                db.session.add(self.config)
-                db.session.commit()
+        self.config = config_registry.distribution_config(self.meta_config_id)
+        self._state = None
+    
+    @property
+    def state(self):
+        """The DistributionConfig row holding current_index, in the caller's session
+        
+        Locked with SELECT ... FOR UPDATE until the transaction ends (re-locked
+        in the next one), so distributors sharing a config, e.g. parallel page
+        syncs falling back to the default, take turns instead of losing
+        updates. SQLite serializes writers anyway and ignores FOR UPDATE.
+        """
+        transaction = db.session().get_transaction()
+        if self._state is None or transaction is None or transaction is not self._state_transaction:
+            self._state = db.session.get(DistributionConfig, self.config.id,
+                                         with_for_update=True, populate_existing=True)
+            self._state_transaction = db.session().get_transaction()
+        return self._state
     
     def distribute_leads(self, leads):
         """Distribute leads to brokers based on configuration"""
@@ -26,73 +52,91 @@ class LeadDistributor:
         
         self.load_config()
         
-        for lead in leads:
+        # Highest-scoring leads are handed out first
+        for lead in sorted(leads, key=lambda lead: lead.score or 0, reverse=True):
             if lead.assigned_to is None:
                 broker = self.get_next_broker()
                 if broker:
                     self.assign_lead_to_broker(lead, broker)
     
-    def get_next_broker(self):
+    def get_next_broker(self, exclude_broker_id=None):
         """Get the next broker based on distribution mode"""
+        if self.config is None:
+            self.load_config()
+        
         if self.config.mode == DistributionMode.ROUND_ROBIN:
-            return self.get_next_broker_round_robin()
+            return self.get_next_broker_round_robin(exclude_broker_id)
         elif self.config.mode == DistributionMode.MANUAL:
-            return self.get_next_broker_manual()
+            return self.get_next_broker_manual(exclude_broker_id)
         
         return None
     
-    def get_next_broker_round_robin(self):
-        """Get next broker using round robin algorithm"""
-        # Get all active brokers who can receive leads
+    def get_available_brokers(self):
+        """Get all active brokers who can receive leads"""
+        if self.batch_mode and self._brokers is not None:
+            return self._brokers
+        
+        if self.config is None:
+            self.load_config()
+        
         query = User.query.filter_by(
-            role='broker',
+            role=UserRole.BROKER,
             is_active=True,
             can_receive_leads=True
         )
+        if self.config.broker_pool:
+            query = query.filter(User.id.in_(self.config.broker_pool))
+        brokers = query.order_by(User.id).all()
         
-        if self.config.skip_inactive:
-            brokers = query.all()
-        else:
-            brokers = query.all()
+        if self.batch_mode:
+            self._brokers = brokers
+        return brokers
+    
+    def get_next_broker_round_robin(self, exclude_broker_id=None):
+        """Get next broker using round robin algorithm"""
+        brokers = self.get_available_brokers()
         
         if not brokers:
             logger.warning("No available brokers for lead distribution")
             return None
         
         # Use round robin to select broker
-        current_index = self.config.current_index % len(brokers)
+        current_index = self.state.current_index % len(brokers)
         selected_broker = brokers[current_index]
         
+        # Skip the excluded broker (e.g. the current owner on reassignment)
+        if selected_broker.id == exclude_broker_id:
+            if len(brokers) == 1:
+                return None
+            current_index = (current_index + 1) % len(brokers)
+            selected_broker = brokers[current_index]
+        
         # Update index for next assignment
-        self.config.current_index = (current_index + 1) % len(brokers)
-        db.session.commit()
+        self.state.current_index = (current_index + 1) % len(brokers)
+        self._commit()
         
         return selected_broker
     
-    def get_next_broker_manual(self):
+    def get_next_broker_manual(self, exclude_broker_id=None):
         """Get next broker using manual order"""
         if not self.config.broker_order:
             # Fallback to round robin if no manual order set
-            return self.get_next_broker_round_robin()
+            return self.get_next_broker_round_robin(exclude_broker_id)
         
         broker_ids = self.config.broker_order
-        current_index = self.config.current_index % len(broker_ids)
+        current_index = self.state.current_index % len(broker_ids)
+        available = {broker.id: broker for broker in self.get_available_brokers()}
         
         # Find next available broker in the manual order
         attempts = 0
         while attempts < len(broker_ids):
             broker_id = broker_ids[current_index]
-            broker = User.query.filter_by(
-                id=broker_id,
-                role='broker',
-                is_active=True,
-                can_receive_leads=True
-            ).first()
+            broker = available.get(broker_id)
             
-            if broker:
+            if broker and broker.id != exclude_broker_id:
                 # Update index for next assignment
-                self.config.current_index = (current_index + 1) % len(broker_ids)
-                db.session.commit()
+                self.state.current_index = (current_index + 1) % len(broker_ids)
+                self._commit()
                 return broker
             
             # Try next broker in order
@@ -102,7 +146,17 @@ class LeadDistributor:
         logger.warning("No available brokers in manual order")
         return None
     
-    def assign_lead_to_broker(self, lead, broker):
+    def for_page(self, meta_config_id):
+        """Distributor for leads of another Meta page, sharing this one's batch mode and transaction"""
+        if meta_config_id == self.meta_config_id:
+            return self
+        if meta_config_id not in self._page_distributors:
+            distributor = LeadDistributor(batch_mode=self.batch_mode, meta_config_id=meta_config_id)
+            distributor.load_config()
+            self._page_distributors[meta_config_id] = distributor
+        return self._page_distributors[meta_config_id]
+    
+    def assign_lead_to_broker(self, lead, broker, assignment_order=None):
         """Assign a lead to a specific broker"""
         try:
             lead.assigned_to = broker.id
@@ -111,9 +165,10 @@ class LeadDistributor:
             assignment = LeadAssignment()
             assignment.lead_id = lead.id
             assignment.broker_id = broker.id
+            assignment.assignment_order = assignment_order or 1
             
             db.session.add(assignment)
-            db.session.commit()
+            self._commit()
             
             logger.info(f"Lead {lead.id} assigned to broker {broker.username}")
             
@@ -121,17 +176,102 @@ class LeadDistributor:
             logger.error(f"Error assigning lead to broker: {str(e)}")
             db.session.rollback()
     
+    def next_assignment_orders(self, lead_ids):
+        """Get the next assignment_order for each lead in one grouped query"""
+        rows = db.session.query(
+            LeadAssignment.lead_id,
+            func.max(LeadAssignment.assignment_order),
+            func.count(LeadAssignment.id)
+        ).filter(LeadAssignment.lead_id.in_(lead_ids))\
+         .group_by(LeadAssignment.lead_id).all()
+        
+        orders = {lead_id: 1 for lead_id in lead_ids}
+        for lead_id, max_order, count in rows:
+            orders[lead_id] = max(max_order or 0, count) + 1
+        return orders
+    
+    def bulk_assign(self, rows, reassigned_message=None, received_message=None):
+        """Assign a chunk of leads with set-based statements (batch mode only)
+        
+        rows need id, name and assigned_to, and may carry meta_config_id to rotate
+        within that page's broker pool; the current owner is skipped in the
+        rotation and both brokers are notified. Returns (assigned, skipped).
+        The caller commits.
+        """
+        now = datetime.utcnow()
+        orders = self.next_assignment_orders([row.id for row in rows])
+        # Lock the configs in id order up front so two jobs can't deadlock on them
+        if self.config is None:
+            self.load_config()
+        distributors = {self.for_page(getattr(row, 'meta_config_id', self.meta_config_id)) for row in rows}
+        for distributor in sorted(distributors, key=lambda distributor: distributor.config.id):
+            distributor.state
+        reassigned_message = reassigned_message or 'O lead {name} foi redistribuído'
+        received_message = received_message or 'Você recebeu o lead {name}'
+        
+        lead_updates = []
+        assignments = []
+        notifications = []
+        skipped = 0
+        
+        for row in rows:
+            distributor = self.for_page(getattr(row, 'meta_config_id', self.meta_config_id))
+            broker = distributor.get_next_broker(exclude_broker_id=row.assigned_to)
+            if not broker:
+                skipped += 1
+                continue
+            
+            lead_updates.append({'id': row.id, 'assigned_to': broker.id, 'updated_at': now})
+            assignments.append({
+                'lead_id': row.id,
+                'broker_id': broker.id,
+                'assigned_at': now,
+                'assignment_order': orders[row.id]
+            })
+            if row.assigned_to:
+                notifications.append({
+                    'user_id': row.assigned_to,
+                    'lead_id': row.id,
+                    'type': 'lead_reassigned',
+                    'message': reassigned_message.format(name=row.name),
+                    'is_read': False,
+                    'created_at': now
+                })
+            notifications.append({
+                'user_id': broker.id,
+                'lead_id': row.id,
+                'type': 'lead_received',
+                'message': received_message.format(name=row.name),
+                'is_read': False,
+                'created_at': now
+            })
+        
+        if lead_updates:
+            db.session.execute(update(Lead), lead_updates)
+            db.session.execute(insert(LeadAssignment), assignments)
+            db.session.execute(insert(Notification), notifications)
+        
+        return len(lead_updates), skipped
+    
+    def _commit(self):
+        """Commit unless the caller owns the transaction (batch mode)"""
+        if not self.batch_mode:
+            db.session.commit()
+    
     def update_distribution_config(self, mode, broker_order=None, skip_inactive=True):
         """Update distribution configuration"""
         try:
             self.load_config()
-            self.config.mode = mode
+            config = self.state
+            config.mode = mode
             if broker_order:
-                self.config.broker_order = broker_order
-            self.config.skip_inactive = skip_inactive
-            self.config.current_index = 0  # Reset index when config changes
+                config.broker_order = broker_order
+            config.skip_inactive = skip_inactive
+            config.current_index = 0  # Reset index when config changes
+            config_registry.bump('distribution')
             
             db.session.commit()
+            self.load_config()
             logger.info(f"Distribution config updated: mode={mode}")
             
         except Exception as e:
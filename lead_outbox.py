@@ -0,0 +1,264 @@
+"""Append-only outbox of lead events for downstream systems (BI, CRM).
+
+Database triggers on leads append to lead_events in the same transaction as
+the change, so every path writes its events: Meta/WhatsApp/manual ingest,
+bulk import, LeadDistributor.assign_lead_to_broker and bulk_assign (the
+sweeper), update_lead and the JSON/API updates. Events:
+
+- created:        the new lead's columns
+- assigned:       assigned_to, previous_assigned_to
+- status_changed: status, previous_status
+- follow_up_set:  follow_up_date (null when cleared)
+
+Consumers read from a cursor (the position of the last event they processed)
+with GET /api/v1/events or `flask stream-events`, and store the cursor only
+after handling a batch: delivery is at-least-once, so a crash replays the
+last batch.
+
+Ids are handed out before commit, so on PostgreSQL a transaction that
+commits late would land behind a cursor that already passed its ids. Events
+there carry the writing transaction's id (txid) and are read in (txid, id)
+order, and only from transactions older than every transaction still running
+(the snapshot's xmin). Those have all finished, so nothing can still commit
+behind the cursor; a long transaction holds back later events until it ends.
+The cursor is `<txid>:<id>`. SQLite has one writer at a time, so its ids
+follow commit order: txid is 0 and the cursor is the event id.
+
+Events older than OUTBOX_RETENTION_DAYS are pruned daily.
+"""
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text, delete, func, tuple_
+from models import LeadEvent
+from app import db
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 1000))
+MAX_BATCH_SIZE = 10000
+RETENTION_DAYS = int(os.environ.get('OUTBOX_RETENTION_DAYS', 30))
+
+CREATED_FIELDS = ['name', 'email', 'phone', 'status', 'assigned_to', 'meta_config_id', 'source_channel',
+                  'source_form_id', 'source_campaign_id', 'score', 'follow_up_date', 'created_at']
+DATETIME_FIELDS = {'follow_up_date', 'created_at'}
+
+# (event type, changed column, extra condition, payload as (key, row, column))
+CHANGE_EVENTS = [
+    ('assigned', 'assigned_to', "{new}.assigned_to IS NOT NULL",
+     [('assigned_to', 'new', 'assigned_to'), ('previous_assigned_to', 'old', 'assigned_to')]),
+    ('status_changed', 'status', "1 = 1",
+     [('status', 'new', 'status'), ('previous_status', 'old', 'status')]),
+    ('follow_up_set', 'follow_up_date', "1 = 1",
+     [('follow_up_date', 'new', 'follow_up_date')]),
+]
+
+def _value(row, column, dialect):
+    if column == 'status':
+        # Stored as the enum name; events carry the API value (novo, em_contato, ...)
+        return f"lower(CAST({row}.{column} AS TEXT))"
+    if dialect == 'sqlite' and column in DATETIME_FIELDS:
+        return f"replace({row}.{column}, ' ', 'T')"
+    return f"{row}.{column}"
+
+def _payload(pairs, dialect):
+    build = 'json_build_object' if dialect == 'postgresql' else 'json_object'
+    arguments = ', '.join(f"'{key}', {value}" for key, value in pairs)
+    return f"{build}({arguments})"
+
+def _created_payload(row, dialect):
+    return _payload([(field, _value(row, field, dialect)) for field in CREATED_FIELDS], dialect)
+
+def _change_payload(fields, rows, dialect):
+    return _payload([(key, _value(rows[row], column, dialect)) for key, row, column in fields], dialect)
+
+PG_NOW = "(clock_timestamp() AT TIME ZONE 'UTC')"
+# Epoch-extended id of the writing transaction, comparable with txid_snapshot_xmin()
+PG_TXID = "txid_current()"
+# Microseconds padded to six digits, the format SQLAlchemy reads back
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%S', 'now') || substr(strftime('%f', 'now'), 3) || '000'"
+
+def _pg_ddl():
+    changes = ' UNION ALL '.join(
+        f"SELECT n.id, '{event}' AS type, {_change_payload(fields, {'new': 'n', 'old': 'o'}, 'postgresql')} AS payload "
+        f"FROM new_rows n JOIN old_rows o ON o.id = n.id "
+        f"WHERE n.{column} IS DISTINCT FROM o.{column} AND {condition.format(new='n')}"
+        for event, column, condition, fields in CHANGE_EVENTS
+    )
+    functions = {
+        'insert': ('INSERT', 'REFERENCING NEW TABLE AS new_rows',
+                   f"INSERT INTO lead_events (lead_id, type, payload, created_at, txid) "
+                   f"SELECT n.id, 'created', {_created_payload('n', 'postgresql')}, {PG_NOW}, {PG_TXID} "
+                   f"FROM new_rows n ORDER BY n.id"),
+        'update': ('UPDATE', 'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows',
+                   f"INSERT INTO lead_events (lead_id, type, payload, created_at, txid) "
+                   f"SELECT id, type, payload, {PG_NOW}, {PG_TXID} FROM ({changes}) changes ORDER BY id, type"),
+    }
+    statements = []
+    for name, (operation, referencing, body) in functions.items():
+        function = f"leads_outbox_{name}"
+        statements += [
+            f"""CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    {body};
+                    RETURN NULL;
+                END $$""",
+            f"DROP TRIGGER IF EXISTS {function} ON leads",
+            f"CREATE TRIGGER {function} AFTER {operation} ON leads {referencing} "
+            f"FOR EACH STATEMENT EXECUTE PROCEDURE {function}()",
+        ]
+    return statements
+
+def _sqlite_ddl():
+    statements = [
+        "DROP TRIGGER IF EXISTS leads_outbox_insert",
+        f"""CREATE TRIGGER leads_outbox_insert AFTER INSERT ON leads BEGIN
+            INSERT INTO lead_events (lead_id, type, payload, created_at)
+            VALUES (new.id, 'created', {_created_payload('new', 'sqlite')}, {SQLITE_NOW});
+        END""",
+    ]
+    for event, column, condition, fields in CHANGE_EVENTS:
+        statements += [
+            f"DROP TRIGGER IF EXISTS leads_outbox_{event}",
+            f"""CREATE TRIGGER leads_outbox_{event} AFTER UPDATE OF {column} ON leads
+                WHEN new.{column} IS NOT old.{column} AND {condition.format(new='new')} BEGIN
+                INSERT INTO lead_events (lead_id, type, payload, created_at)
+                VALUES (new.id, '{event}', {_change_payload(fields, {'new': 'new', 'old': 'old'}, 'sqlite')},
+                        {SQLITE_NOW});
+            END""",
+        ]
+    return statements
+
+def init_outbox():
+    """Create the outbox triggers on leads"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statements = _pg_ddl()
+    elif dialect == 'sqlite':
+        statements = _sqlite_ddl()
+    else:
+        logger.warning(f"No outbox triggers for dialect {dialect}; lead events will not be recorded")
+        return
+
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+    logger.info("Lead outbox triggers ready")
+
+def parse_cursor(cursor):
+    """(txid, id) of a cursor: `<txid>:<id>`, or a bare event id for txid 0; raises ValueError"""
+    txid, _, event_id = str(cursor or 0).strip().rpartition(':')
+    try:
+        return int(txid or 0), int(event_id)
+    except ValueError:
+        raise ValueError(f"Cursor inválido: {cursor}")
+
+def format_cursor(event):
+    return f"{event.txid}:{event.id}" if event.txid else str(event.id)
+
+def read_events(after=0, limit=BATCH_SIZE):
+    """Events after the cursor in (txid, id) order, from finished transactions only"""
+    query = db.session.query(LeadEvent.id, LeadEvent.txid, LeadEvent.lead_id, LeadEvent.type,
+                             LeadEvent.payload, LeadEvent.created_at)\
+                      .filter(tuple_(LeadEvent.txid, LeadEvent.id) > tuple_(*parse_cursor(after)))
+    if db.engine.dialect.name == 'postgresql':
+        # Computed in the query's own snapshot: every transaction below it has ended
+        query = query.filter(LeadEvent.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    return query.order_by(LeadEvent.txid, LeadEvent.id).limit(limit).all()
+
+def serialize_event(event):
+    return {
+        'id': event.id,
+        'cursor': format_cursor(event),
+        'lead_id': event.lead_id,
+        'type': event.type,
+        'payload': event.payload,
+        'created_at': event.created_at.isoformat()
+    }
+
+def to_ndjson(events):
+    return ''.join(json.dumps(serialize_event(event), ensure_ascii=False) + '\n' for event in events)
+
+def prune_events(retention_days=RETENTION_DAYS):
+    """Delete events older than the retention window; returns how many"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = db.session.execute(delete(LeadEvent).where(LeadEvent.created_at < cutoff)).rowcount
+    db.session.commit()
+    if deleted:
+        logger.info(f"Pruned {deleted} lead events older than {retention_days} days")
+    return deleted
+
+class FileSink:
+    """Appends NDJSON batches to one file, flushed to disk before the cursor moves"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(to_ndjson(events))
+            f.flush()
+            os.fsync(f.fileno())
+
+class SpoolSink:
+    """Local queue: one NDJSON file per batch, named by its first event's (txid, id)
+
+    Files appear atomically (written under a temporary name, then renamed),
+    so a downstream agent can pick up, process and delete them in name order.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, events):
+        name = f"{events[0].txid:020d}-{events[0].id:012d}.ndjson"
+        temporary = os.path.join(self.directory, f".{name}.tmp")
+        with open(temporary, 'w', encoding='utf-8') as f:
+            f.write(to_ndjson(events))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, os.path.join(self.directory, name))
+
+class StreamSink:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, events):
+        self.stream.write(to_ndjson(events))
+        self.stream.flush()
+
+def read_cursor(path):
+    try:
+        with open(path) as f:
+            cursor = f.read().strip() or '0'
+    except FileNotFoundError:
+        return '0'
+    parse_cursor(cursor)
+    return cursor
+
+def write_cursor(path, cursor):
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as f:
+        f.write(str(cursor))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def drain(sink, cursor, save_cursor, limit=BATCH_SIZE):
+    """Deliver every available event after cursor to sink, batch by batch; returns the new cursor
+
+    save_cursor(cursor) is only called after sink.write() returned.
+    """
+    while True:
+        events = read_events(cursor, limit)
+        # Read-only: end the transaction so no snapshot is held while the sink writes
+        db.session.rollback()
+        if not events:
+            return cursor
+        sink.write(events)
+        cursor = format_cursor(events[-1])
+        save_cursor(cursor)
+        if len(events) < limit:
+            return cursor
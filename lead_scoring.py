@@ -0,0 +1,411 @@
+"""Lead scoring.
+
+Every lead gets a score from 0 to 100, an estimate of how likely it is to
+convert, built only from what is known when it arrives: its segment (channel
+and Meta form), whether it left a message, an e-mail and a phone, and the
+hour of the day it came in. The score is a naive Bayes log-odds: the conversion
+rate of the lead's segment (smoothed towards its channel, the channel towards
+all leads) plus, per feature, how much better or worse than average closed
+leads with that value converted. The rates come from one grouped query over
+closed leads, archive included, and are kept in lead_score_weights.
+
+Leads are scored in batches as arrays (numpy when the optional `scoring`
+extra is installed, plain Python otherwise) and only scores that changed are
+written. numpy is imported by the first batch large enough to use it, so
+web workers scoring single leads never load it. New leads are scored on insert with the
+stored weights, once create_app() has called register_scoring(). The rescore
+job recomputes the weights and revisits only the open leads whose weights
+moved: a lead closing shifts its segment's rate, so that segment's open leads
+are rescored, while a change of the other features rescores every open lead.
+
+Brokers' lead lists and the distributor order work by score.
+
+Benchmark:  python lead_scoring.py
+"""
+import os
+import math
+import time
+import logging
+from datetime import datetime
+from sqlalchemy import event, select, func, case, update, delete, insert, or_, tuple_
+from models import Lead, LeadStatus, ArchivedLead, LeadScoreWeight, IntegrationLog
+from sql_functions import hour_of
+from app import db
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('LEAD_SCORE_BATCH_SIZE', 10000))
+# Closed leads a rate is pulled towards its parent rate with (segment -> channel -> all)
+PRIOR_WEIGHT = float(os.environ.get('LEAD_SCORE_PRIOR_WEIGHT', 20))
+# Weight changes below this (in log-odds) don't trigger a rescore
+TOLERANCE = 0.02
+# Process-local copy of the stored weights used to score leads on insert
+WEIGHTS_TTL_SECONDS = 300
+# Smaller batches are scored per row: not worth importing numpy for
+VECTOR_MIN_ROWS = 64
+
+OPEN_STATUSES = [LeadStatus.NOVO, LeadStatus.EM_CONTATO]
+CLOSED_STATUSES = [LeadStatus.CONVERTIDO, LeadStatus.PERDIDO]
+FLAGS = ('message', 'email', 'phone')
+
+def _present(column):
+    return case((func.coalesce(column, '') != '', 1), else_=0)
+
+def feature_columns(table):
+    """Feature expressions of a leads-shaped table, in the order score_columns() takes them"""
+    return [
+        func.coalesce(table.c.source_channel, 'manual'),
+        func.coalesce(table.c.source_form_id, ''),
+        _present(table.c.message),
+        _present(table.c.email),
+        _present(table.c.phone),
+        func.coalesce(hour_of(table.c.created_at), 0),
+    ]
+
+def _logit(rate):
+    return math.log(rate / (1 - rate))
+
+def _smoothed(converted, closed, prior):
+    return (converted + PRIOR_WEIGHT * prior) / (closed + PRIOR_WEIGHT)
+
+class Weights:
+    """Log-odds contributions of every feature value"""
+
+    def __init__(self, base=0.0, channels=None, segments=None, flags=None, hours=None):
+        self.base = base
+        self.channels = channels or {}
+        self.segments = segments or {}
+        self.flags = flags or {flag: [0.0, 0.0] for flag in FLAGS}
+        self.hours = hours or [0.0] * 24
+
+    @classmethod
+    def fit(cls, groups):
+        """Weights from [(channel, form, message, email, phone, hour, converted, closed)]"""
+        converted = sum(group[6] for group in groups)
+        closed = sum(group[7] for group in groups)
+        overall = (converted + 1) / (closed + 2)
+        base = _logit(overall)
+
+        def tally(key_of):
+            totals = {}
+            for group in groups:
+                counts = totals.setdefault(key_of(group), [0, 0])
+                counts[0] += group[6]
+                counts[1] += group[7]
+            return totals
+
+        channel_rates = {channel: _smoothed(c, n, overall)
+                         for channel, (c, n) in tally(lambda group: group[0]).items()}
+        segment_rates = {(channel, form): _smoothed(c, n, channel_rates[channel])
+                         for (channel, form), (c, n) in tally(lambda group: group[:2]).items()}
+
+        def contributions(position, size):
+            values = [0.0] * size
+            for value, (c, n) in tally(lambda group: group[position]).items():
+                values[int(value)] = _logit(_smoothed(c, n, overall)) - base
+            return values
+
+        return cls(
+            base=base,
+            channels={channel: _logit(rate) for channel, rate in channel_rates.items()},
+            segments={segment: _logit(rate) for segment, rate in segment_rates.items()},
+            flags={flag: contributions(2 + i, 2) for i, flag in enumerate(FLAGS)},
+            hours=contributions(5, 24)
+        )
+
+    def rows(self):
+        """(feature, value, weight) rows for lead_score_weights"""
+        yield 'base', '', self.base
+        for channel, weight in self.channels.items():
+            yield 'channel', channel, weight
+        for (channel, form), weight in self.segments.items():
+            yield 'segment', f'{channel}|{form}', weight
+        for flag in FLAGS:
+            for value, weight in enumerate(self.flags[flag]):
+                yield flag, str(value), weight
+        for hour, weight in enumerate(self.hours):
+            yield 'hour', str(hour), weight
+
+    @classmethod
+    def from_rows(cls, rows):
+        weights = cls()
+        for feature, value, weight in rows:
+            if feature == 'base':
+                weights.base = weight
+            elif feature == 'channel':
+                weights.channels[value] = weight
+            elif feature == 'segment':
+                channel, _, form = value.partition('|')
+                weights.segments[(channel, form)] = weight
+            elif feature == 'hour':
+                weights.hours[int(value)] = weight
+            else:
+                weights.flags[feature][int(value)] = weight
+        return weights
+
+    def segment_weight(self, channel, form):
+        """Unseen forms fall back to their channel, unseen channels to all leads"""
+        weight = self.segments.get((channel, form))
+        if weight is None:
+            weight = self.channels.get(channel, self.base)
+        return weight
+
+    def changes(self, other):
+        """(global_changed, channels, segments) whose weight differs from other's"""
+        def differs(a, b):
+            return abs(a - b) > TOLERANCE
+
+        global_changed = differs(self.base, other.base) or any(
+            differs(a, b)
+            for flag in FLAGS for a, b in zip(self.flags[flag], other.flags[flag])
+        ) or any(differs(a, b) for a, b in zip(self.hours, other.hours))
+        channels = {channel for channel in self.channels.keys() | other.channels.keys()
+                    if differs(self.channels.get(channel, self.base), other.channels.get(channel, other.base))}
+        segments = {segment for segment in self.segments.keys() | other.segments.keys()
+                    if differs(self.segment_weight(*segment), other.segment_weight(*segment))}
+        return global_changed, channels, segments
+
+_numpy = {}
+
+def load_numpy():
+    """The numpy module, imported on first use; None without the `scoring` extra"""
+    if 'module' not in _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy['module'] = numpy
+    return _numpy['module']
+
+def score_columns(weights, channels, forms, messages, emails, phones, hours):
+    """Scores (0-100) of leads given column-wise, one array operation per feature"""
+    numpy = load_numpy() if len(channels) >= VECTOR_MIN_ROWS else None
+    if numpy is None:
+        return [
+            round(100 / (1 + math.exp(-(weights.segment_weight(channel, form)
+                                        + weights.flags['message'][message]
+                                        + weights.flags['email'][email]
+                                        + weights.flags['phone'][phone]
+                                        + weights.hours[int(hour) % 24]))))
+            for channel, form, message, email, phone, hour
+            in zip(channels, forms, messages, emails, phones, hours)
+        ]
+
+    segments, codes = segment_codes(numpy, channels, forms)
+    segment_weights = numpy.array([weights.segment_weight(*segment) for segment in segments])
+
+    logits = segment_weights[codes]
+    for flag, values in zip(FLAGS, (messages, emails, phones)):
+        logits += numpy.asarray(weights.flags[flag])[numpy.asarray(values, dtype=numpy.intp)]
+    logits += numpy.asarray(weights.hours)[numpy.asarray(hours, dtype=numpy.intp) % 24]
+    return numpy.rint(100 / (1 + numpy.exp(-logits))).astype(int).tolist()
+
+def segment_codes(numpy, channels, forms):
+    """Distinct (channel, form) segments and each lead's index into them
+
+    Channels and forms are numbered separately by numpy.unique, then their
+    pairs, so segment weights are looked up once per segment, not per lead.
+    """
+    channel_values, channel_codes = numpy.unique(numpy.asarray(channels), return_inverse=True)
+    form_values, form_codes = numpy.unique(numpy.asarray(forms), return_inverse=True)
+    pairs, codes = numpy.unique(channel_codes * len(form_values) + form_codes, return_inverse=True)
+    segments = [(channel_values[pair // len(form_values)], form_values[pair % len(form_values)])
+                for pair in pairs.tolist()]
+    return segments, codes
+
+def fit_weights():
+    """Weights from every closed lead, hot and archived, in one grouped query per table"""
+    groups = {}
+    for table in (Lead.__table__, ArchivedLead.__table__):
+        features = feature_columns(table)
+        rows = db.session.execute(
+            select(*features,
+                   func.sum(case((table.c.status == LeadStatus.CONVERTIDO, 1), else_=0)),
+                   func.count())
+            .where(table.c.status.in_(CLOSED_STATUSES))
+            .group_by(*features)
+        )
+        for *key, converted, closed in rows:
+            key = tuple(key[:5]) + (int(key[5]),)
+            counts = groups.setdefault(key, [0, 0])
+            counts[0] += converted or 0
+            counts[1] += closed
+    return Weights.fit([key + tuple(counts) for key, counts in groups.items()])
+
+def stored_weights():
+    """Weights of the last rescore, or None before the first one"""
+    rows = db.session.query(LeadScoreWeight.feature, LeadScoreWeight.value, LeadScoreWeight.weight).all()
+    return Weights.from_rows(rows) if rows else None
+
+def rescore_leads(full=False):
+    """Refit the weights and rescore the open leads they affect, one batch per transaction
+
+    Leads without a score (stored before scoring existed or inserted in bulk
+    elsewhere) are always scored. Returns run metrics.
+    """
+    started = time.monotonic()
+    stats = {'scanned': 0, 'rescored': 0}
+
+    try:
+        previous = stored_weights()
+        weights = fit_weights()
+        full = full or previous is None
+        global_changed, channels, segments = weights.changes(previous) if not full else (True, (), ())
+        full = full or global_changed
+
+        channel, form = feature_columns(Lead.__table__)[:2]
+        scope = [Lead.score.is_(None)]
+        if full:
+            scope = []
+        else:
+            if channels:
+                scope.append(channel.in_(channels))
+            if segments:
+                scope.append(tuple_(channel, form).in_(list(segments)))
+        stats['scope'] = 'all' if full else {'channels': len(channels), 'segments': len(segments)}
+
+        query = select(Lead.id, Lead.score, Lead.updated_at, *feature_columns(Lead.__table__))\
+            .where(Lead.status.in_(OPEN_STATUSES))
+        if scope:
+            query = query.where(or_(*scope))
+
+        last_id = 0
+        while True:
+            rows = db.session.execute(query.where(Lead.id > last_id)
+                                           .order_by(Lead.id).limit(BATCH_SIZE)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            stats['scanned'] += len(rows)
+            stats['rescored'] += _write_scores(weights, rows)
+            db.session.commit()
+
+        db.session.execute(delete(LeadScoreWeight))
+        db.session.execute(insert(LeadScoreWeight), [
+            {'feature': feature, 'value': value, 'weight': weight}
+            for feature, value, weight in weights.rows()
+        ])
+        db.session.commit()
+        _cache.update(weights=weights, loaded_at=time.monotonic())
+
+    except Exception as e:
+        logger.error(f"Error rescoring leads: {str(e)}")
+        db.session.rollback()
+        stats['error'] = str(e)
+
+    stats['duration_seconds'] = round(time.monotonic() - started, 3)
+    if stats['rescored'] or 'error' in stats:
+        db.session.add(IntegrationLog(
+            action='lead_scoring',
+            status='error' if 'error' in stats else 'success',
+            message=f"{stats['rescored']} leads com pontuação atualizada",
+            details=stats
+        ))
+        db.session.commit()
+
+    logger.info(f"Lead scoring finished: {stats}")
+    return stats
+
+def _write_scores(weights, rows):
+    ids, scores, updated_ats, *features = zip(*rows)
+    new_scores = score_columns(weights, *features)
+    changed = [{'id': lead_id, 'score': new, 'updated_at': updated_at}  # Not a change for sync or the sweeper
+               for lead_id, old, new, updated_at in zip(ids, scores, new_scores, updated_ats)
+               if old != new]
+    if changed:
+        db.session.execute(update(Lead), changed)
+    return len(changed)
+
+def score_rows(rows):
+    """Set 'score' on column dicts for insert(Lead), in one vectorized pass"""
+    if not rows:
+        return rows
+    weights = current_weights()
+    hours = [(row.get('created_at') or datetime.utcnow()).hour for row in rows]
+    scores = score_columns(
+        weights,
+        [row.get('source_channel') or 'manual' for row in rows],
+        [row.get('source_form_id') or '' for row in rows],
+        *[[int(bool(row.get(flag))) for row in rows] for flag in FLAGS],
+        hours
+    )
+    for row, score in zip(rows, scores):
+        row['score'] = score
+    return rows
+
+_cache = {'weights': None, 'loaded_at': 0.0}
+
+def current_weights(connection=None):
+    """Stored weights, reloaded at most every WEIGHTS_TTL_SECONDS per process"""
+    if _cache['weights'] is None or time.monotonic() - _cache['loaded_at'] > WEIGHTS_TTL_SECONDS:
+        query = select(LeadScoreWeight.feature, LeadScoreWeight.value, LeadScoreWeight.weight)
+        rows = (connection or db.session).execute(query).all()
+        _cache.update(weights=Weights.from_rows(rows), loaded_at=time.monotonic())
+    return _cache['weights']
+
+def register_scoring():
+    """Score every Lead inserted through the ORM (called by create_app)"""
+    if not event.contains(Lead, 'before_insert', _score_new_lead):
+        event.listen(Lead, 'before_insert', _score_new_lead)
+
+def _score_new_lead(mapper, connection, lead):
+    if lead.score is None:
+        row = {column: getattr(lead, column) for column in
+               ('source_channel', 'source_form_id', 'message', 'email', 'phone', 'created_at')}
+        lead.score = score_columns(
+            current_weights(connection),
+            [row['source_channel'] or 'manual'], [row['source_form_id'] or ''],
+            *[[int(bool(row[flag]))] for flag in FLAGS],
+            [(row['created_at'] or datetime.utcnow()).hour]
+        )[0]
+
+if __name__ == '__main__':
+    # Fits weights on a synthetic history and scores BENCH_ROWS leads held in
+    # memory, array path against the per-row path. No database needed.
+    import random
+
+    ROWS = int(os.environ.get('BENCH_ROWS', 1000000))
+    rng = random.Random(42)
+    channels = ['meta', 'whatsapp', 'import', 'manual']
+    forms = [f'form{n}' for n in range(200)]
+
+    groups = [(channel, rng.choice(forms) if channel == 'meta' else '', message, email, phone, hour,
+               rng.randint(0, 30), rng.randint(30, 200))
+              for channel in channels for message in (0, 1) for email in (0, 1) for phone in (0, 1)
+              for hour in range(24)]
+    weights = Weights.fit(groups)
+
+    columns = [[] for _ in range(6)]
+    for _ in range(ROWS):
+        channel = rng.choice(channels)
+        for column, value in zip(columns, (channel, rng.choice(forms) if channel == 'meta' else '',
+                                           rng.randint(0, 1), rng.randint(0, 1), rng.randint(0, 1),
+                                           rng.randrange(24))):
+            column.append(value)
+
+    def timed(label):
+        started = time.perf_counter()
+        scores = score_columns(weights, *columns)
+        elapsed = time.perf_counter() - started
+        print(f"{label:<10} {ROWS} leads in {elapsed:6.2f}s ({ROWS / elapsed:,.0f} leads/s)")
+        return scores
+
+    numpy = load_numpy()
+    if numpy is not None:
+        # Segment numbering alone: numpy.unique against a per-lead dict lookup
+        started = time.perf_counter()
+        segments, codes = segment_codes(numpy, columns[0], columns[1])
+        print(f"{'unique':<10} {len(segments)} segments in {time.perf_counter() - started:6.2f}s")
+        started = time.perf_counter()
+        numbers = {}
+        dict_codes = numpy.fromiter((numbers.setdefault(segment, len(numbers))
+                                     for segment in zip(columns[0], columns[1])),
+                                    dtype=numpy.intp, count=ROWS)
+        print(f"{'dict':<10} {len(numbers)} segments in {time.perf_counter() - started:6.2f}s")
+        print(f"same segments per lead: {[segments[code] for code in codes.tolist()] == list(zip(columns[0], columns[1]))}")
+
+    vectorized = timed('numpy') if numpy is not None else None
+    _numpy['module'] = None
+    per_row = timed('per row')
+    if vectorized is not None:
+        print(f"results identical: {vectorized == per_row}")
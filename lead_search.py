@@ -0,0 +1,247 @@
+import re
+import logging
+from sqlalchemy import text, or_
+from sqlalchemy.orm import joinedload
+from models import Lead
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Generates the stored leads.search_document column. ADD COLUMN IF NOT EXISTS
+# won't redefine an existing column: changing it needs the column dropped first
+PG_SEARCH_DOCUMENT = (
+    "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(email, '') || ' ' || "
+    "coalesce(phone, '') || ' ' || coalesce(message, '') || ' ' || coalesce(notes, ''))"
+)
+
+PG_INDEX_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # Computed once per write, so queries and ts_rank read the tsvector instead of
+    # re-parsing five text columns of every candidate row (the column is not mapped
+    # on Lead: it only exists on PostgreSQL)
+    f"ALTER TABLE leads ADD COLUMN IF NOT EXISTS search_document tsvector "
+    f"GENERATED ALWAYS AS ({PG_SEARCH_DOCUMENT}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_leads_search_document ON leads USING GIN (search_document)",
+    "DROP INDEX IF EXISTS ix_leads_search",  # The expression index it replaces
+    "CREATE INDEX IF NOT EXISTS ix_leads_phone_trgm ON leads USING GIN (phone gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_leads_email_trgm ON leads USING GIN (email gin_trgm_ops)",
+]
+
+SQLITE_FTS_COLUMNS = "name, email, phone, message, notes"
+
+SQLITE_INDEX_DDL = [
+    f"CREATE VIRTUAL TABLE leads_fts USING fts5({SQLITE_FTS_COLUMNS}, "
+    "content='leads', content_rowid='id')",
+    f"""CREATE TRIGGER IF NOT EXISTS leads_fts_insert AFTER INSERT ON leads BEGIN
+        INSERT INTO leads_fts(rowid, {SQLITE_FTS_COLUMNS})
+        VALUES (new.id, new.name, new.email, new.phone, new.message, new.notes);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS leads_fts_delete AFTER DELETE ON leads BEGIN
+        INSERT INTO leads_fts(leads_fts, rowid, {SQLITE_FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.email, old.phone, old.message, old.notes);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS leads_fts_update AFTER UPDATE ON leads BEGIN
+        INSERT INTO leads_fts(leads_fts, rowid, {SQLITE_FTS_COLUMNS})
+        VALUES ('delete', old.id, old.name, old.email, old.phone, old.message, old.notes);
+        INSERT INTO leads_fts(rowid, {SQLITE_FTS_COLUMNS})
+        VALUES (new.id, new.name, new.email, new.phone, new.message, new.notes);
+    END""",
+    "INSERT INTO leads_fts(leads_fts) VALUES ('rebuild')",
+]
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def init_search_index():
+    """Create the dialect-specific search index
+
+    The index is maintained by the database itself (generated column on
+    PostgreSQL, triggers on SQLite), so every ingest path and update_lead
+    keep it current without application code.
+
+    Adding the generated column rewrites the leads table once, under an
+    exclusive lock; it runs from `flask init-db` at deploy time.
+    """
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        for statement in PG_INDEX_DDL:
+            db.session.execute(text(statement))
+        db.session.commit()
+        logger.info("PostgreSQL lead search index ready")
+
+    elif dialect == 'sqlite':
+        exists = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads_fts'"
+        )).first()
+        if not exists:
+            for statement in SQLITE_INDEX_DDL:
+                db.session.execute(text(statement))
+            db.session.commit()
+            logger.info("SQLite FTS5 lead search index created")
+
+    else:
+        logger.warning(f"No search index for dialect {dialect}; falling back to LIKE scans")
+
+def tokenize(query):
+    return TOKEN_PATTERN.findall(query or '')[:10]
+
+def search_leads(query, page=1, per_page=25, broker_id=None):
+    """Ranked, paginated lead search
+
+    Returns (leads, has_more); leads are ordered by relevance.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return [], False
+
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        ids = _search_postgresql(query, tokens, per_page + 1, offset, broker_id)
+    elif dialect == 'sqlite':
+        ids = _search_sqlite(tokens, per_page + 1, offset, broker_id)
+    else:
+        ids = _search_like(query, per_page + 1, offset, broker_id)
+
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+
+    leads = Lead.query.options(joinedload(Lead.assigned_broker))\
+                      .filter(Lead.id.in_(ids)).all()
+    leads_by_id = {lead.id: lead for lead in leads}
+    return [leads_by_id[lead_id] for lead_id in ids if lead_id in leads_by_id], has_more
+
+def _search_postgresql(query, tokens, limit, offset, broker_id):
+    # Prefix match on every token, e.g. "mari silv" -> 'mari:* & silv:*'
+    ts_query = ' & '.join(f"{token}:*" for token in tokens)
+    fragment = query.strip()
+
+    broker_filter = "AND assigned_to = :broker_id" if broker_id else ""
+
+    # Trigram indexes serve substring matches on phone/email fragments
+    # (e.g. "98765" or "@gmail") that the word-based tsvector misses
+    sql = text(f"""
+        SELECT id FROM (
+            SELECT id, ts_rank(search_document, q) AS rank
+            FROM leads, to_tsquery('simple', :ts_query) q
+            WHERE search_document @@ q {broker_filter}
+            UNION
+            SELECT id, 0.05 AS rank
+            FROM leads
+            WHERE length(:fragment) >= 3
+              AND (phone LIKE :like OR email ILIKE :like) {broker_filter}
+        ) matches
+        GROUP BY id
+        ORDER BY max(rank) DESC, id DESC
+        LIMIT :limit OFFSET :offset
+    """)
+
+    params = {
+        'ts_query': ts_query,
+        'fragment': fragment,
+        'like': f"%{_escape_like(fragment)}%",
+        'limit': limit,
+        'offset': offset,
+    }
+    if broker_id:
+        params['broker_id'] = broker_id
+
+    return [row.id for row in db.session.execute(sql, params)]
+
+def _search_sqlite(tokens, limit, offset, broker_id):
+    match = ' '.join(f'"{token}"*' for token in tokens)
+    broker_filter = "AND leads.assigned_to = :broker_id" if broker_id else ""
+
+    sql = text(f"""
+        SELECT leads_fts.rowid AS id
+        FROM leads_fts JOIN leads ON leads.id = leads_fts.rowid
+        WHERE leads_fts MATCH :match {broker_filter}
+        ORDER BY bm25(leads_fts), leads_fts.rowid DESC
+        LIMIT :limit OFFSET :offset
+    """)
+
+    params = {'match': match, 'limit': limit, 'offset': offset}
+    if broker_id:
+        params['broker_id'] = broker_id
+
+    return [row.id for row in db.session.execute(sql, params)]
+
+def _search_like(query, limit, offset, broker_id):
+    like = f"%{_escape_like(query.strip())}%"
+    q = db.session.query(Lead.id).filter(or_(
+        Lead.name.ilike(like, escape='\\'), Lead.email.ilike(like, escape='\\'),
+        Lead.phone.ilike(like, escape='\\'), Lead.message.ilike(like, escape='\\'),
+        Lead.notes.ilike(like, escape='\\')
+    ))
+    if broker_id:
+        q = q.filter(Lead.assigned_to == broker_id)
+    return [row.id for row in q.order_by(Lead.id.desc()).limit(limit).offset(offset)]
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+if __name__ == '__main__':
+    # Ranked search against the ILIKE scan it replaced, over BENCH_ROWS seeded
+    # leads (removed afterwards); point DATABASE_URL at a scratch database.
+    import os
+    import time
+    import random
+    import statistics
+    from datetime import datetime
+    from sqlalchemy import insert, delete
+    from app import app, create_app, init_db
+    from models import LeadStatus
+
+    ROWS = int(os.environ.get('BENCH_ROWS', 100000))
+    RUNS = int(os.environ.get('BENCH_RUNS', 20))
+    WORDS = ['apartamento', 'casa', 'cobertura', 'terreno', 'financiamento', 'visita', 'quartos',
+             'garagem', 'piscina', 'centro', 'praia', 'investimento', 'aluguel', 'permuta']
+    NAMES = ['Maria', 'João', 'Ana', 'Pedro', 'Carla', 'Lucas', 'Juliana', 'Marcos']
+    SURNAMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Pereira', 'Costa', 'Rodrigues', 'Almeida']
+    SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'la', 'me', 'ni', 'po', 'ru', 'sa', 'te', 'vo', 'xi', 'zu']
+    QUERIES = ['maria silva', 'piscina', 'cobertura praia', 'juli', 'financiamento garagem centro',
+               'inexistente']
+
+    create_app()
+    rng = random.Random(1)
+    # Filler vocabulary, so each real word appears in a realistic share of the leads
+    vocabulary = [''.join(rng.choices(SYLLABLES, k=4)) for _ in range(3000)] + WORDS
+    with app.app_context():
+        init_db()
+        now = datetime.utcnow()
+        for start in range(0, ROWS, 10000):
+            db.session.execute(insert(Lead), [{
+                'name': f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}', 'email': f'bench{n}@example.com',
+                'phone': f'5511{n:09d}', 'message': ' '.join(rng.choices(vocabulary, k=12)),
+                'notes': ' '.join(rng.choices(vocabulary, k=6)), 'status': LeadStatus.NOVO,
+                'source_channel': 'bench-search', 'created_at': now, 'updated_at': now
+            } for n in range(start, min(start + 10000, ROWS))])
+            db.session.commit()
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            db.session.execute(text('ANALYZE leads'))
+            db.session.commit()
+
+    def timed(search):
+        timings = []
+        with app.app_context():
+            for _ in range(RUNS):
+                started = time.perf_counter()
+                search()
+                timings.append(time.perf_counter() - started)
+        return statistics.median(timings) * 1000
+
+    try:
+        print(f"{dialect}, {ROWS} leads, median of {RUNS} runs, first page of 25")
+        for query in QUERIES:
+            indexed = timed(lambda: search_leads(query))
+            scan = timed(lambda: _search_like(query, 26, 0, None))
+            print(f"  {query!r:<32} ranked index {indexed:8.2f} ms   ILIKE scan {scan:8.2f} ms")
+    finally:
+        with app.app_context():
+            db.session.execute(delete(Lead).where(Lead.source_channel == 'bench-search'))
+            db.session.commit()
@@ -0,0 +1,115 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import or_, and_
+from models import Lead, LeadStatus, IntegrationLog
+from lead_distributor import LeadDistributor
+from app import db
+
+logger = logging.getLogger(__name__)
+
+class LeadSweeper:
+    """Reassigns leads that stayed in NOVO with the same broker for too long
+
+    Runs every 15 minutes in the scheduler process (scheduler.JOBS) and on
+    demand with `flask --app main sweep-leads`.
+    """
+
+    def __init__(self, stale_after=None, batch_size=None, max_leads=None, max_seconds=None):
+        self.stale_after = stale_after or timedelta(
+            hours=int(os.environ.get('LEAD_SWEEP_STALE_HOURS', 48)))
+        self.batch_size = batch_size or int(os.environ.get('LEAD_SWEEP_BATCH_SIZE', 500))
+        self.max_leads = max_leads or int(os.environ.get('LEAD_SWEEP_MAX_LEADS', 100000))
+        self.max_seconds = max_seconds or int(os.environ.get('LEAD_SWEEP_MAX_SECONDS', 600))
+
+    def sweep(self):
+        """Sweep stale leads in keyset-paginated batches and return run metrics"""
+        started = time.monotonic()
+        cutoff = datetime.utcnow() - self.stale_after
+        stats = {'scanned': 0, 'swept': 0, 'skipped': 0, 'batches': 0}
+
+        distributor = LeadDistributor(batch_mode=True)
+        distributor.load_config()
+
+        last_key = None
+        try:
+            while stats['scanned'] < self.max_leads:
+                if time.monotonic() - started > self.max_seconds:
+                    logger.warning("Lead sweep stopped early: time budget exhausted")
+                    break
+
+                limit = min(self.batch_size, self.max_leads - stats['scanned'])
+                rows = self.fetch_stale_batch(cutoff, last_key, limit)
+                if not rows:
+                    break
+
+                last_key = (rows[-1].updated_at, rows[-1].id)
+                self.reassign_batch(distributor, rows, stats)
+
+                # One commit per batch keeps locks short and the session small
+                db.session.commit()
+                stats['batches'] += 1
+                stats['scanned'] += len(rows)
+
+        except Exception as e:
+            logger.error(f"Error sweeping stale leads: {str(e)}")
+            db.session.rollback()
+            stats['error'] = str(e)
+
+        stats['duration_seconds'] = round(time.monotonic() - started, 3)
+
+        if stats['scanned'] or 'error' in stats:
+            self.log_sweep(stats)
+
+        logger.info(f"Lead sweep finished: {stats}")
+        return stats
+
+    def fetch_stale_batch(self, cutoff, last_key, limit):
+        """Fetch the next batch of stale leads using the (status, updated_at, id) index"""
+        query = db.session.query(
+            Lead.id, Lead.name, Lead.assigned_to, Lead.meta_config_id, Lead.score, Lead.updated_at
+        ).filter(
+            Lead.status == LeadStatus.NOVO,
+            Lead.updated_at < cutoff,
+            Lead.assigned_to.isnot(None)
+        )
+
+        if last_key:
+            last_updated_at, last_id = last_key
+            query = query.filter(or_(
+                Lead.updated_at > last_updated_at,
+                and_(Lead.updated_at == last_updated_at, Lead.id > last_id)
+            ))
+
+        return query.order_by(Lead.updated_at, Lead.id).limit(limit).all()
+
+    def reassign_batch(self, distributor, rows, stats):
+        """Hand a batch of stale leads to the next brokers in the rotation, best scores first"""
+        swept, skipped = distributor.bulk_assign(
+            sorted(rows, key=lambda row: row.score or 0, reverse=True),
+            reassigned_message='O lead {name} foi redistribuído por falta de atendimento',
+            received_message='Você recebeu o lead {name} (redistribuído)'
+        )
+        stats['swept'] += swept
+        stats['skipped'] += skipped
+
+    def log_sweep(self, stats):
+        """Record sweep metrics in the integration log"""
+        try:
+            log = IntegrationLog(
+                action='lead_sweep',
+                status='error' if 'error' in stats else 'success',
+                message=f"Redistribuídos {stats['swept']} leads parados "
+                        f"({stats['skipped']} sem corretor disponível)",
+                details=stats
+            )
+            db.session.add(log)
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Error logging lead sweep: {str(e)}")
+            db.session.rollback()
+
+# Create instance when needed
+def get_lead_sweeper():
+    return LeadSweeper()
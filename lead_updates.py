@@ -0,0 +1,121 @@
+from datetime import datetime
+from sqlalchemy import update
+from models import Lead, LeadStatus
+from follow_up_reminders import schedule_reminder
+from app import db
+
+# Fields a broker may change on their own leads
+EDITABLE_FIELDS = ('status', 'notes', 'follow_up_date')
+
+def parse_lead_changes(data):
+    """Column values for the editable fields present in a JSON body; raises ValueError"""
+    values = {}
+    try:
+        if 'status' in data:
+            values['status'] = LeadStatus(data['status'])
+        if 'notes' in data:
+            values['notes'] = data['notes'] or ''
+        if 'follow_up_date' in data:
+            values['follow_up_date'] = datetime.fromisoformat(data['follow_up_date']) \
+                if data['follow_up_date'] else None
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Valor inválido: {str(e)}')
+    return values
+
+def apply_lead_changes(lead_ids, broker_id, values, now=None):
+    """Write the same values to the broker's leads with one UPDATE ... RETURNING
+
+    Returns the ids actually updated (leads of other brokers are left out).
+    Runs in the caller's transaction. Besides the UPDATE, a status or
+    follow-up change costs per lead a DELETE of its reminder (closed or no
+    follow-up) or a SELECT plus INSERT/UPDATE of it (future follow-up);
+    notes alone cost nothing more.
+    """
+    values = dict(values, updated_at=now or datetime.utcnow())
+    rows = db.session.execute(
+        update(Lead).where(Lead.id.in_(lead_ids), Lead.assigned_to == broker_id)
+                    .values(**values)
+                    .returning(Lead.id, Lead.status, Lead.follow_up_date),
+        execution_options={'synchronize_session': False}
+    ).all()
+
+    if 'status' in values or 'follow_up_date' in values:
+        for row in rows:
+            schedule_reminder(row)
+    return [row.id for row in rows]
+
+def serialize_value(value):
+    if isinstance(value, LeadStatus):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def serialize_changes(values):
+    return {field: serialize_value(value) for field, value in values.items()}
+
+if __name__ == '__main__':
+    # Saving a lead from its page: the form POST, redirect and re-rendered page
+    # against PATCH /api/leads/<id>, with latency, bytes returned and SQL
+    # statements per save:
+    #   DATABASE_URL=... python lead_updates.py
+    import os
+    import statistics
+    import time
+    from sqlalchemy import event
+    from app import create_app
+    from models import User, UserRole
+
+    SAVES = int(os.environ.get('BENCH_SAVES', 200))
+    app = create_app()
+
+    with app.app_context():
+        broker = User(username=f'bench_{int(time.time())}', email=f'bench_{int(time.time())}@example.com',
+                      role=UserRole.BROKER, is_active=True)
+        broker.set_password('bench')
+        db.session.add(broker)
+        db.session.flush()
+        lead = Lead(name='Lead benchmark', phone='11999990000', assigned_to=broker.id, status=LeadStatus.NOVO)
+        db.session.add(lead)
+        db.session.commit()
+        broker_id, lead_id = broker.id, lead.id
+        engine = db.engine
+
+    statements = [0]
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.__setitem__(0, statements[0] + 1))
+    client = app.test_client()
+    with client.session_transaction() as user_session:
+        user_session['user_id'] = broker_id
+
+    def form_save(n):
+        response = client.post(f'/broker/leads/{lead_id}/update', follow_redirects=True, data={
+            'status': ('novo', 'em_contato')[n % 2], 'notes': f'nota {n}', 'follow_up_date': ''})
+        return response, sum(len(r.get_data()) for r in response.history) + len(response.get_data())
+
+    def patch_save(fields):
+        def save(n):
+            response = client.patch(f'/api/leads/{lead_id}', json={
+                'status': ('novo', 'em_contato')[n % 2], 'notes': f'nota {n}'}
+                if fields == 'status' else {'notes': f'nota {n}'})
+            return response, len(response.get_data())
+        return save
+
+    print(f"{'save':<28} {'p50 ms':>8} {'p95 ms':>8} {'bytes':>8} {'statements':>10}")
+    for label, save in (('form + redirect + render', form_save),
+                        ('PATCH status and notes', patch_save('status')),
+                        ('PATCH notes only', patch_save('notes'))):
+        timings = []
+        statements[0] = 0
+        for n in range(SAVES):
+            started = time.perf_counter()
+            response, size = save(n)
+            timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.status_code
+        timings.sort()
+        print(f"{label:<28} {statistics.median(timings):>8.2f} {timings[int(len(timings) * 0.95)]:>8.2f} "
+              f"{size:>8} {statements[0] / SAVES:>10.1f}")
+
+    with app.app_context():
+        db.session.delete(db.session.get(Lead, lead_id))
+        db.session.delete(db.session.get(User, broker_id))
+        db.session.commit()
@@ -1,9 +1,12 @@
 import os
-from app import app
-import routes  # noqa: F401
-import scheduler
+from app import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
+    # Imported here so web workers don't pay for APScheduler at boot
+    import scheduler
+    
     # Start the background scheduler for Meta API sync
     scheduler.start_scheduler()
     
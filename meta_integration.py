@@ -1,20 +1,32 @@
+import json
+import calendar
 import requests
 import logging
-from datetime import datetime
-from models import MetaConfig, Lead, IntegrationLog
+from datetime import datetime, timezone, timedelta
+from models import Lead, ArchivedLead, MergedLead, IntegrationLog
+from lead_dedup import absorb_duplicate
+from config_registry import config_registry
 from app import db
 
 logger = logging.getLogger(__name__)
 
+# Leads can show up in the API slightly after their created_time
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+class MetaSyncError(Exception):
+    pass
+
 class MetaLeadsIntegration:
-    def __init__(self):
-        self.config = None
+    def __init__(self, config=None, max_leads=None):
+        # config is a page snapshot from the config registry
+        self.config = config
+        self.max_leads = max_leads
+        self.truncated = False
     
     def load_config(self):
-        """Load Meta API configuration"""
-        from flask import current_app
-        with current_app.app_context():
-            self.config = MetaConfig.query.filter_by(is_active=True).first()
+        """Load Meta API configuration (the first active page when none was given)"""
+        pages = config_registry.get('meta')
+        self.config = pages[0] if pages else None
         return self.config is not None
     
     def test_connection(self):
@@ -48,83 +60,132 @@ class MetaLeadsIntegration:
             self.log_integration('test_connection', 'error', error_msg)
             return False, error_msg
     
-    def fetch_leads(self):
-        """Fetch new leads from Meta Lead Ads"""
+    def fetch_new_leads(self):
+        """Fetch new leads from Meta Lead Ads as unsaved Lead objects (save them with save_leads)
+        
+        Only leads created after the page's sync watermark (minus an overlap)
+        are requested. Stops after max_leads new leads and sets truncated, so a
+        large page cannot hold a sync worker for the whole cycle. Only reads
+        the database, so it can run outside the SQLite writer thread.
+        """
+        self.truncated = False
         if not self.config:
             self.load_config()
         if not self.config:
             self.log_integration('fetch_leads', 'error', "No active Meta configuration")
             return []
         
-        try:
-            # Get leadgen forms for the page
-            url = f"https://graph.facebook.com/v18.0/{self.config.page_id}/leadgen_forms"
-            params = {
-                'access_token': self.config.api_token,
-                'fields': 'id,name'
-            }
-            
-            response = requests.get(url, params=params, timeout=30)
-            
-            if response.status_code != 200:
-                self.log_integration('fetch_leads', 'error', f"Failed to fetch forms: {response.text}")
-                return []
-            
-            forms_data = response.json()
-            forms = forms_data.get('data', [])
-            
-            all_leads = []
-            
-            # Fetch leads for each form
-            for form in forms:
-                form_id = form['id']
-                leads_url = f"https://graph.facebook.com/v18.0/{form_id}/leads"
-                leads_params = {
-                    'access_token': self.config.api_token,
-                    'fields': 'id,created_time,field_data'
-                }
-                
-                leads_response = requests.get(leads_url, params=leads_params, timeout=30)
+        # Get leadgen forms for the page
+        url = f"https://graph.facebook.com/v18.0/{self.config.page_id}/leadgen_forms"
+        params = {
+            'access_token': self.config.api_token,
+            'fields': 'id,name'
+        }
+        
+        response = requests.get(url, params=params, timeout=30)
+        
+        if response.status_code != 200:
+            raise MetaSyncError(f"Failed to fetch forms: {response.text}")
+        
+        forms = response.json().get('data', [])
+        new_leads = []
+        
+        # Fetch leads for each form
+        for form in forms:
+            for leads in self.iter_form_leads(form['id']):
+                # One query per API page to skip leads already imported (or archived, or merged)
+                lead_ids = [lead_data['id'] for lead_data in leads]
+                existing = {row[0] for row in db.session.query(Lead.meta_lead_id)
+                                                        .filter(Lead.meta_lead_id.in_(lead_ids))
+                                                        .union(db.session.query(ArchivedLead.meta_lead_id)
+                                                               .filter(ArchivedLead.meta_lead_id.in_(lead_ids)))
+                                                        .union(db.session.query(MergedLead.meta_lead_id)
+                                                               .filter(MergedLead.meta_lead_id.in_(lead_ids)))}
+                # Read-only: don't keep a transaction open across the next HTTP call
+                db.session.rollback()
                 
-                if leads_response.status_code == 200:
-                    leads_data = leads_response.json()
-                    leads = leads_data.get('data', [])
+                for lead_data in leads:
+                    if lead_data['id'] in existing:
+                        continue
                     
-                    for lead_data in leads:
-                        # Check if lead already exists
-                        existing_lead = Lead.query.filter_by(meta_lead_id=lead_data['id']).first()
-                        if existing_lead:
-                            continue
-                        
-                        # Parse lead data
-                        lead_info = self.parse_lead_data(lead_data)
-                        if lead_info:
-                            # Create new lead
-                            lead = Lead()
-                            lead.meta_lead_id = lead_data['id']
-                            lead.name = lead_info.get('name', 'Unknown')
-                            lead.email = lead_info.get('email')
-                            lead.phone = lead_info.get('phone')
-                            lead.message = lead_info.get('message', '')
-                            
-                            db.session.add(lead)
-                            all_leads.append(lead)
-            
-            if all_leads:
-                db.session.commit()
-                self.config.last_sync = datetime.utcnow()
-                db.session.commit()
+                    # Parse lead data
+                    lead_info = self.parse_lead_data(lead_data)
+                    if lead_info:
+                        new_leads.append(self.build_lead(lead_data, lead_info, form))
                 
-                self.log_integration('fetch_leads', 'success', 
-                                   f"Successfully imported {len(all_leads)} new leads")
+                if self.max_leads and len(new_leads) >= self.max_leads:
+                    self.truncated = True
+                    break
+            if self.truncated:
+                break
+        
+        return new_leads
+    
+    def save_leads(self, leads):
+        """Add fetched leads, folding contacts already known into their lead; returns the added ones"""
+        added = []
+        for lead in leads:
+            # Someone already known (another form, WhatsApp) stays with their broker
+            if absorb_duplicate(lead):
+                continue
+            # Added right away so later leads of this sync are checked against it
+            db.session.add(lead)
+            added.append(lead)
+        
+        db.session.commit()
+        if added:
+            self.log_integration('fetch_leads', 'success', 
+                               f"Successfully imported {len(added)} new leads from page {self.config.page_id}")
+        
+        return added
+    
+    def iter_form_leads(self, form_id):
+        """Yield the form's leads one API page at a time, following paging.next"""
+        url = f"https://graph.facebook.com/v18.0/{form_id}/leads"
+        params = {
+            'access_token': self.config.api_token,
+            'fields': 'id,created_time,field_data,ad_id,campaign_id,campaign_name',
+            'limit': 100
+        }
+        if self.config.sync_watermark:
+            since = self.config.sync_watermark - WATERMARK_OVERLAP
+            params['filtering'] = json.dumps([{
+                'field': 'time_created',
+                'operator': 'GREATER_THAN',
+                'value': calendar.timegm(since.timetuple())
+            }])
+        
+        while url:
+            response = requests.get(url, params=params, timeout=30)
+            if response.status_code != 200:
+                raise MetaSyncError(f"Failed to fetch leads of form {form_id}: {response.text}")
             
-            return all_leads
+            data = response.json()
+            yield data.get('data', [])
             
-        except Exception as e:
-            error_msg = f"Error fetching leads: {str(e)}"
-            self.log_integration('fetch_leads', 'error', error_msg)
-            logger.error(error_msg)
-            return []
+            # The next URL already carries the query parameters
+            url = data.get('paging', {}).get('next')
+            params = None
+    
+    def build_lead(self, lead_data, lead_info, form):
+        lead = Lead()
+        lead.meta_lead_id = lead_data['id']
+        lead.meta_config_id = self.config.id
+        lead.name = lead_info.get('name', 'Unknown')
+        lead.email = lead_info.get('email')
+        lead.phone = lead_info.get('phone')
+        lead.message = lead_info.get('message', '')
+        
+        # Source attribution
+        lead.source_channel = 'meta'
+        lead.source_page_id = self.config.page_id
+        lead.source_form_id = form['id']
+        lead.source_form_name = form.get('name')
+        lead.source_ad_id = lead_data.get('ad_id')
+        lead.source_campaign_id = lead_data.get('campaign_id')
+        lead.source_campaign_name = lead_data.get('campaign_name')
+        lead.source_created_at = self.parse_created_time(lead_data.get('created_time'))
+        return lead
     
     def parse_lead_data(self, lead_data):
         """Parse Meta lead data into structured format"""
@@ -154,6 +215,17 @@ class MetaLeadsIntegration:
             logger.error(f"Error parsing lead data: {str(e)}")
             return None
     
+    def parse_created_time(self, created_time):
+        """Parse Meta's created_time (e.g. 2024-05-01T12:30:00+0000) as naive UTC"""
+        if not created_time:
+            return None
+        try:
+            parsed = datetime.strptime(created_time, '%Y-%m-%dT%H:%M:%S%z')
+            return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            logger.warning(f"Unexpected created_time format: {created_time}")
+            return None
+    
     def log_integration(self, action, status, message, details=None):
         """Log integration activities"""
         try:
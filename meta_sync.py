@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from flask import g
+from models import MetaConfig, IntegrationLog
+from meta_integration import MetaLeadsIntegration
+from lead_distributor import LeadDistributor
+from whatsapp_dispatcher import enqueue_greetings
+from config_registry import config_registry
+from write_queue import write_queue
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+SYNC_WORKERS = int(os.environ.get('META_SYNC_WORKERS', 4))
+# New leads imported per page per cycle; the rest is picked up next cycle
+MAX_LEADS_PER_PAGE = int(os.environ.get('META_SYNC_MAX_LEADS_PER_PAGE', 500))
+
+executor = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='meta-sync')
+
+def sync_all_pages():
+    """Sync every active Meta page in parallel and return per-page results
+
+    Pages are started least recently synced first and each one stops after
+    MAX_LEADS_PER_PAGE new leads, so a page with a huge backlog takes one
+    worker for one bounded slice per cycle instead of delaying the others.
+    """
+    pages = sorted(config_registry.get('meta'), key=lambda page: page.last_sync or datetime.min)
+    if not pages:
+        return []
+
+    # Pages are snapshots; end this transaction so it can't hold SQLite's write lock
+    # while the pages' imports wait for the writer thread
+    db.session.commit()
+    futures = [executor.submit(sync_page, page) for page in pages]
+    results = [future.result() for future in as_completed(futures)]
+
+    # last_sync and the metrics changed; let every process reload the pages
+    config_registry.bump('meta')
+    db.session.commit()
+    return results
+
+def sync_page(page):
+    """Import and distribute one page's new leads, recording the run's metrics on its config
+
+    The Graph API calls run on this worker; only the writes go through the
+    write queue, so on SQLite they don't hold the single writer during HTTP.
+    """
+    with app.app_context():
+        # This thread's own transactions only read (see read_only_request)
+        g.writes_queued = write_queue.enabled
+        started_at = datetime.utcnow()
+        started = time.monotonic()
+        integration = MetaLeadsIntegration(page, max_leads=MAX_LEADS_PER_PAGE)
+        result = {'meta_config_id': page.id, 'page_id': page.page_id, 'leads': 0, 'error': None}
+
+        try:
+            fetched = integration.fetch_new_leads()
+            result['leads'] = write_queue.run(import_leads, integration, fetched) if fetched else 0
+            result['status'] = 'partial' if integration.truncated else 'success'
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error syncing Meta page {page.page_id}: {str(e)}")
+            result['status'] = 'error'
+            result['error'] = str(e)
+
+        result['duration_ms'] = int((time.monotonic() - started) * 1000)
+        write_queue.run(record_sync, page, result, started_at)
+        return result
+
+def import_leads(integration, fetched):
+    """Save, distribute and greet a page's fetched leads; returns how many were new"""
+    new_leads = integration.save_leads(fetched)
+    if new_leads:
+        LeadDistributor(meta_config_id=integration.config.id).distribute_leads(new_leads)
+        # Greet new leads on WhatsApp (no-op unless a greeting template is configured)
+        enqueue_greetings(new_leads)
+    return len(new_leads)
+
+def record_sync(page, result, started_at):
+    values = {
+        'last_sync': datetime.utcnow(),
+        'last_sync_status': result['status'],
+        'last_sync_leads': result['leads'],
+        'last_sync_duration_ms': result['duration_ms'],
+        'last_sync_error': result['error'],
+    }
+    # The watermark only moves when every form was read to the end
+    if result['status'] == 'success':
+        values['sync_watermark'] = started_at
+    MetaConfig.query.filter_by(id=page.id).update(values, synchronize_session=False)
+
+    if result['status'] == 'error':
+        db.session.add(IntegrationLog(
+            action='fetch_leads',
+            status='error',
+            message=f"Erro ao sincronizar a página {page.name or page.page_id}: {result['error']}",
+            details=result
+        ))
+    db.session.commit()
+
+def get_sync_metrics():
+    """Last sync run of every Meta page, for the admin page and the metrics endpoint"""
+    pages = MetaConfig.query.order_by(MetaConfig.id).all()
+    return [{
+        'id': page.id,
+        'name': page.name,
+        'page_id': page.page_id,
+        'is_active': page.is_active,
+        'last_sync': page.last_sync.isoformat() if page.last_sync else None,
+        'last_sync_status': page.last_sync_status,
+        'last_sync_leads': page.last_sync_leads,
+        'last_sync_duration_ms': page.last_sync_duration_ms,
+        'last_sync_error': page.last_sync_error,
+        'sync_watermark': page.sync_watermark.isoformat() if page.sync_watermark else None,
+    } for page in pages]
@@ -48,11 +48,22 @@ class MetaConfig(db.Model):
     __tablename__ = 'meta_config'
     
     id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256), nullable=True)  # Page / team label
     api_token = db.Column(db.Text, nullable=True)
     app_secret = db.Column(db.String(256), nullable=True)
-    page_id = db.Column(db.String(256), nullable=True)
+    verify_token = db.Column(db.String(256), nullable=True)
+    page_id = db.Column(db.String(256), nullable=True, index=True)
     is_active = db.Column(db.Boolean, default=False)
     last_sync = db.Column(db.DateTime, nullable=True)
+    
+    # Leads created before this time have all been read (only advances on complete syncs)
+    sync_watermark = db.Column(db.DateTime, nullable=True)
+    
+    # Metrics of the last sync run
+    last_sync_status = db.Column(db.String(20), nullable=True)  # success, partial, error
+    last_sync_leads = db.Column(db.Integer, nullable=True)
+    last_sync_duration_ms = db.Column(db.Integer, nullable=True)
+    last_sync_error = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -67,27 +78,70 @@ class Lead(db.Model):
     message = db.Column(db.Text, nullable=True)
     status = db.Column(db.Enum(LeadStatus), default=LeadStatus.NOVO)
     assigned_to = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    meta_config_id = db.Column(db.Integer, db.ForeignKey('meta_config.id'), nullable=True)  # Page / team
     notes = db.Column(db.Text, nullable=True)
     follow_up_date = db.Column(db.DateTime, nullable=True)
+    
+    # Source attribution
+    source_channel = db.Column(db.String(20), nullable=True, default='manual')  # meta, whatsapp, import, manual
+    source_page_id = db.Column(db.String(256), nullable=True)
+    source_form_id = db.Column(db.String(256), nullable=True)
+    source_form_name = db.Column(db.String(256), nullable=True)
+    source_ad_id = db.Column(db.String(256), nullable=True)
+    source_campaign_id = db.Column(db.String(256), nullable=True)
+    source_campaign_name = db.Column(db.String(256), nullable=True)
+    source_created_at = db.Column(db.DateTime, nullable=True)
+    
+    # Last outbound WhatsApp message delivery status (sent, delivered, read, failed)
+    last_message_status = db.Column(db.String(20), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    
+    # Normalized phone/email used to block duplicate candidates (set by lead_dedup.py)
+    phone_key = db.Column(db.String(20), nullable=True)
+    email_key = db.Column(db.String(256), nullable=True)
+    
+    # Conversion likelihood 0-100 (set by lead_scoring.py)
+    score = db.Column(db.SmallInteger, nullable=True)
+    
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relationships
     assignments = db.relationship('LeadAssignment', backref='lead', lazy=True)
+    
+    __table_args__ = (
+        # Used by the reassignment sweeper to find stale NOVO leads without a full scan
+        db.Index('ix_leads_status_updated_at', 'status', 'updated_at', 'id'),
+        # Keyset pagination of the admin lead browser, overall and per broker
+        db.Index('ix_leads_created_at_id', 'created_at', 'id'),
+        db.Index('ix_leads_assigned_to_created_at', 'assigned_to', 'created_at', 'id'),
+        db.Index('ix_leads_source_channel_created_at', 'source_channel', 'created_at', 'id'),
+        # Broker queue ordered by score
+        db.Index('ix_leads_assigned_to_score', 'assigned_to', 'score', 'created_at'),
+        # Delta sync of a broker's leads by (updated_at, id) cursor
+        db.Index('ix_leads_assigned_to_updated_at', 'assigned_to', 'updated_at', 'id'),
+        db.Index('ix_leads_meta_config_created_at', 'meta_config_id', 'created_at', 'id'),
+        # Duplicate detection: equality lookups, and batch mode walks the keys in order
+        db.Index('ix_leads_phone_key', 'phone_key'),
+        db.Index('ix_leads_email_key', 'email_key'),
+    )
 
 class LeadAssignment(db.Model):
     __tablename__ = 'lead_assignments'
     
     id = db.Column(db.Integer, primary_key=True)
-    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), nullable=False)
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), nullable=False, index=True)
     broker_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
+    assigned_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Delta sync removals
     assignment_order = db.Column(db.Integer, nullable=True)
 
 class DistributionConfig(db.Model):
     __tablename__ = 'distribution_config'
     
     id = db.Column(db.Integer, primary_key=True)
+    # NULL is the default config; a page config distributes only that page's leads
+    meta_config_id = db.Column(db.Integer, db.ForeignKey('meta_config.id'), unique=True, nullable=True)
+    broker_pool = db.Column(db.JSON, nullable=True)  # Broker IDs allowed to receive the page's leads
     mode = db.Column(db.Enum(DistributionMode), default=DistributionMode.ROUND_ROBIN)
     broker_order = db.Column(db.JSON, nullable=True)  # List of broker IDs in order
     current_index = db.Column(db.Integer, default=0)
@@ -118,3 +172,241 @@ class IntegrationLog(db.Model):
     message = db.Column(db.Text, nullable=False)
     details = db.Column(db.JSON, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Notification(db.Model):
+    __tablename__ = 'notifications'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), nullable=True)
+    type = db.Column(db.String(50), nullable=False)  # lead_reassigned, lead_received, ...
+    message = db.Column(db.String(512), nullable=False)
+    is_read = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_notifications_user_unread', 'user_id', 'is_read'),
+    )
+
+class BulkJob(db.Model):
+    __tablename__ = 'bulk_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # reassign, status_update, import
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, error
+    params = db.Column(db.JSON, nullable=True)
+    total = db.Column(db.Integer, default=0)
+    processed = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Stamped per chunk while running
+    # Imports: the uploaded file, kept in the database so whichever process
+    # recovers the job can read it, and the file rows already committed
+    upload = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    rows_read = db.Column(db.Integer, default=0)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'error': self.error,
+            'progress': round(min(self.processed + self.skipped, self.total) / self.total * 100, 1)
+                        if self.total else (100.0 if self.status == 'done' else 0.0)
+        }
+
+class CampaignDailyRollup(db.Model):
+    __tablename__ = 'campaign_daily_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    channel = db.Column(db.String(20), nullable=True)
+    campaign_id = db.Column(db.String(256), nullable=True)
+    campaign_name = db.Column(db.String(256), nullable=True)
+    broker_id = db.Column(db.Integer, nullable=True)
+    leads = db.Column(db.Integer, default=0)
+    converted = db.Column(db.Integer, default=0)
+    lost = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_campaign_daily_rollups_day_campaign', 'day', 'campaign_id'),
+        # One row per day, campaign and broker (NULLs stay distinct, refresh_rollups' lock covers those)
+        db.Index('uq_campaign_daily_rollups_key', 'day', 'channel', 'campaign_id', 'broker_id', unique=True),
+    )
+
+class CampaignSpend(db.Model):
+    __tablename__ = 'campaign_spend'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.String(256), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('campaign_id', 'day', name='uq_campaign_spend_campaign_day'),
+    )
+
+class RollupState(db.Model):
+    __tablename__ = 'rollup_state'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    watermark = db.Column(db.DateTime, nullable=True)
+
+class FollowUpReminder(db.Model):
+    __tablename__ = 'follow_up_reminders'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), unique=True, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False)
+    fired_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # The reminder engine reads pending reminders in due order, one window at a time
+        db.Index('ix_follow_up_reminders_pending', 'fired_at', 'due_at'),
+    )
+
+class ConfigVersion(db.Model):
+    __tablename__ = 'config_versions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)  # meta, distribution, whatsapp
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class DashboardCounter(db.Model):
+    """Headline counts kept current by database triggers (see dashboard_counters.py)"""
+    __tablename__ = 'dashboard_counters'
+    
+    scope = db.Column(db.String(20), primary_key=True)  # status, broker_status, source, brokers, archived_*
+    key = db.Column(db.String(64), primary_key=True)  # e.g. NOVO, 12:NOVO, active
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class LeadScoreWeight(db.Model):
+    """Log-odds contribution of a feature value to lead scores (see lead_scoring.py)"""
+    __tablename__ = 'lead_score_weights'
+    
+    feature = db.Column(db.String(20), primary_key=True)  # base, channel, segment, message, email, phone, hour
+    value = db.Column(db.String(300), primary_key=True)  # e.g. meta, meta|<form id>, 1, 14
+    weight = db.Column(db.Float, nullable=False)
+
+class LeadEvent(db.Model):
+    """Append-only lead change events, written by database triggers (see lead_outbox.py)"""
+    __tablename__ = 'lead_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # Writing transaction on PostgreSQL (0 on SQLite); consumers read in (txid, id) order
+    txid = db.Column(db.BigInteger, nullable=False, server_default='0')
+    lead_id = db.Column(db.Integer, nullable=False)  # No FK: events outlive merged and archived leads
+    type = db.Column(db.String(30), nullable=False)  # created, assigned, status_changed, follow_up_set
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_lead_events_txid_id', 'txid', 'id'),
+    )
+
+class ReplicaHeartbeat(db.Model):
+    """Timestamp stamped on the primary; its age on a replica is the replica's lag (see read_replicas.py)"""
+    __tablename__ = 'replica_heartbeat'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Single row, id 1
+    beat_at = db.Column(db.DateTime, nullable=False)
+
+class OutboundMessage(db.Model):
+    __tablename__ = 'outbound_messages'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), nullable=True, index=True)
+    to_phone = db.Column(db.String(20), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)  # greeting, follow_up
+    payload = db.Column(db.JSON, nullable=False)
+    idempotency_key = db.Column(db.String(256), unique=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, delivered, read, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    wa_message_id = db.Column(db.String(256), nullable=True, index=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_outbound_messages_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class ArchivedLead(db.Model):
+    """Closed leads moved out of `leads` by lead_archive.py; same columns plus archived_at"""
+    __tablename__ = 'leads_archive'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Original leads.id
+    meta_lead_id = db.Column(db.String(256), nullable=True)
+    name = db.Column(db.String(256), nullable=False)
+    email = db.Column(db.String(256), nullable=True)
+    phone = db.Column(db.String(20), nullable=True)
+    message = db.Column(db.Text, nullable=True)
+    status = db.Column(db.Enum(LeadStatus))
+    assigned_to = db.Column(db.Integer, nullable=True)
+    meta_config_id = db.Column(db.Integer, nullable=True)
+    notes = db.Column(db.Text, nullable=True)
+    follow_up_date = db.Column(db.DateTime, nullable=True)
+    
+    source_channel = db.Column(db.String(20), nullable=True)
+    source_page_id = db.Column(db.String(256), nullable=True)
+    source_form_id = db.Column(db.String(256), nullable=True)
+    source_form_name = db.Column(db.String(256), nullable=True)
+    source_ad_id = db.Column(db.String(256), nullable=True)
+    source_campaign_id = db.Column(db.String(256), nullable=True)
+    source_campaign_name = db.Column(db.String(256), nullable=True)
+    source_created_at = db.Column(db.DateTime, nullable=True)
+    
+    last_message_status = db.Column(db.String(20), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    
+    phone_key = db.Column(db.String(20), nullable=True)
+    email_key = db.Column(db.String(256), nullable=True)
+    score = db.Column(db.SmallInteger, nullable=True)
+    
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_leads_archive_created_at', 'created_at'),
+        db.Index('ix_leads_archive_assigned_to', 'assigned_to'),
+        db.Index('ix_leads_archive_meta_lead_id', 'meta_lead_id'),
+        db.Index('ix_leads_archive_archived_at', 'archived_at'),
+    )
+
+class ArchivedLeadAssignment(db.Model):
+    __tablename__ = 'lead_assignments_archive'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Original lead_assignments.id
+    lead_id = db.Column(db.Integer, nullable=False, index=True)
+    broker_id = db.Column(db.Integer, nullable=False)
+    assigned_at = db.Column(db.DateTime)
+    assignment_order = db.Column(db.Integer, nullable=True)
+
+class MergedLead(db.Model):
+    """A duplicate lead folded into an existing one by lead_dedup.py"""
+    __tablename__ = 'merged_leads'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, db.ForeignKey('leads.id'), nullable=True, index=True)  # Kept lead
+    merged_lead_id = db.Column(db.Integer, nullable=True)  # Id of the removed lead, if it was stored
+    meta_lead_id = db.Column(db.String(256), nullable=True, index=True)  # Keeps Meta from re-importing it
+    name = db.Column(db.String(256), nullable=True)
+    email = db.Column(db.String(256), nullable=True)
+    phone = db.Column(db.String(20), nullable=True)
+    source_channel = db.Column(db.String(20), nullable=True)
+    status = db.Column(db.Enum(LeadStatus), nullable=True)  # The duplicate's, when it was stored
+    assigned_to = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    score = db.Column(db.Float, nullable=False)
+    merged_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,262 @@
+"""Read replicas for reports, exports and dashboards.
+
+DATABASE_REPLICA_URLS (comma separated) adds one bind per replica next to
+SQLALCHEMY_DATABASE_URI. Views decorated with @replica_reads send their
+SELECTs to a replica; everything else stays on the primary: writes, flushes,
+SELECT ... FOR UPDATE, raw SQL, API routes, scheduler jobs and CLI commands.
+
+Staleness: while replicas are configured every process that routes reads
+stamps the replica_heartbeat row on the primary, at most every
+REPLICA_HEARTBEAT_SECONDS, when a @replica_reads view picks a replica (so it
+needs no scheduler process and stops when nothing reads). The age of the
+stamp a replica serves is its lag; a replica lagging more than
+DB_REPLICA_MAX_LAG_SECONDS, or not answering, is skipped and the reads fall
+back to the primary. Each process checks a replica at most every
+DB_REPLICA_LAG_CHECK_SECONDS.
+
+Read-your-writes: a request that writes records the time in the user's
+session, and that user's reads stay on the primary until a replica serves a
+heartbeat stamped after the write. Within a request, reads after a write go
+to the primary.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import g, request, session, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, select, update, insert
+from database import PoolMetrics, build_engine_options, configure_engine, get_pool_metrics
+
+logger = logging.getLogger(__name__)
+
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+MAX_LAG = timedelta(seconds=float(os.environ.get('DB_REPLICA_MAX_LAG_SECONDS', 30)))
+LAG_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_LAG_CHECK_SECONDS', 2))
+HEARTBEAT_SECONDS = int(os.environ.get('REPLICA_HEARTBEAT_SECONDS', 5))
+
+LAST_WRITE_KEY = 'db_last_write'
+
+def replica_binds(urls=REPLICA_URLS):
+    """SQLALCHEMY_BINDS entries for the replicas: replica_0, replica_1, ..."""
+    return {f'replica_{index}': {'url': url, **build_engine_options(url)} for index, url in enumerate(urls)}
+
+def replica_engines(db):
+    return {key: engine for key, engine in db.engines.items() if key and key.startswith('replica_')}
+
+class ReplicaMonitor:
+    """Per-process cache of the heartbeat each replica serves"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._beats = {}  # bind key -> (checked at, beat_at or None when unreachable)
+        self._stamped_at = None  # monotonic time this process last stamped the primary
+        self.metrics = {}  # bind key -> PoolMetrics
+
+    def stamp(self, db):
+        """Stamp the primary's heartbeat if this process hasn't for REPLICA_HEARTBEAT_SECONDS"""
+        if self._stamped_at is not None and time.monotonic() - self._stamped_at < HEARTBEAT_SECONDS:
+            return
+        with self._lock:
+            if self._stamped_at is not None and time.monotonic() - self._stamped_at < HEARTBEAT_SECONDS:
+                return
+            self._stamped_at = time.monotonic()
+        try:
+            write_heartbeat(db)
+        except Exception as e:
+            logger.warning(f"Replica heartbeat stamp failed: {str(e)}")
+
+    def beat_at(self, key, engine):
+        checked = self._beats.get(key)
+        if checked and time.monotonic() - checked[0] < LAG_CHECK_SECONDS:
+            return checked[1]
+
+        with self._lock:
+            checked = self._beats.get(key)
+            if checked and time.monotonic() - checked[0] < LAG_CHECK_SECONDS:
+                return checked[1]
+            beat_at = self._read_heartbeat(key, engine)
+            if checked and (checked[1] is None) != (beat_at is None):
+                logger.warning(f"Replica {key} {'unreachable' if beat_at is None else 'reachable again'}")
+            self._beats[key] = (time.monotonic(), beat_at)
+            return beat_at
+
+    def _read_heartbeat(self, key, engine):
+        from models import ReplicaHeartbeat
+        try:
+            with engine.connect() as connection:
+                return connection.execute(select(ReplicaHeartbeat.beat_at)
+                                          .where(ReplicaHeartbeat.id == 1)).scalar()
+        except Exception as e:
+            logger.debug(f"Heartbeat read from replica {key} failed: {str(e)}")
+            return None
+
+    def lag(self, key, engine, now=None):
+        """Seconds behind the primary, or None when the replica can't be used"""
+        beat_at = self.beat_at(key, engine)
+        if beat_at is None:
+            return None
+        return max(((now or datetime.utcnow()) - beat_at).total_seconds(), 0.0)
+
+replica_monitor = ReplicaMonitor()
+
+def init_read_replicas(app, db):
+    """Instrument the replica engines and remember each user's last write"""
+    with app.app_context():
+        for key, engine in replica_engines(db).items():
+            replica_monitor.metrics[key] = PoolMetrics()
+            configure_engine(engine, replica_monitor.metrics[key], read_only=lambda: True)
+            logger.info(f"Read replica {key} configured (max lag {MAX_LAG.total_seconds():g}s)")
+
+    @app.before_request
+    def mark_replica_reads():
+        # Set before the auth decorators run so the whole request reads alike
+        view = app.view_functions.get(request.endpoint)
+        g.replica_reads = getattr(view, 'replica_reads', False)
+        g.writes_queued = getattr(view, 'writes_queued', False)
+
+    @app.after_request
+    def remember_last_write(response):
+        if g.get('db_wrote') and 'user_id' in session:
+            session[LAST_WRITE_KEY] = datetime.utcnow().isoformat()
+        return response
+
+def replica_reads(f):
+    """Decorator for read-only views: their SELECTs may be served by a fresh replica
+
+    Only marks the view (functools.wraps copies the mark onto the outer
+    decorators); the flag is set for the request before any of them runs.
+    """
+    f.replica_reads = True
+    return f
+
+def read_only_request():
+    """Whether this thread only reads: a @replica_reads view that has not written, or a view
+    or worker whose writes run on the SQLite writer thread (@queued_writes, meta_sync)"""
+    if not has_app_context():
+        return False
+    if g.get('writes_queued', False):
+        return True
+    return has_request_context() and g.get('replica_reads', False) and not g.get('db_wrote', False)
+
+def choose_replica(db, now=None):
+    """A replica within the lag bound that has the user's last write, or None for the primary"""
+    replica_monitor.stamp(db)
+    now = now or datetime.utcnow()
+    last_write = session.get(LAST_WRITE_KEY)
+    if last_write:
+        last_write = datetime.fromisoformat(last_write)
+        if now - last_write > MAX_LAG:
+            # Any replica within the bound has it by now
+            session.pop(LAST_WRITE_KEY)
+            last_write = None
+
+    fresh = []
+    for key, engine in replica_engines(db).items():
+        beat_at = replica_monitor.beat_at(key, engine)
+        if beat_at is None or now - beat_at > MAX_LAG:
+            continue
+        if last_write and beat_at <= last_write:
+            continue
+        fresh.append(engine)
+    return random.choice(fresh) if fresh else None
+
+class RoutingSession(Session):
+    """Session that sends the SELECTs of @replica_reads views to a replica
+
+    The replica is picked once per request; a request without a usable
+    replica reads from the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            if 'db_replica' not in g:
+                g.db_replica = choose_replica(self._db)
+            if g.db_replica is not None:
+                return g.db_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        return (has_request_context() and g.get('replica_reads', False) and not g.get('db_wrote', False)
+                and not self._flushing and clause is not None and clause.is_select
+                and getattr(clause, '_for_update_arg', None) is None)
+
+def _mark_write():
+    if has_request_context():
+        g.db_wrote = True
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    _mark_write()
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _after_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _mark_write()
+
+def write_heartbeat(db):
+    """Stamp the heartbeat on the primary, in a transaction of its own (not the request's)"""
+    from models import ReplicaHeartbeat
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        stamped = connection.execute(update(ReplicaHeartbeat).where(ReplicaHeartbeat.id == 1)
+                                                             .values(beat_at=now)).rowcount
+        if not stamped:
+            connection.execute(insert(ReplicaHeartbeat).values(id=1, beat_at=now))
+
+def replica_metrics(db):
+    """Lag, routing state and pool metrics of each replica for the metrics endpoint"""
+    now = datetime.utcnow()
+    data = {}
+    for key, engine in replica_engines(db).items():
+        lag = replica_monitor.lag(key, engine, now)
+        data[key] = {
+            'lag_seconds': round(lag, 3) if lag is not None else None,
+            'serving_reads': lag is not None and lag <= MAX_LAG.total_seconds(),
+            'pool': get_pool_metrics(engine, replica_monitor.metrics.get(key, PoolMetrics())),
+        }
+    return data
+
+if __name__ == '__main__':
+    # Primary plus replica check: serves the admin dashboard, reports and metrics
+    # through the test client and counts the connections each database handed out.
+    #   DATABASE_URL=postgresql://primary/db DATABASE_REPLICA_URLS=postgresql://replica/db python read_replicas.py
+    from app import app, db, create_app
+    from database import pool_metrics
+    from models import User, UserRole
+    # The app routes through the imported module, not this __main__ copy
+    import read_replicas as routing
+
+    REQUESTS = int(os.environ.get('BENCH_REQUESTS', 60))
+    PAGES = ['/admin', '/admin/reports', '/api/metrics/dashboard']
+
+    if not REPLICA_URLS:
+        raise SystemExit("Set DATABASE_REPLICA_URLS to the replica of DATABASE_URL")
+    create_app()
+    with app.app_context():
+        admin_id = User.query.filter_by(role=UserRole.ADMIN).first().id
+    client = app.test_client()
+    with client.session_transaction() as user_session:
+        user_session['user_id'] = admin_id
+
+    def run(label):
+        before = (pool_metrics.snapshot()['checkouts'],
+                  {key: metrics.snapshot()['checkouts'] for key, metrics in routing.replica_monitor.metrics.items()})
+        statuses = {client.get(PAGES[n % len(PAGES)]).status_code for n in range(REQUESTS)}
+        replicas = {key: metrics.snapshot()['checkouts'] - before[1][key]
+                    for key, metrics in routing.replica_monitor.metrics.items()}
+        with app.app_context():
+            lags = {key: data['lag_seconds'] for key, data in routing.replica_metrics(db).items()}
+        print(f"{label:<28} HTTP {sorted(statuses)}: primary {pool_metrics.snapshot()['checkouts'] - before[0]:4} "
+              f"connections, replicas {replicas}, lag {lags}")
+
+    run('first requests')
+    time.sleep(1)  # The first stamp reaches the replica
+    run('steady')
+    with client.session_transaction() as user_session:
+        user_session[LAST_WRITE_KEY] = datetime.utcnow().isoformat()
+    run('right after a write')
+    time.sleep(HEARTBEAT_SECONDS + 1)
+    run(f'{HEARTBEAT_SECONDS + 1}s after the write')
@@ -1,13 +1,28 @@
 from flask import render_template, request, redirect, url_for, flash, session, jsonify, make_response
 from datetime import datetime, timedelta
-import csv
-import io
 from app import app, db
 from models import (User, Lead, LeadAssignment, MetaConfig, DistributionConfig, 
-                   IntegrationLog, WhatsAppConfig, UserRole, LeadStatus, DistributionMode)
+                   IntegrationLog, WhatsAppConfig, Notification, BulkJob, UserRole, LeadStatus,
+                   DistributionMode)
 from auth import login_required, admin_required, get_current_user
-from meta_integration import MetaLeadsIntegration
 from lead_distributor import LeadDistributor
+from database import get_pool_metrics
+from read_replicas import replica_reads, replica_metrics
+from lead_search import search_leads
+from lead_browser import parse_filters, browse_leads, get_facets, lead_rows, lead_rows_with_broker, notes_preview
+from bulk_operations import create_job, count_rows, MAX_IMPORT_BYTES
+from campaign_analytics import campaign_report, record_spend
+from whatsapp_dispatcher import apply_status_updates, enqueue_greetings
+from follow_up_reminders import schedule_reminder
+from lead_updates import parse_lead_changes, apply_lead_changes, serialize_changes
+from lead_dedup import absorb_duplicate, phone_key
+import dashboard_counters
+from http_caching import conditional_json
+from lead_archive import lead_table, search_archived_leads
+from sql_functions import seconds_between, day_of
+from write_queue import write_queue, queued_writes
+from webhook_security import verify_webhook, verify_token_matches, SIGNATURE_HEADER, INVALID, DUPLICATE
+from config_registry import config_registry
 from sqlalchemy import func, desc, or_, case
 
 @app.route('/')
@@ -53,24 +68,20 @@ def logout():
 # Admin Routes
 @app.route('/admin')
 @admin_required
+@replica_reads
 def admin_dashboard():
     """Admin dashboard"""
-    # Get dashboard statistics
-    total_leads = Lead.query.count()
-    total_brokers = User.query.filter_by(role=UserRole.BROKER).count()
-    active_brokers = User.query.filter_by(role=UserRole.BROKER, is_active=True).count()
+    # Get dashboard statistics (trigger-maintained counters, no table scans)
+    status_counts = dashboard_counters.status_counts()
+    total_leads = dashboard_counters.total_leads()
+    total_brokers, active_brokers = dashboard_counters.broker_totals()
     
     # Recent leads
-    recent_leads = Lead.query.order_by(desc(Lead.created_at)).limit(5).all()
-    
-    # Lead status distribution
-    status_counts = db.session.query(
-        Lead.status, func.count(Lead.id)
-    ).group_by(Lead.status).all()
+    recent_leads = lead_rows_with_broker().order_by(desc(Lead.created_at)).limit(5).all()
     
     # Integration status
-    meta_config = MetaConfig.query.filter_by(is_active=True).first()
-    last_sync = meta_config.last_sync if meta_config else None
+    syncs = [page.last_sync for page in config_registry.get('meta') if page.last_sync]
+    last_sync = max(syncs) if syncs else None
     
     return render_template('admin_dashboard.html',
                          total_leads=total_leads,
@@ -158,6 +169,21 @@ def delete_user(user_id):
         user = User.query.get_or_404(user_id)
         username = user.username
         
+        has_history = Lead.query.filter_by(assigned_to=user.id).first() is not None or \
+            LeadAssignment.query.filter_by(broker_id=user.id).first() is not None
+        
+        if has_history:
+            # Leads and assignment history reference the user, so keep the row,
+            # stop new assignments and move open leads to the remaining brokers
+            user.is_active = False
+            user.can_receive_leads = False
+            db.session.commit()
+            
+            job = create_job('reassign', {'broker_id': user.id}, created_by=session['user_id'])
+            flash(f'Usuário {username} desativado; seus leads abertos estão sendo redistribuídos '
+                  f'(operação #{job.id})', 'warning')
+            return redirect(url_for('admin_users'))
+        
         db.session.delete(user)
         db.session.commit()
         
@@ -172,38 +198,60 @@ def delete_user(user_id):
 @app.route('/admin/meta-config')
 @admin_required
 def admin_meta_config():
-    """Admin Meta API configuration"""
-    config = MetaConfig.query.filter_by(is_active=True).first()
+    """Admin Meta API configuration: one entry per Facebook page"""
+    pages = MetaConfig.query.order_by(MetaConfig.id).all()
+    config = db.session.get(MetaConfig, request.args.get('config_id', type=int)) if request.args.get('config_id') else None
+    pools = {dc.meta_config_id: dc.broker_pool or []
+             for dc in DistributionConfig.query.filter(DistributionConfig.meta_config_id.isnot(None))}
+    brokers = User.query.filter_by(role=UserRole.BROKER, is_active=True).order_by(User.username).all()
     logs = IntegrationLog.query.order_by(desc(IntegrationLog.created_at)).limit(10).all()
-    return render_template('admin_meta_config.html', config=config, logs=logs)
+    return render_template('admin_meta_config.html',
+                         config=config,
+                         pages=pages,
+                         pools=pools,
+                         brokers=brokers,
+                         logs=logs)
 
 @app.route('/admin/meta-config/save', methods=['POST'])
 @admin_required
 def save_meta_config():
     """Save Meta API configuration"""
     try:
-        api_token = request.form['api_token']
-        app_secret = request.form['app_secret']
         page_id = request.form['page_id']
+        config_id = request.form.get('config_id', type=int)
+        
+        # Update the page being edited (or already registered), otherwise add it
+        config = db.session.get(MetaConfig, config_id) if config_id else None
+        if not config:
+            config = MetaConfig.query.filter_by(page_id=page_id).first()
+        if not config:
+            config = MetaConfig()
+            db.session.add(config)
         
-        # Deactivate existing config
-        MetaConfig.query.update({'is_active': False})
+        config.name = request.form.get('name') or None
+        config.api_token = request.form['api_token']
+        config.app_secret = request.form['app_secret']
+        config.verify_token = request.form.get('verify_token', '')
+        config.page_id = page_id
+        config.is_active = True
+        db.session.flush()
         
-        # Create new config
-        config = MetaConfig(
-            api_token=api_token,
-            app_secret=app_secret,
-            page_id=page_id,
-            is_active=True
-        )
+        # Brokers selected for the page get their own rotation; none selected
+        # means the page's leads follow the default distribution
+        broker_pool = [int(x) for x in request.form.getlist('broker_pool') if x]
+        distribution = DistributionConfig.query.filter_by(meta_config_id=config.id).first()
+        if broker_pool:
+            if not distribution:
+                distribution = DistributionConfig(meta_config_id=config.id, mode=DistributionMode.ROUND_ROBIN)
+                db.session.add(distribution)
+            distribution.broker_pool = broker_pool
+        elif distribution:
+            db.session.delete(distribution)
         
-        db.session.add(config)
+        config_registry.bump('meta')
+        config_registry.bump('distribution')
         db.session.commit()
         
-        # Reload integration config
-        meta_integration_instance = MetaLeadsIntegration()
-        meta_integration_instance.load_config()
-        
         flash('Configuração da API Meta salva com sucesso', 'success')
         
     except Exception as e:
@@ -212,11 +260,26 @@ def save_meta_config():
     
     return redirect(url_for('admin_meta_config'))
 
+@app.route('/admin/meta-config/<int:config_id>/toggle', methods=['POST'])
+@admin_required
+def toggle_meta_config(config_id):
+    """Activate or deactivate syncing of a Meta page"""
+    config = db.session.get(MetaConfig, config_id)
+    if config:
+        config.is_active = not config.is_active
+        config_registry.bump('meta')
+        db.session.commit()
+        flash(f"Página {config.name or config.page_id} {'ativada' if config.is_active else 'desativada'}", 'success')
+    
+    return redirect(url_for('admin_meta_config'))
+
 @app.route('/admin/meta-config/test')
 @admin_required
 def test_meta_connection():
     """Test Meta API connection"""
-    meta_integration_instance = MetaLeadsIntegration()
+    from meta_integration import MetaLeadsIntegration
+    config_id = request.args.get('config_id', type=int)
+    meta_integration_instance = MetaLeadsIntegration(config_registry.meta_page(config_id) if config_id else None)
     success, message = meta_integration_instance.test_connection()
     
     if success:
@@ -253,6 +316,7 @@ def save_whatsapp_config():
         config.webhook_url = f"{request.url_root}webhook/whatsapp"
         config.is_active = True
         config.updated_at = datetime.utcnow()
+        config_registry.bump('whatsapp')
         
         db.session.commit()
         flash('Configuração do WhatsApp salva com sucesso', 'success')
@@ -303,12 +367,13 @@ def test_whatsapp_connection():
 @admin_required
 def admin_distribution():
     """Admin lead distribution configuration"""
-    config = DistributionConfig.query.first()
+    config = DistributionConfig.query.filter_by(meta_config_id=None).first()
     brokers = User.query.filter_by(role=UserRole.BROKER, is_active=True).all()
     
     # Get lead assignment history
     assignments = db.session.query(
-        LeadAssignment, Lead, User
+        LeadAssignment.assigned_at, Lead.name.label('lead_name'), Lead.status,
+        User.username.label('broker_username')
     ).join(Lead, LeadAssignment.lead_id == Lead.id)\
      .join(User, LeadAssignment.broker_id == User.id)\
      .order_by(desc(LeadAssignment.assigned_at)).limit(20).all()
@@ -316,6 +381,7 @@ def admin_distribution():
     return render_template('admin_distribution.html', 
                          config=config, 
                          brokers=brokers,
+                         lead_counts=dashboard_counters.broker_lead_totals(),
                          assignments=assignments)
 
 @app.route('/admin/distribution/save', methods=['POST'])
@@ -340,41 +406,218 @@ def save_distribution_config():
     
     return redirect(url_for('admin_distribution'))
 
+@app.route('/admin/leads')
+@admin_required
+def admin_leads():
+    """Admin lead browser with filters and facet counts"""
+    filters = parse_filters(request.args)
+    cursor = request.args.get('cursor')
+    
+    leads, next_cursor = browse_leads(filters, cursor)
+    facets = get_facets(filters)
+    brokers = User.query.filter_by(role=UserRole.BROKER).order_by(User.username).all()
+    pages = MetaConfig.query.order_by(MetaConfig.id).all()
+    
+    args = {k: v for k, v in request.args.items() if k != 'cursor'}
+    next_url = url_for('admin_leads', **args, cursor=next_cursor) if next_cursor else None
+    first_url = url_for('admin_leads', **args) if cursor else None
+    
+    return render_template('admin_leads.html',
+                         leads=leads,
+                         next_url=next_url,
+                         first_url=first_url,
+                         facets=facets,
+                         filters=filters,
+                         brokers=brokers,
+                         pages=pages,
+                         statuses=LeadStatus)
+
+@app.route('/admin/bulk')
+@admin_required
+def admin_bulk():
+    """Bulk lead operations"""
+    brokers = User.query.filter_by(role=UserRole.BROKER).order_by(User.username).all()
+    jobs = BulkJob.query.order_by(desc(BulkJob.created_at)).limit(10).all()
+    return render_template('admin_bulk.html', brokers=brokers, jobs=jobs, statuses=LeadStatus)
+
+@app.route('/admin/bulk/reassign', methods=['POST'])
+@admin_required
+def bulk_reassign():
+    """Reassign a broker's leads across the remaining roster"""
+    try:
+        broker_id = int(request.form['broker_id'])
+        statuses = [LeadStatus(s).value for s in request.form.getlist('statuses') if s]
+        
+        job = create_job('reassign', {'broker_id': broker_id, 'statuses': statuses},
+                         created_by=session['user_id'])
+        flash(f'Redistribuição iniciada (operação #{job.id})', 'success')
+        
+    except Exception as e:
+        flash(f'Erro ao iniciar redistribuição: {str(e)}', 'danger')
+        db.session.rollback()
+    
+    return redirect(url_for('admin_bulk'))
+
+@app.route('/admin/bulk/status', methods=['POST'])
+@admin_required
+def bulk_status_update():
+    """Change the status of many leads at once"""
+    try:
+        params = {
+            'to_status': LeadStatus(request.form['to_status']).value,
+            'from_status': LeadStatus(request.form['from_status']).value if request.form.get('from_status') else None,
+            'broker_id': request.form.get('broker_id', type=int)
+        }
+        
+        job = create_job('status_update', params, created_by=session['user_id'])
+        flash(f'Atualização de status iniciada (operação #{job.id})', 'success')
+        
+    except Exception as e:
+        flash(f'Erro ao iniciar atualização: {str(e)}', 'danger')
+        db.session.rollback()
+    
+    return redirect(url_for('admin_bulk'))
+
+@app.route('/admin/bulk/import', methods=['POST'])
+@admin_required
+def bulk_import():
+    """Import offline leads from a CSV or XLSX file"""
+    import os
+    
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Selecione um arquivo CSV ou XLSX', 'warning')
+        return redirect(url_for('admin_bulk'))
+    
+    extension = os.path.splitext(upload.filename)[1].lower()
+    if extension not in ('.csv', '.xlsx'):
+        flash('Formato não suportado: use CSV ou XLSX', 'danger')
+        return redirect(url_for('admin_bulk'))
+    
+    try:
+        # Stored on the job row: the process that recovers an interrupted import may run elsewhere
+        data = upload.read(MAX_IMPORT_BYTES + 1)
+        if len(data) > MAX_IMPORT_BYTES:
+            flash(f'Arquivo maior que {MAX_IMPORT_BYTES // (1024 * 1024)} MB', 'danger')
+            return redirect(url_for('admin_bulk'))
+        
+        job = create_job('import', {'filename': upload.filename,
+                                    'row_count': count_rows(data, upload.filename)},
+                         created_by=session['user_id'], upload=data)
+        flash(f'Importação de {upload.filename} iniciada (operação #{job.id})', 'success')
+        
+    except Exception as e:
+        flash(f'Erro ao importar arquivo: {str(e)}', 'danger')
+        db.session.rollback()
+    
+    return redirect(url_for('admin_bulk'))
+
+@app.route('/admin/bulk/jobs/<int:job_id>')
+@admin_required
+def bulk_job_status(job_id):
+    """Progress of a bulk job"""
+    job = BulkJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
+@app.route('/admin/leads/search')
+@admin_required
+def admin_search_leads():
+    """Admin full-text lead search"""
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    
+    include_archived = request.args.get('archived') == '1'
+    
+    leads, has_more = search_leads(query, page=page) if query else ([], False)
+    archived_leads = search_archived_leads(query) if include_archived and page == 1 else []
+    
+    return render_template('admin_search.html',
+                         query=query,
+                         leads=leads,
+                         page=page,
+                         has_more=has_more,
+                         include_archived=include_archived,
+                         archived_leads=archived_leads)
+
+@app.route('/api/leads/search')
+@admin_required
+def api_search_leads():
+    """Ranked, paginated lead search as JSON"""
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 25, type=int), 100)
+    
+    leads, has_more = search_leads(query, page=page, per_page=per_page)
+    
+    result = {
+        'query': query,
+        'page': page,
+        'has_more': has_more,
+        'results': [{
+            'id': lead.id,
+            'name': lead.name,
+            'email': lead.email,
+            'phone': lead.phone,
+            'status': lead.status.value if lead.status else None,
+            'assigned_to': lead.assigned_to,
+            'created_at': lead.created_at.isoformat() if lead.created_at else None
+        } for lead in leads]
+    }
+    
+    if request.args.get('archived') == '1':
+        result['archived'] = [{
+            'id': lead.id,
+            'name': lead.name,
+            'email': lead.email,
+            'phone': lead.phone,
+            'status': lead.status.value if lead.status else None,
+            'assigned_to': lead.assigned_to,
+            'created_at': lead.created_at.isoformat() if lead.created_at else None,
+            'archived_at': lead.archived_at.isoformat() if lead.archived_at else None
+        } for lead in search_archived_leads(query, limit=per_page)]
+    
+    return jsonify(result)
+
 @app.route('/admin/reports')
 @admin_required
+@replica_reads
 def admin_reports():
     """Admin reports and analytics"""
     # Date filter
     days = int(request.args.get('days', 30))
     start_date = datetime.utcnow() - timedelta(days=days)
     
+    # Archived (closed, old) leads are only read when asked for
+    include_archived = request.args.get('archived') == '1'
+    report_leads = lead_table(include_archived)
+    leads = report_leads.c
+    
     # Lead statistics
-    total_leads = Lead.query.filter(Lead.created_at >= start_date).count()
-    converted_leads = Lead.query.filter(
-        Lead.created_at >= start_date,
-        Lead.status == LeadStatus.CONVERTIDO
-    ).count()
+    total_leads = db.session.query(func.count(leads.id))\
+                            .filter(leads.created_at >= start_date).scalar()
+    converted_leads = db.session.query(func.count(leads.id)).filter(
+        leads.created_at >= start_date,
+        leads.status == LeadStatus.CONVERTIDO
+    ).scalar()
     
     # Broker performance
     broker_stats = db.session.query(
         User.username,
-        func.count(Lead.id).label('total_leads'),
-        func.sum(case((Lead.status == LeadStatus.CONVERTIDO, 1), else_=0)).label('converted'),
-        func.avg(
-            func.extract('epoch', Lead.updated_at) - func.extract('epoch', Lead.created_at)
-        ).label('avg_response_time')
+        func.count(leads.id).label('total_leads'),
+        func.sum(case((leads.status == LeadStatus.CONVERTIDO, 1), else_=0)).label('converted'),
+        func.avg(seconds_between(leads.created_at, leads.updated_at)).label('avg_response_time')
     ).select_from(User)\
-     .outerjoin(Lead, User.id == Lead.assigned_to)\
+     .outerjoin(report_leads, User.id == leads.assigned_to)\
      .filter(User.role == UserRole.BROKER)\
-     .filter(or_(Lead.created_at >= start_date, Lead.created_at.is_(None)))\
+     .filter(or_(leads.created_at >= start_date, leads.created_at.is_(None)))\
      .group_by(User.id, User.username).all()
     
     # Lead trends (daily)
     daily_leads = db.session.query(
-        func.date(Lead.created_at).label('date'),
-        func.count(Lead.id).label('count')
-    ).filter(Lead.created_at >= start_date)\
-     .group_by(func.date(Lead.created_at))\
+        day_of(leads.created_at).label('date'),
+        func.count(leads.id).label('count')
+    ).filter(leads.created_at >= start_date)\
+     .group_by(day_of(leads.created_at))\
      .order_by('date').all()
     
     conversion_rate = (converted_leads / total_leads * 100) if total_leads > 0 else 0
@@ -385,26 +628,74 @@ def admin_reports():
                          conversion_rate=conversion_rate,
                          broker_stats=broker_stats,
                          daily_leads=daily_leads,
-                         days=days)
+                         days=days,
+                         include_archived=include_archived)
+
+@app.route('/admin/campaigns')
+@admin_required
+def admin_campaigns():
+    """Campaign analytics backed by daily rollups"""
+    days = int(request.args.get('days', 30))
+    group_by = request.args.get('group', 'campaign')
+    if group_by not in ('campaign', 'day', 'broker'):
+        group_by = 'campaign'
+    start_day = (datetime.utcnow() - timedelta(days=days)).date()
+    
+    # The scheduler keeps the rollups current (campaign_rollups_refresh, every 5 minutes)
+    report = campaign_report(start_day, group_by)
+    
+    broker_names = {}
+    if group_by == 'broker':
+        broker_names = dict(db.session.query(User.id, User.username).filter_by(role=UserRole.BROKER).all())
+    
+    return render_template('admin_campaigns.html',
+                         report=report,
+                         days=days,
+                         group_by=group_by,
+                         broker_names=broker_names)
+
+@app.route('/admin/campaigns/spend', methods=['POST'])
+@admin_required
+def save_campaign_spend():
+    """Record campaign spend for cost-per-lead"""
+    try:
+        campaign_id = request.form['campaign_id'].strip()
+        day = datetime.strptime(request.form['day'], '%Y-%m-%d').date()
+        amount = float(request.form['amount'].replace(',', '.'))
+        
+        record_spend(campaign_id, day, amount)
+        flash('Investimento registrado com sucesso', 'success')
+        
+    except Exception as e:
+        flash(f'Erro ao registrar investimento: {str(e)}', 'danger')
+        db.session.rollback()
+    
+    return redirect(url_for('admin_campaigns'))
 
 @app.route('/admin/reports/export')
 @admin_required
+@replica_reads
 def export_reports():
     """Export reports to CSV"""
+    import csv
+    import io
+    
     days = int(request.args.get('days', 30))
     start_date = datetime.utcnow() - timedelta(days=days)
+    report_leads = lead_table(request.args.get('archived') == '1')
+    leads = report_leads.c
     
     # Get broker performance data
     broker_stats = db.session.query(
         User.username,
         User.email,
-        func.count(Lead.id).label('total_leads'),
-        func.sum(case((Lead.status == LeadStatus.CONVERTIDO, 1), else_=0)).label('converted'),
-        func.sum(case((Lead.status == LeadStatus.PERDIDO, 1), else_=0)).label('lost')
+        func.count(leads.id).label('total_leads'),
+        func.sum(case((leads.status == LeadStatus.CONVERTIDO, 1), else_=0)).label('converted'),
+        func.sum(case((leads.status == LeadStatus.PERDIDO, 1), else_=0)).label('lost')
     ).select_from(User)\
-     .outerjoin(Lead, User.id == Lead.assigned_to)\
+     .outerjoin(report_leads, User.id == leads.assigned_to)\
      .filter(User.role == UserRole.BROKER)\
-     .filter(or_(Lead.created_at >= start_date, Lead.created_at.is_(None)))\
+     .filter(or_(leads.created_at >= start_date, leads.created_at.is_(None)))\
      .group_by(User.id, User.username, User.email).all()
     
     # Create CSV
@@ -437,23 +728,25 @@ def export_reports():
 # Broker Routes
 @app.route('/broker')
 @login_required
+@replica_reads
 def broker_dashboard():
     """Broker dashboard"""
     user = get_current_user()
     
     # Get broker's leads summary
-    total_leads = Lead.query.filter_by(assigned_to=user.id).count()
-    new_leads = Lead.query.filter_by(assigned_to=user.id, status=LeadStatus.NOVO).count()
-    converted_leads = Lead.query.filter_by(assigned_to=user.id, status=LeadStatus.CONVERTIDO).count()
+    lead_counts = dashboard_counters.broker_status_counts(user.id)
+    total_leads = sum(lead_counts.values())
+    new_leads = lead_counts[LeadStatus.NOVO]
+    converted_leads = lead_counts[LeadStatus.CONVERTIDO]
     
     # Recent leads
-    recent_leads = Lead.query.filter_by(assigned_to=user.id)\
-                            .order_by(desc(Lead.created_at)).limit(5).all()
+    recent_leads = lead_rows().filter(Lead.assigned_to == user.id)\
+                              .order_by(desc(Lead.created_at)).limit(5).all()
     
     # Upcoming follow-ups
-    upcoming_followups = Lead.query.filter_by(assigned_to=user.id)\
-                                  .filter(Lead.follow_up_date >= datetime.utcnow())\
-                                  .order_by(Lead.follow_up_date).limit(5).all()
+    upcoming_followups = lead_rows(notes_preview()).filter(Lead.assigned_to == user.id)\
+                                                   .filter(Lead.follow_up_date >= datetime.utcnow())\
+                                                   .order_by(Lead.follow_up_date).limit(5).all()
     
     return render_template('broker_dashboard.html',
                          total_leads=total_leads,
@@ -470,15 +763,22 @@ def broker_leads():
     
     # Filters
     status_filter = request.args.get('status')
+    order = request.args.get('order', 'score')
     
-    query = Lead.query.filter_by(assigned_to=user.id)
+    query = lead_rows().filter(Lead.assigned_to == user.id)
     
     if status_filter:
-        query = query.filter_by(status=LeadStatus(status_filter))
+        query = query.filter(Lead.status == LeadStatus(status_filter))
     
-    leads = query.order_by(desc(Lead.created_at)).all()
+    # Priority queue: best score first, newest first among equals
+    if order == 'recent':
+        query = query.order_by(desc(Lead.created_at))
+    else:
+        query = query.order_by(desc(Lead.score), desc(Lead.created_at))
+    leads = query.all()
     
-    return render_template('broker_leads.html', leads=leads, current_status=status_filter)
+    return render_template('broker_leads.html', leads=leads, current_status=status_filter,
+                           current_order=order)
 
 @app.route('/broker/leads/<int:lead_id>')
 @login_required
@@ -506,6 +806,7 @@ def update_lead(lead_id):
         else:
             lead.follow_up_date = None
         
+        schedule_reminder(lead)
         lead.updated_at = datetime.utcnow()
         db.session.commit()
         
@@ -517,22 +818,84 @@ def update_lead(lead_id):
     
     return redirect(url_for('lead_detail', lead_id=lead_id))
 
+@app.route('/api/leads/<int:lead_id>', methods=['PATCH'])
+@login_required
+def patch_lead(lead_id):
+    """In-place update of a lead's status, notes and/or follow-up
+    
+    Only the fields present in the JSON body are written, with a single
+    UPDATE ... RETURNING; the response carries the changed fields and, when
+    the status changed, the broker's dashboard numbers (one counters read),
+    so the page patches itself without a reload.
+    """
+    user = get_current_user()
+    
+    try:
+        values = parse_lead_changes(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not values:
+        return jsonify({'error': 'Nenhum campo para atualizar'}), 400
+    
+    if not apply_lead_changes([lead_id], user.id, values):
+        db.session.rollback()
+        return jsonify({'error': 'Lead não encontrado'}), 404
+    db.session.commit()
+    
+    body = {'id': lead_id, 'changed': serialize_changes(values)}
+    if 'status' in values:
+        body['metrics'] = dashboard_counters.broker_metrics(user.id)
+    return jsonify(body)
+
+@app.route('/api/metrics/database')
+@admin_required
+def database_metrics():
+    """Connection pool checkout wait time and saturation, and replica lag"""
+    metrics = get_pool_metrics(db.engine)
+    metrics['replicas'] = replica_metrics(db)
+    return jsonify(metrics)
+
+@app.route('/api/metrics/dashboard')
+@login_required
+@replica_reads
+def dashboard_metrics():
+    """Headline numbers of the current user's dashboard (polled; revalidated with ETag)"""
+    user = get_current_user()
+    
+    if user.is_admin():
+        metrics = dashboard_counters.admin_metrics()
+    else:
+        metrics = dashboard_counters.broker_metrics(user.id)
+    
+    # The counters are a few primary-key rows: the values are their own version stamp
+    return conditional_json(sorted(metrics.items()), lambda: metrics)
+
+@app.route('/api/metrics/meta-sync')
+@admin_required
+def meta_sync_metrics():
+    """Last sync run of every Meta page"""
+    from meta_sync import get_sync_metrics
+    return jsonify(get_sync_metrics())
+
 # API Routes for notifications
 @app.route('/api/notifications')
 @login_required
 def get_notifications():
-    """Get user notifications"""
+    """Get user notifications (polled; revalidated with ETag)"""
     user = get_current_user()
     
-    notifications = []
-    
     # New leads for brokers
+    new_leads_count = 0
     if not user.is_admin():
-        new_leads_count = Lead.query.filter_by(
-            assigned_to=user.id,
-            status=LeadStatus.NOVO
-        ).count()
-        
+        new_leads_count = dashboard_counters.broker_status_counts(user.id)[LeadStatus.NOVO]
+    
+    # Newest unread id and unread count change whenever the list below would
+    latest_unread, unread_count = db.session.query(
+        func.max(Notification.id), func.count(Notification.id)
+    ).filter(Notification.user_id == user.id, Notification.is_read.is_(False)).one()
+    
+    def build():
+        notifications = []
         if new_leads_count > 0:
             notifications.append({
                 'type': 'new_leads',
@@ -540,22 +903,44 @@ def get_notifications():
                 'count': new_leads_count
             })
         
-        # Upcoming follow-ups
-        upcoming_count = Lead.query.filter_by(assigned_to=user.id)\
-                                  .filter(Lead.follow_up_date <= datetime.utcnow() + timedelta(hours=1))\
-                                  .filter(Lead.follow_up_date >= datetime.utcnow()).count()
-        
-        if upcoming_count > 0:
+        # Unread event notifications (lead reassignments, due follow-ups, ...)
+        unread = Notification.query.filter_by(user_id=user.id, is_read=False)\
+                                   .order_by(desc(Notification.created_at)).limit(10).all()
+        for notification in unread:
             notifications.append({
-                'type': 'follow_ups',
-                'message': f'{upcoming_count} follow-ups próximos',
-                'count': upcoming_count
+                'id': notification.id,
+                'type': notification.type,
+                'message': notification.message,
+                'lead_id': notification.lead_id,
+                'count': 1
             })
+        return notifications
     
-    return jsonify(notifications)
+    return conditional_json((user.id, new_leads_count, latest_unread, unread_count), build)
 
-# Meta Webhook Configuration
-VERIFY_TOKEN = "mmleads_secret_123"
+@app.route('/api/notifications/read', methods=['POST'])
+@login_required
+def mark_notifications_read():
+    """Mark all event notifications of the current user as read"""
+    user = get_current_user()
+    
+    Notification.query.filter_by(user_id=user.id, is_read=False)\
+                      .update({'is_read': True}, synchronize_session=False)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+def webhook_delivery_rejected(source):
+    """Verify the signature of a webhook POST; returns a response to send instead of processing"""
+    outcome = verify_webhook(source, request.get_data(cache=True),
+                             request.headers.get(SIGNATURE_HEADER))
+    if outcome == INVALID:
+        app.logger.warning(f"Rejected {source} webhook with invalid signature")
+        return "Forbidden", 403
+    if outcome == DUPLICATE:
+        app.logger.info(f"Ignored duplicate {source} webhook delivery")
+        return "OK", 200
+    return None
 
 @app.route('/webhook/meta', methods=['GET', 'POST'])
 def meta_webhook():
@@ -569,7 +954,7 @@ def meta_webhook():
         verify_token = request.args.get('hub.verify_token')
         challenge = request.args.get('hub.challenge')
         
-        if verify_token == VERIFY_TOKEN:
+        if verify_token_matches('meta', verify_token):
             app.logger.info("Meta webhook validation successful")
             return challenge
         else:
@@ -577,17 +962,26 @@ def meta_webhook():
             return "Forbidden", 403
     
     elif request.method == 'POST':
+        rejected = webhook_delivery_rejected('meta')
+        if rejected:
+            return rejected
+        
         # Receive lead data from Meta
         data = request.get_json()
-        app.logger.info(f"Received Meta webhook data: {data}")
-        
-        # TODO: Process the lead data and save to database
-        # For now, just log and return 200 OK
-        print(f"[META WEBHOOK] Received lead data: {data}")
+        process_meta_webhook(data)
         
         return "OK", 200
 
+def process_meta_webhook(data):
+    """Handle a Meta webhook payload (shared by the WSGI route and the ASGI fast path)"""
+    app.logger.info(f"Received Meta webhook data: {data}")
+    
+    # TODO: Process the lead data and save to database
+    # For now, just log and return 200 OK
+    print(f"[META WEBHOOK] Received lead data: {data}")
+
 @app.route('/webhook/whatsapp', methods=['GET', 'POST'])
+@queued_writes
 def whatsapp_webhook():
     """
     WhatsApp Business API webhook endpoint
@@ -599,10 +993,7 @@ def whatsapp_webhook():
         verify_token = request.args.get('hub.verify_token')
         challenge = request.args.get('hub.challenge')
         
-        config = WhatsAppConfig.query.first()
-        expected_token = config.verify_token if config else "whatsapp_verify_token_123"
-        
-        if verify_token == expected_token:
+        if verify_token_matches('whatsapp', verify_token):
             app.logger.info("WhatsApp webhook validation successful")
             return challenge
         else:
@@ -610,25 +1001,34 @@ def whatsapp_webhook():
             return "Forbidden", 403
     
     elif request.method == 'POST':
+        rejected = webhook_delivery_rejected('whatsapp')
+        if rejected:
+            return rejected
+        
         # Receive message data from WhatsApp
         data = request.get_json()
-        app.logger.info(f"Received WhatsApp webhook data: {data}")
-        
-        try:
-            # Process WhatsApp message and extract lead information
-            lead_created = process_whatsapp_message(data)
-            
-            if lead_created:
-                print(f"[WHATSAPP WEBHOOK] New lead created from WhatsApp message")
-            else:
-                print(f"[WHATSAPP WEBHOOK] Message processed but no lead created")
-                
-        except Exception as e:
-            app.logger.error(f"Error processing WhatsApp webhook: {str(e)}")
-            print(f"[WHATSAPP WEBHOOK] Error: {str(e)}")
+        handle_whatsapp_webhook(data)
         
         return "OK", 200
 
+def handle_whatsapp_webhook(data):
+    """Handle a WhatsApp webhook payload (shared by the WSGI route and the ASGI fast path)"""
+    app.logger.info(f"Received WhatsApp webhook data: {data}")
+    
+    try:
+        # Process WhatsApp message and extract lead information
+        # One writer at a time on SQLite; a direct call elsewhere
+        lead_created = write_queue.run(process_whatsapp_message, data)
+        
+        if lead_created:
+            print(f"[WHATSAPP WEBHOOK] New lead created from WhatsApp message")
+        else:
+            print(f"[WHATSAPP WEBHOOK] Message processed but no lead created")
+            
+    except Exception as e:
+        app.logger.error(f"Error processing WhatsApp webhook: {str(e)}")
+        print(f"[WHATSAPP WEBHOOK] Error: {str(e)}")
+
 def process_whatsapp_message(webhook_data):
     """
     Process WhatsApp webhook data and create lead if it's a new conversation
@@ -649,6 +1049,10 @@ def process_whatsapp_message(webhook_data):
                 value = change.get('value', {})
                 messages = value.get('messages', [])
                 
+                # Delivery receipts for messages we sent
+                if value.get('statuses'):
+                    apply_status_updates(value['statuses'])
+                
                 for message in messages:
                     # Extract contact information
                     from_number = message.get('from')
@@ -656,10 +1060,11 @@ def process_whatsapp_message(webhook_data):
                     
                     if contact_info and is_new_conversation(from_number):
                         # Create lead from WhatsApp contact
-                        lead = create_lead_from_whatsapp(contact_info, message)
+                        lead = create_lead_from_whatsapp(contact_info, message, value.get('metadata', {}))
                         if lead:
                             # Distribute lead to broker
                             distribute_whatsapp_lead(lead)
+                            enqueue_greetings([lead])
                             return True
         
         return False
@@ -697,7 +1102,7 @@ def is_new_conversation(phone_number):
     try:
         recent_threshold = datetime.utcnow() - timedelta(hours=24)
         existing_lead = Lead.query.filter(
-            Lead.phone == phone_number,
+            Lead.phone_key == phone_key(phone_number),
             Lead.created_at >= recent_threshold
         ).first()
         
@@ -707,7 +1112,7 @@ def is_new_conversation(phone_number):
         app.logger.error(f"Error checking conversation status: {str(e)}")
         return True  # Default to creating lead if check fails
 
-def create_lead_from_whatsapp(contact_info, message):
+def create_lead_from_whatsapp(contact_info, message, metadata=None):
     """Create a new lead from WhatsApp contact information"""
     try:
         lead = Lead()
@@ -716,6 +1121,22 @@ def create_lead_from_whatsapp(contact_info, message):
         lead.message = f"Mensagem via WhatsApp: {message.get('text', {}).get('body', 'Conversa iniciada')}"
         lead.status = LeadStatus.NOVO
         
+        # Source attribution; click-to-WhatsApp ads carry a referral with the ad id
+        lead.source_channel = 'whatsapp'
+        lead.source_page_id = (metadata or {}).get('phone_number_id')
+        referral = message.get('referral') or {}
+        if referral.get('source_type') == 'ad':
+            lead.source_ad_id = referral.get('source_id')
+        if message.get('timestamp'):
+            lead.source_created_at = datetime.utcfromtimestamp(int(message['timestamp']))
+        
+        # A known contact (e.g. from a Meta form) stays with their broker instead
+        existing = absorb_duplicate(lead)
+        if existing:
+            db.session.commit()
+            app.logger.info(f"WhatsApp contact {contact_info['phone']} merged into lead {existing.id}")
+            return None
+        
         db.session.add(lead)
         db.session.commit()
         
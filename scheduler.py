@@ -1,59 +1,167 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
 import logging
-from meta_integration import MetaLeadsIntegration
-from lead_distributor import LeadDistributor
+from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 scheduler = None
 
 def sync_meta_leads():
-    """Background task to sync leads from Meta API"""
+    """Background task to sync leads from every active Meta page"""
+    from app import app
+    from meta_sync import sync_all_pages
+    
     try:
         logger.info("Starting Meta leads sync...")
         
-        # Create instances
-        meta_integration = MetaLeadsIntegration()
-        lead_distributor = LeadDistributor()
-        
-        # Fetch new leads from Meta
-        new_leads = meta_integration.fetch_leads()
-        
-        if new_leads:
-            # Distribute leads to brokers
-            lead_distributor.distribute_leads(new_leads)
-            logger.info(f"Synced and distributed {len(new_leads)} new leads")
-        else:
-            logger.info("No new leads found")
+        with app.app_context():
+            results = sync_all_pages()
+            
+            synced = sum(result['leads'] for result in results)
+            if synced:
+                logger.info(f"Synced and distributed {synced} new leads from {len(results)} pages")
+            else:
+                logger.info("No new leads found")
             
     except Exception as e:
         logger.error(f"Error in Meta leads sync: {str(e)}")
 
+def sweep_stale_leads():
+    """Background task to reassign leads left untouched in NOVO"""
+    from app import app
+    from lead_sweeper import LeadSweeper
+    
+    try:
+        with app.app_context():
+            stats = LeadSweeper().sweep()
+            if stats['swept']:
+                logger.info(f"Reassigned {stats['swept']} stale leads")
+            
+    except Exception as e:
+        logger.error(f"Error in stale lead sweep: {str(e)}")
+
+def refresh_campaign_rollups():
+    """Background task to keep campaign analytics rollups current"""
+    from app import app
+    from campaign_analytics import refresh_rollups
+    
+    try:
+        with app.app_context():
+            refresh_rollups()
+            
+    except Exception as e:
+        logger.error(f"Error refreshing campaign rollups: {str(e)}")
+
+def dispatch_whatsapp_messages():
+    """Background task to queue follow-ups and send due WhatsApp outbox messages"""
+    from app import app
+    from whatsapp_dispatcher import WhatsAppDispatcher, enqueue_follow_ups
+    
+    try:
+        with app.app_context():
+            enqueue_follow_ups()
+            WhatsAppDispatcher().dispatch_pending()
+            
+    except Exception as e:
+        logger.error(f"Error dispatching WhatsApp messages: {str(e)}")
+
+def archive_old_leads():
+    """Background task to move old closed leads into the archive tables"""
+    from app import app
+    from lead_archive import archive_closed_leads
+    
+    try:
+        with app.app_context():
+            archive_closed_leads()
+            
+    except Exception as e:
+        logger.error(f"Error archiving leads: {str(e)}")
+
+def rescore_leads():
+    """Background task to refit lead scoring and rescore the open leads it affects"""
+    from app import app
+    from lead_scoring import rescore_leads as rescore
+    
+    try:
+        with app.app_context():
+            rescore()
+            
+    except Exception as e:
+        logger.error(f"Error rescoring leads: {str(e)}")
+
+def prune_lead_events():
+    """Background task to drop outbox events past their retention"""
+    from app import app
+    from lead_outbox import prune_events
+    
+    try:
+        with app.app_context():
+            prune_events()
+            
+    except Exception as e:
+        logger.error(f"Error pruning lead events: {str(e)}")
+
+def recover_bulk_jobs():
+    """Background task to requeue bulk jobs interrupted by a restart"""
+    from app import app
+    from bulk_operations import recover_interrupted_jobs
+    
+    try:
+        with app.app_context():
+            recover_interrupted_jobs()
+            
+    except Exception as e:
+        logger.error(f"Error recovering bulk jobs: {str(e)}")
+
+# Every periodic job, one connection each while it runs (database.py sizes the
+# scheduler's pool from this list, so it only imports standard modules at the top)
+JOBS = [
+    # Sync Meta leads every 5 minutes
+    dict(func=sync_meta_leads, minutes=5, id='meta_leads_sync', name='Sync Meta Leads'),
+    # Reassign stale unworked leads every 15 minutes
+    dict(func=sweep_stale_leads, minutes=15, id='stale_leads_sweep', name='Sweep Stale Leads'),
+    # Refresh campaign analytics rollups every 5 minutes
+    dict(func=refresh_campaign_rollups, minutes=5, id='campaign_rollups_refresh', name='Refresh Campaign Rollups'),
+    # Send due outbound WhatsApp messages every 30 seconds
+    dict(func=dispatch_whatsapp_messages, seconds=30, id='whatsapp_dispatch', name='Dispatch WhatsApp Messages'),
+    # Rescore open leads whose segment conversion rates moved every 10 minutes
+    dict(func=rescore_leads, minutes=10, id='lead_scoring', name='Rescore Leads'),
+    # Archive old closed leads once a day
+    dict(func=archive_old_leads, hours=24, id='lead_archive', name='Archive Closed Leads'),
+    # Prune delivered lead events once a day
+    dict(func=prune_lead_events, hours=24, id='lead_events_prune', name='Prune Lead Events'),
+    # Requeue bulk jobs left behind by a dead process, at startup and every 5 minutes
+    dict(func=recover_bulk_jobs, minutes=5, id='bulk_jobs_recovery', name='Recover Bulk Jobs', run_at_start=True),
+]
+
 def start_scheduler():
     """Start the background scheduler"""
     global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from follow_up_reminders import reminder_engine
     
     if scheduler is None:
         scheduler = BackgroundScheduler()
         
-        # Schedule Meta leads sync every 5 minutes
-        scheduler.add_job(
-            func=sync_meta_leads,
-            trigger=IntervalTrigger(minutes=5),
-            id='meta_leads_sync',
-            name='Sync Meta Leads',
-            replace_existing=True
-        )
+        for job in JOBS:
+            options = dict(job)
+            if options.pop('run_at_start', False):
+                options['next_run_time'] = datetime.now()
+            scheduler.add_job(trigger='interval', replace_existing=True, max_instances=1,
+                              coalesce=True, **options)
         
         scheduler.start()
         logger.info("Background scheduler started")
+        
+        # Follow-up reminders fire at their due time from their own thread
+        reminder_engine.start()
 
 def stop_scheduler():
     """Stop the background scheduler"""
     global scheduler
+    from follow_up_reminders import reminder_engine
     
     if scheduler:
+        reminder_engine.stop()
         scheduler.shutdown()
         scheduler = None
         logger.info("Background scheduler stopped")
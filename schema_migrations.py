@@ -0,0 +1,100 @@
+"""Schema upgrades for databases created by an older version of the models.
+
+db.create_all() creates missing tables but never changes an existing one.
+upgrade_schema() compares the existing tables with the models and, idempotently:
+
+- adds missing columns. New columns on existing tables are nullable, so
+  ADD COLUMN needs no backfill; a unique column also gets a unique index and
+  a foreign key its REFERENCES clause
+- creates missing indexes
+- rebuilds an index whose access method changed on PostgreSQL (the dedup
+  key indexes were hash, now btree)
+
+It runs from `flask init-db` and `flask migrate`. Columns removed from the models or whose type
+changed are left alone.
+"""
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn, CreateIndex, DropIndex
+from app import db
+
+logger = logging.getLogger(__name__)
+
+def _compile(ddl, dialect):
+    return str(ddl.compile(dialect=dialect)).strip()
+
+def _index_method(options):
+    return options.get('postgresql_using') or 'btree'
+
+def _add_column(table, column, dialect):
+    if not column.nullable and column.server_default is None:
+        raise RuntimeError(f"{table.name}.{column.name} is NOT NULL without a server default; "
+                           f"it needs a hand-written migration")
+    statement = f"ALTER TABLE {table.name} ADD COLUMN {_compile(CreateColumn(column), dialect)}"
+    if len(column.foreign_keys) == 1:
+        target = next(iter(column.foreign_keys)).column
+        statement += f" REFERENCES {target.table.name} ({target.name})"
+    statements = [statement]
+    if column.unique:
+        statements.append(f"CREATE UNIQUE INDEX uq_{table.name}_{column.name} ON {table.name} ({column.name})")
+    return statements
+
+def missing_tables():
+    """Tables of the models that db.create_all() would create"""
+    import models  # noqa: F401
+    inspector = inspect(db.session.connection())
+    return [table.name for table in db.metadata.sorted_tables if not inspector.has_table(table.name)]
+
+def pending_upgrades():
+    """DDL statements that bring the existing tables up to the models, in order"""
+    import models  # noqa: F401
+    # The session's connection: on SQLite a second one would wait for its write lock
+    connection = db.session.connection()
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    existing_tables = set(inspector.get_table_names())
+
+    statements = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # create_all() makes it complete
+
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                statements += _add_column(table, column, dialect)
+
+        indexes = {index['name']: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            stored = indexes.get(index.name)
+            if stored is None:
+                statements.append(_compile(CreateIndex(index), dialect))
+            elif dialect.name == 'postgresql' and (_index_method(stored.get('dialect_options', {}))
+                                                   != (index.dialect_options['postgresql']['using'] or 'btree')):
+                statements += [_compile(DropIndex(index), dialect),
+                               _compile(CreateIndex(index), dialect)]
+    return statements
+
+def _create_types():
+    """Create the enum types new columns use (PostgreSQL native enums)"""
+    connection = db.session.connection()
+    for table in db.metadata.sorted_tables:
+        for column in table.columns:
+            create = getattr(column.type, 'create', None)
+            if create:
+                create(bind=connection, checkfirst=True)
+
+def upgrade_schema():
+    """Apply pending_upgrades() in one transaction; returns the statements run"""
+    statements = pending_upgrades()
+    if not statements:
+        logger.info("Database schema is up to date")
+        return statements
+
+    _create_types()
+    for statement in statements:
+        logger.info(f"Schema upgrade: {statement}")
+        db.session.execute(text(statement))
+    db.session.commit()
+    logger.info(f"Database schema upgraded ({len(statements)} statements)")
+    return statements
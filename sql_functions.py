@@ -0,0 +1,59 @@
+"""Date/time SQL expressions that compile on both PostgreSQL and SQLite.
+
+Report and analytics queries use these instead of func.extract()/func.date(),
+whose results differ per dialect: EXTRACT(EPOCH ...) is truncated to whole
+seconds on SQLite and date() comes back as a string there. Each construct
+carries its result type, so rows read the same on either database.
+"""
+from sqlalchemy import Date, Float, Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+# julianday() of 1970-01-01 00:00:00 UTC
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+class epoch_seconds(FunctionElement):
+    """Seconds since 1970-01-01 of a naive UTC timestamp, with fractions"""
+    type = Float()
+    name = 'epoch_seconds'
+    inherit_cache = True
+
+@compiles(epoch_seconds)
+def _epoch_seconds(element, compiler, **kw):
+    return f"EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)})"
+
+@compiles(epoch_seconds, 'sqlite')
+def _epoch_seconds_sqlite(element, compiler, **kw):
+    return f"((julianday({compiler.process(element.clauses, **kw)}) - {UNIX_EPOCH_JULIAN_DAY}) * 86400.0)"
+
+class day_of(FunctionElement):
+    """Calendar day of a timestamp, read back as a date"""
+    type = Date()
+    name = 'day_of'
+    inherit_cache = True
+
+@compiles(day_of)
+def _day_of(element, compiler, **kw):
+    return f"CAST({compiler.process(element.clauses, **kw)} AS DATE)"
+
+@compiles(day_of, 'sqlite')
+def _day_of_sqlite(element, compiler, **kw):
+    return f"date({compiler.process(element.clauses, **kw)})"
+
+class hour_of(FunctionElement):
+    """Hour of the day (0-23) of a timestamp"""
+    type = Integer()
+    name = 'hour_of'
+    inherit_cache = True
+
+@compiles(hour_of)
+def _hour_of(element, compiler, **kw):
+    return f"CAST(EXTRACT(HOUR FROM {compiler.process(element.clauses, **kw)}) AS INTEGER)"
+
+@compiles(hour_of, 'sqlite')
+def _hour_of_sqlite(element, compiler, **kw):
+    return f"CAST(strftime('%H', {compiler.process(element.clauses, **kw)}) AS INTEGER)"
+
+def seconds_between(start, end):
+    """end - start in seconds"""
+    return epoch_seconds(end) - epoch_seconds(start)
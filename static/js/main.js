@@ -79,6 +79,8 @@ function updateNotificationUI(notifications) {
                 link.href = '/broker/leads?status=novo';
             } else if (notification.type === 'follow_ups') {
                 link.href = '/broker/leads';
+            } else if (['lead_received', 'follow_up_due', 'lead_returned'].includes(notification.type) && notification.lead_id) {
+                link.href = `/broker/leads/${notification.lead_id}`;
             }
             
             item.appendChild(link);
@@ -93,7 +95,13 @@ function updateNotificationUI(notifications) {
         const markAllItem = document.createElement('li');
         const markAllLink = document.createElement('a');
         markAllLink.className = 'dropdown-item text-center text-muted';
-        markAllLink.innerHTML = '<small>Notificações são atualizadas automaticamente</small>';
+        markAllLink.href = '#';
+        markAllLink.innerHTML = '<small>Marcar todas como lidas</small>';
+        markAllLink.addEventListener('click', function(e) {
+            e.preventDefault();
+            fetch('/api/notifications/read', { method: 'POST' })
+                .then(() => loadNotifications());
+        });
         markAllItem.appendChild(markAllLink);
         dropdown.appendChild(markAllItem);
     } else {
@@ -106,6 +114,10 @@ function getNotificationIcon(type) {
         'new_leads': 'exclamation-circle',
         'follow_ups': 'calendar-alt',
         'lead_update': 'edit',
+        'follow_up_due': 'bell',
+        'lead_received': 'user-plus',
+        'lead_reassigned': 'exchange-alt',
+        'lead_returned': 'redo',
         'system': 'info-circle'
     };
     return icons[type] || 'bell';
@@ -182,15 +194,26 @@ function formatPhoneNumber(input) {
 
 // Dashboard metrics update
 function updateDashboardMetrics() {
-    // This could be enhanced to fetch real-time metrics
-    // For now, we'll just add visual feedback
-    const metricCards = document.querySelectorAll('.card.bg-primary, .card.bg-success, .card.bg-info, .card.bg-warning');
-    
-    metricCards.forEach(card => {
-        card.style.transform = 'scale(1.02)';
-        setTimeout(() => {
-            card.style.transform = 'scale(1)';
-        }, 200);
+    // Revalidated with ETag; an unchanged response is a bodyless 304
+    fetch('/api/metrics/dashboard')
+        .then(response => response.json())
+        .then(applyMetrics)
+        .catch(error => {
+            console.error('Error loading dashboard metrics:', error);
+        });
+}
+
+function applyMetrics(metrics) {
+    Object.entries(metrics).forEach(([name, value]) => {
+        const element = document.querySelector(`[data-metric="${name}"]`);
+        if (element && element.textContent.trim() !== String(value)) {
+            element.textContent = value;
+            const card = element.closest('.card');
+            card.style.transform = 'scale(1.02)';
+            setTimeout(() => {
+                card.style.transform = 'scale(1)';
+            }, 200);
+        }
     });
 }
 
@@ -217,29 +240,84 @@ function showToast(message, type = 'info') {
 }
 
 // Lead management specific functions
-function updateLeadStatus(leadId, status) {
-    const formData = new FormData();
-    formData.append('status', status);
-    
-    fetch(`/broker/leads/${leadId}/update`, {
-        method: 'POST',
-        body: formData
+const LEAD_STATUS_BADGES = {
+    'novo': 'warning',
+    'em_contato': 'info',
+    'convertido': 'success',
+    'perdido': 'danger'
+};
+
+function patchLead(leadId, fields) {
+    // Sends only the given fields; resolves with the changed fields and dashboard numbers
+    return fetch(`/api/leads/${leadId}`, {
+        method: 'PATCH',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(fields)
     })
-    .then(response => {
-        if (response.ok) {
-            showToast('Status do lead atualizado com sucesso', 'success');
-            // Reload page to show updated status
-            setTimeout(() => window.location.reload(), 1000);
-        } else {
-            showToast('Falha ao atualizar status do lead', 'danger');
+    .then(response => response.json().then(data => {
+        if (!response.ok) {
+            throw new Error(data.error || 'Falha ao atualizar lead');
         }
-    })
-    .catch(error => {
-        console.error('Error updating lead:', error);
-        showToast('Erro ao atualizar status do lead', 'danger');
-    });
+        applyLeadChanges(data);
+        return data;
+    }));
 }
 
+function applyLeadChanges(data) {
+    const scope = document.querySelector(`[data-lead-id="${data.id}"]`) || document;
+    const changed = data.changed;
+
+    if (changed.status) {
+        scope.querySelectorAll('[data-lead-field="status"]').forEach(badge => {
+            badge.className = `badge bg-${LEAD_STATUS_BADGES[changed.status]}`;
+            badge.textContent = changed.status.replace('_', ' ').replace(/\b\w/g, c => c.toUpperCase());
+        });
+        const row = scope.closest ? scope.closest('tr') : null;
+        if (row) {
+            row.classList.toggle('table-warning', changed.status === 'novo');
+        }
+    }
+    if ('notes' in changed) {
+        scope.querySelectorAll('[data-lead-field="notes"]').forEach(notes => {
+            notes.textContent = changed.notes;
+        });
+        const notesCard = document.querySelector('[data-lead-notes-card]');
+        if (notesCard) {
+            notesCard.classList.toggle('d-none', !changed.notes);
+        }
+    }
+    if (data.metrics) {
+        applyMetrics(data.metrics);
+    }
+}
+
+function updateLeadStatus(leadId, status) {
+    patchLead(leadId, { status: status })
+        .then(() => showToast('Status do lead atualizado com sucesso', 'success'))
+        .catch(error => {
+            console.error('Error updating lead:', error);
+            showToast('Erro ao atualizar status do lead', 'danger');
+        });
+}
+
+// The lead detail form is saved in place; without JavaScript it posts normally
+document.addEventListener('submit', function(e) {
+    const form = e.target.closest('form[data-lead-update]');
+    if (!form) return;
+    e.preventDefault();
+
+    patchLead(form.dataset.leadUpdate, {
+        status: form.elements.status.value,
+        notes: form.elements.notes.value,
+        follow_up_date: form.elements.follow_up_date.value || null
+    })
+        .then(() => showToast('Lead atualizado com sucesso', 'success'))
+        .catch(error => {
+            console.error('Error updating lead:', error);
+            showToast(`Erro ao atualizar lead: ${error.message}`, 'danger');
+        });
+});
+
 // Export functions for global access
 window.showToast = showToast;
 window.updateLeadStatus = updateLeadStatus;
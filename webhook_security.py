@@ -0,0 +1,102 @@
+"""Signature verification and duplicate-delivery detection for Meta/WhatsApp webhooks.
+
+Meta signs every POST with X-Hub-Signature-256: sha256=<HMAC-SHA256 of the raw
+body keyed with the app secret>. Secrets come from the in-memory config
+registry, so verification does not query the database on the request path.
+
+Microbenchmark:  python webhook_security.py
+"""
+import os
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+
+SIGNATURE_HEADER = 'X-Hub-Signature-256'
+RECENT_DELIVERIES = int(os.environ.get('WEBHOOK_RECENT_DELIVERIES', 10000))
+
+# Verification outcomes
+VALID = 'valid'
+UNSIGNED = 'unsigned'  # no app secret configured, signature not checked
+INVALID = 'invalid'
+DUPLICATE = 'duplicate'
+
+def compute_signature(secret, body):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def signature_matches(secret, body, header):
+    """Constant-time comparison of the X-Hub-Signature-256 header with the body HMAC"""
+    if not header:
+        return False
+    return hmac.compare_digest(compute_signature(secret, body).encode(), header.strip().encode())
+
+class RecentDeliveries:
+    """Bounded LRU set of delivery ids seen by this process"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, delivery_id):
+        """Record a delivery id; returns True if it was already seen"""
+        with self._lock:
+            if delivery_id in self._seen:
+                self._seen.move_to_end(delivery_id)
+                return True
+            self._seen[delivery_id] = None
+            if len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            return False
+
+def webhook_credentials(source):
+    """App secrets and verify tokens of 'meta' (every active page) or 'whatsapp'"""
+    from config_registry import config_registry
+
+    config = config_registry.get(source)
+    configs = config if isinstance(config, list) else [config] if config else []
+    app_secrets = {c.app_secret for c in configs if c.app_secret}
+    verify_tokens = {c.verify_token for c in configs if c.verify_token}
+    if source == 'meta' and os.environ.get('META_VERIFY_TOKEN'):
+        verify_tokens.add(os.environ['META_VERIFY_TOKEN'])
+    return app_secrets, verify_tokens
+
+recent_deliveries = RecentDeliveries(RECENT_DELIVERIES)
+
+def verify_webhook(source, body, signature):
+    """Check a webhook POST; returns VALID, UNSIGNED, INVALID or DUPLICATE
+
+    With several Meta pages the delivery may be signed by any of their apps.
+    A redelivered payload has the same body and therefore the same signature,
+    so the signature doubles as the delivery id.
+    """
+    app_secrets, _ = webhook_credentials(source)
+    if not app_secrets:
+        return UNSIGNED
+    if not any(signature_matches(secret, body, signature) for secret in app_secrets):
+        return INVALID
+    if recent_deliveries.check_and_add(signature.strip()):
+        return DUPLICATE
+    return VALID
+
+def verify_token_matches(source, token):
+    _, verify_tokens = webhook_credentials(source)
+    return bool(token) and any(hmac.compare_digest(expected.encode(), token.encode())
+                               for expected in verify_tokens)
+
+if __name__ == '__main__':
+    import timeit
+
+    secret = 'benchmark-app-secret'
+    guard = RecentDeliveries(RECENT_DELIVERIES)
+    for size in (512, 4096, 65536):
+        body = os.urandom(size)
+        header = compute_signature(secret, body)
+
+        def verify():
+            signature_matches(secret, body, header)
+            guard.check_and_add(os.urandom(8))
+
+        runs = 20000
+        seconds = min(timeit.repeat(verify, number=runs, repeat=5))
+        print(f"{size:>6} byte body: {seconds / runs * 1e6:6.1f} µs per verification")
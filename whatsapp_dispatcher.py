@@ -0,0 +1,308 @@
+import os
+import re
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import Lead, LeadStatus, OutboundMessage, IntegrationLog
+from config_registry import config_registry
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Point at a local fake (see fake_whatsapp_api.py) to test without Meta
+API_BASE = os.environ.get('WHATSAPP_API_BASE', 'https://graph.facebook.com/v18.0')
+GREETING_TEMPLATE = os.environ.get('WHATSAPP_GREETING_TEMPLATE')
+FOLLOW_UP_TEMPLATE = os.environ.get('WHATSAPP_FOLLOW_UP_TEMPLATE')
+TEMPLATE_LANGUAGE = os.environ.get('WHATSAPP_TEMPLATE_LANGUAGE', 'pt_BR')
+RATE_PER_SECOND = float(os.environ.get('WHATSAPP_RATE_PER_SECOND', 20))
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+STUCK_AFTER = timedelta(minutes=10)
+
+# Later statuses never move back to earlier ones (webhooks can arrive out of order)
+STATUS_RANK = {'pending': 0, 'sending': 1, 'sent': 2, 'delivered': 3, 'read': 4, 'failed': 5}
+
+class RateLimiter:
+    """Token bucket per sender phone number, shared by all dispatcher threads"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, updated = self._buckets.get(key, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[key] = (tokens - 1, now)
+                    return
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+rate_limiter = RateLimiter(RATE_PER_SECOND)
+
+def normalize_phone(phone):
+    """Digits-only E.164 without '+'; Brazilian numbers without country code get 55"""
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) in (10, 11):
+        digits = '55' + digits
+    return digits or None
+
+def template_payload(to_phone, template_name, lead_name):
+    return {
+        'messaging_product': 'whatsapp',
+        'to': to_phone,
+        'type': 'template',
+        'template': {
+            'name': template_name,
+            'language': {'code': TEMPLATE_LANGUAGE},
+            'components': [{
+                'type': 'body',
+                'parameters': [{'type': 'text', 'text': lead_name}]
+            }]
+        }
+    }
+
+def enqueue_message(lead, kind, payload, idempotency_key, send_at=None):
+    """Add a message to the outbox; a repeated idempotency key is a no-op"""
+    if OutboundMessage.query.filter_by(idempotency_key=idempotency_key).first():
+        return None
+
+    message = OutboundMessage(
+        lead_id=lead.id,
+        to_phone=payload['to'],
+        kind=kind,
+        payload=payload,
+        idempotency_key=idempotency_key,
+        next_attempt_at=send_at or datetime.utcnow()
+    )
+    db.session.add(message)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process enqueued the same key concurrently
+        db.session.rollback()
+        return None
+    return message
+
+def enqueue_greetings(leads):
+    """Queue the greeting template for newly received leads"""
+    if not GREETING_TEMPLATE:
+        return 0
+
+    queued = 0
+    for lead in leads:
+        phone = normalize_phone(lead.phone)
+        if not phone:
+            continue
+        payload = template_payload(phone, GREETING_TEMPLATE, lead.name)
+        if enqueue_message(lead, 'greeting', payload, f'greeting:{lead.id}'):
+            queued += 1
+    return queued
+
+def enqueue_follow_ups(horizon=timedelta(hours=1)):
+    """Queue follow-up messages due within the horizon, to be sent at their due time"""
+    if not FOLLOW_UP_TEMPLATE:
+        return 0
+
+    now = datetime.utcnow()
+    leads = Lead.query.filter(
+        Lead.follow_up_date >= now,
+        Lead.follow_up_date <= now + horizon,
+        Lead.status.in_([LeadStatus.NOVO, LeadStatus.EM_CONTATO]),
+        Lead.phone.isnot(None)
+    ).all()
+
+    queued = 0
+    for lead in leads:
+        phone = normalize_phone(lead.phone)
+        if not phone:
+            continue
+        # The due date is part of the key, so a rescheduled follow-up gets a new message
+        key = f'follow_up:{lead.id}:{lead.follow_up_date.isoformat()}'
+        payload = template_payload(phone, FOLLOW_UP_TEMPLATE, lead.name)
+        if enqueue_message(lead, 'follow_up', payload, key, send_at=lead.follow_up_date):
+            queued += 1
+    return queued
+
+def send_message(phone_number_id, access_token, payload):
+    """POST one message to the Cloud API (runs in a worker thread, no DB access)"""
+    import requests
+
+    rate_limiter.acquire(phone_number_id)
+    try:
+        response = requests.post(
+            f"{API_BASE}/{phone_number_id}/messages",
+            json=payload,
+            headers={'Authorization': f'Bearer {access_token}'},
+            timeout=15
+        )
+    except requests.RequestException as e:
+        return {'ok': False, 'retry': True, 'error': str(e)}
+
+    if response.status_code == 200:
+        messages = response.json().get('messages') or [{}]
+        return {'ok': True, 'wa_message_id': messages[0].get('id')}
+
+    retry = response.status_code == 429 or response.status_code >= 500
+    return {'ok': False, 'retry': retry, 'error': f"{response.status_code}: {response.text[:500]}"}
+
+class WhatsAppDispatcher:
+    def __init__(self, max_workers=None, batch_size=None):
+        self.max_workers = max_workers or int(os.environ.get('WHATSAPP_DISPATCH_WORKERS', 8))
+        self.batch_size = batch_size or int(os.environ.get('WHATSAPP_DISPATCH_BATCH', 200))
+        self.config = None
+
+    def load_config(self):
+        """Load WhatsApp Business configuration"""
+        self.config = config_registry.get('whatsapp')
+        return self.config is not None and self.config.is_active and bool(self.config.access_token)
+
+    def dispatch_pending(self):
+        """Send due outbox messages; returns counts of sent, retried and failed"""
+        stats = {'sent': 0, 'retried': 0, 'failed': 0, 'cancelled': 0}
+        if not self.load_config():
+            return stats
+
+        self.release_stuck_messages()
+        jobs = self.claim_batch(stats)
+        if not jobs:
+            return stats
+
+        # Read credentials here: worker threads must not touch the session
+        phone_number_id = self.config.phone_number_id
+        access_token = self.config.access_token
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='wa-send') as pool:
+            results = list(pool.map(
+                lambda job: (job[0], send_message(phone_number_id, access_token, job[1])),
+                jobs
+            ))
+
+        messages = OutboundMessage.query.filter(OutboundMessage.id.in_([job[0] for job in jobs])).all()
+        by_id = {message.id: message for message in messages}
+        now = datetime.utcnow()
+        for message_id, result in results:
+            self.apply_result(by_id[message_id], result, now, stats)
+        db.session.commit()
+
+        if stats['failed']:
+            db.session.add(IntegrationLog(
+                action='whatsapp_dispatch',
+                status='error',
+                message=f"{stats['failed']} mensagens WhatsApp falharam definitivamente",
+                details=stats
+            ))
+            db.session.commit()
+
+        logger.info(f"WhatsApp dispatch finished: {stats}")
+        return stats
+
+    def release_stuck_messages(self):
+        # A crash between claim and result leaves rows in 'sending'; put them back.
+        # This can re-send a message whose result was lost, which is preferred to dropping it.
+        OutboundMessage.query.filter(
+            OutboundMessage.status == 'sending',
+            OutboundMessage.updated_at < datetime.utcnow() - STUCK_AFTER
+        ).update({'status': 'pending'}, synchronize_session=False)
+        db.session.commit()
+
+    def claim_batch(self, stats):
+        """Mark due messages as 'sending' so no other process sends them too
+
+        Returns (id, payload) pairs for the worker threads.
+        """
+        messages = OutboundMessage.query.filter(
+            OutboundMessage.status == 'pending',
+            OutboundMessage.next_attempt_at <= datetime.utcnow()
+        ).order_by(OutboundMessage.next_attempt_at, OutboundMessage.id)\
+         .limit(self.batch_size).with_for_update(skip_locked=True).all()
+
+        follow_up_dates = {}
+        follow_up_ids = [m.lead_id for m in messages if m.kind == 'follow_up' and m.lead_id]
+        if follow_up_ids:
+            follow_up_dates = dict(db.session.query(Lead.id, Lead.follow_up_date)
+                                   .filter(Lead.id.in_(follow_up_ids)).all())
+
+        claimed = []
+        for message in messages:
+            if message.kind == 'follow_up' and not self.follow_up_still_due(message, follow_up_dates):
+                message.status = 'cancelled'
+                stats['cancelled'] += 1
+                continue
+            message.status = 'sending'
+            message.attempts += 1
+            claimed.append((message.id, message.payload))
+
+        db.session.commit()
+        return claimed
+
+    def follow_up_still_due(self, message, follow_up_dates):
+        due = follow_up_dates.get(message.lead_id)
+        return due is not None and message.idempotency_key.endswith(due.isoformat())
+
+    def apply_result(self, message, result, now, stats):
+        if result['ok']:
+            message.status = 'sent'
+            message.wa_message_id = result['wa_message_id']
+            message.sent_at = now
+            message.last_error = None
+            update_lead_message_status(message.lead_id, 'sent', now)
+            stats['sent'] += 1
+            return
+
+        message.last_error = result['error']
+        if result['retry'] and message.attempts < MAX_ATTEMPTS:
+            delay = min(BACKOFF_BASE_SECONDS * 2 ** (message.attempts - 1), BACKOFF_MAX_SECONDS)
+            message.status = 'pending'
+            message.next_attempt_at = now + timedelta(seconds=delay)
+            stats['retried'] += 1
+        else:
+            message.status = 'failed'
+            update_lead_message_status(message.lead_id, 'failed', now)
+            stats['failed'] += 1
+
+def update_lead_message_status(lead_id, status, at):
+    if not lead_id:
+        return
+    Lead.query.filter_by(id=lead_id).update(
+        # Delivery receipts aren't a lead change for the sweeper, archive or API sync
+        {'last_message_status': status, 'last_message_at': at, 'updated_at': Lead.updated_at},
+        synchronize_session=False
+    )
+
+def apply_status_updates(statuses):
+    """Fold Cloud API delivery statuses (sent/delivered/read/failed) back into the outbox and lead"""
+    updated = 0
+    for status in statuses:
+        message = OutboundMessage.query.filter_by(wa_message_id=status.get('id')).first()
+        new_status = status.get('status')
+        if not message or new_status not in STATUS_RANK:
+            continue
+        if STATUS_RANK[new_status] < STATUS_RANK.get(message.status, 0):
+            continue
+
+        at = datetime.utcfromtimestamp(int(status['timestamp'])) if status.get('timestamp') else datetime.utcnow()
+        message.status = new_status
+        if new_status == 'failed':
+            message.last_error = str(status.get('errors'))
+        update_lead_message_status(message.lead_id, new_status, at)
+        updated += 1
+
+    if updated:
+        db.session.commit()
+    return updated
+
+# Create instance when needed
+def get_whatsapp_dispatcher():
+    return WhatsAppDispatcher()
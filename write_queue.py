@@ -0,0 +1,192 @@
+"""Single-writer queue for lead ingestion on SQLite.
+
+SQLite takes one writer at a time. Concurrent webhook deliveries and Meta
+page syncs would each wait for the write lock in SQLite's busy handler,
+which polls instead of queueing and fails with "database is locked" once
+SQLITE_BUSY_TIMEOUT_MS runs out. On SQLite they are handed to one writer
+thread instead and run in arrival order while the caller waits for the
+result. On PostgreSQL run() calls the function directly.
+
+The queue lives in one process. Writers in other processes, such as more
+gunicorn workers (WEB_CONCURRENCY or --workers) or the scheduler process,
+still meet in SQLite's busy handler and can fail with "database is locked"
+under load. On SQLite run a single web worker, scale it with
+GUNICORN_THREADS, and keep the scheduler's batch jobs small. The writer
+thread logs a warning when WEB_CONCURRENCY asks for more workers.
+
+SQLITE_WRITE_QUEUE=false disables the queue; SQLITE_WRITE_QUEUE_SIZE bounds
+how many writes may wait (callers block beyond that).
+
+Benchmark the same mixed workload (concurrent WhatsApp webhooks creating and
+distributing leads, admin dashboards, reports and CSV exports) on each
+database, with the pool sized for the benchmark's threads:
+    GUNICORN_THREADS=12 DATABASE_URL=sqlite:////tmp/bench.db python write_queue.py
+    GUNICORN_THREADS=12 DATABASE_URL=postgresql://... python write_queue.py
+"""
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from flask import has_app_context
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('SQLITE_WRITE_QUEUE', 'true').lower() in ('1', 'true', 'yes', 'on')
+QUEUE_SIZE = int(os.environ.get('SQLITE_WRITE_QUEUE_SIZE', 1000))
+
+class WriteQueue:
+    """Runs submitted functions one at a time on a dedicated thread, each in its own app context
+
+    Serializes the writes of this process only (see the module docstring).
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return ENABLED and (app.config.get('SQLALCHEMY_DATABASE_URI') or '').startswith('sqlite')
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn on the writer thread and return its result (or raise its exception)"""
+        if not self.enabled or threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+
+        # End the caller's transaction: it may hold the write lock the writer needs
+        if has_app_context():
+            db.session.commit()
+
+        self._start()
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future.result()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='sqlite-writer', daemon=True)
+                self._thread.start()
+                logger.info("SQLite writer thread started")
+                if int(os.environ.get('WEB_CONCURRENCY') or 1) > 1:
+                    logger.warning("SQLite write queue only serializes this worker's writes: "
+                                   "run a single web worker (WEB_CONCURRENCY=1) on SQLite")
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with app.app_context():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+write_queue = WriteQueue()
+
+def queued_writes(f):
+    """Mark a view whose writes all go through write_queue.run()
+
+    The request thread then only reads, so on SQLite its transaction begins
+    DEFERRED and does not compete with the writer thread for the write lock.
+    Without the queue the view writes itself and keeps BEGIN IMMEDIATE.
+    """
+    f.writes_queued = write_queue.enabled
+    return f
+
+if __name__ == '__main__':
+    import json
+    import time
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from app import init_db, create_app
+    from sqlalchemy import func
+    from models import User, UserRole, Lead
+
+    WEBHOOK_THREADS = int(os.environ.get('BENCH_WEBHOOK_THREADS', 8))
+    DASHBOARD_THREADS = int(os.environ.get('BENCH_DASHBOARD_THREADS', 4))
+    SECONDS = float(os.environ.get('BENCH_SECONDS', 20))
+    BROKERS = 10
+
+    create_app()
+    with app.app_context():
+        init_db()
+        for i in range(BROKERS - User.query.filter_by(role=UserRole.BROKER).count()):
+            broker = User(username=f'bench-broker-{i}-{random.randrange(10 ** 9)}', role=UserRole.BROKER,
+                          is_active=True, can_receive_leads=True)
+            broker.email = f'{broker.username}@example.com'
+            broker.set_password('bench')
+            db.session.add(broker)
+        db.session.commit()
+        admin_id = User.query.filter_by(role=UserRole.ADMIN).first().id
+
+    def whatsapp_delivery(phone):
+        return {'entry': [{'changes': [{'field': 'messages', 'value': {
+            'metadata': {'phone_number_id': 'bench'},
+            'contacts': [{'wa_id': phone, 'profile': {'name': f'Bench {phone}'}}],
+            'messages': [{'from': phone, 'id': f'wamid.{phone}', 'type': 'text',
+                          'text': {'body': 'Olá, quero saber mais ' + 'x' * 200}}]
+        }}]}]}
+
+    def timed(send):
+        started = time.perf_counter()
+        status = send().status_code
+        return time.perf_counter() - started, status
+
+    def webhooks(worker, deadline):
+        client = app.test_client()
+        results, sequence = [], 0
+        while time.monotonic() < deadline:
+            sequence += 1
+            phone = f'55{worker:02d}{sequence:09d}'
+            results.append(timed(lambda: client.post('/webhook/whatsapp', data=json.dumps(whatsapp_delivery(phone)),
+                                                     content_type='application/json')))
+        return results
+
+    def dashboards(worker, deadline):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = admin_id
+        pages = ['/admin', '/admin/reports', '/admin/reports/export', '/api/metrics/dashboard']
+        results = []
+        while time.monotonic() < deadline:
+            results.append(timed(lambda: client.get(random.choice(pages))))
+        return results
+
+    def summary(name, results):
+        latencies = sorted(seconds for seconds, _ in results)
+        errors = sum(1 for _, status in results if status >= 500)
+        if not latencies:
+            return f"{name}: no requests"
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        return (f"{name}: {len(latencies) / SECONDS:.0f} req/s, p50 {p50:.1f} ms, p95 {p95:.1f} ms, "
+                f"{errors} errors")
+
+    with app.app_context():
+        first_id = (db.session.query(func.max(Lead.id)).scalar() or 0) + 1
+
+    logging.getLogger().setLevel(logging.WARNING)
+    deadline = time.monotonic() + SECONDS
+    with ThreadPoolExecutor(max_workers=WEBHOOK_THREADS + DASHBOARD_THREADS) as pool:
+        writes = [pool.submit(webhooks, i, deadline) for i in range(WEBHOOK_THREADS)]
+        reads = [pool.submit(dashboards, i, deadline) for i in range(DASHBOARD_THREADS)]
+        write_results = [result for future in writes for result in future.result()]
+        read_results = [result for future in reads for result in future.result()]
+
+    dialect = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+    print(f"{dialect}, {WEBHOOK_THREADS} webhook + {DASHBOARD_THREADS} dashboard threads, {SECONDS:g}s "
+          f"(write queue {'on' if write_queue.enabled else 'off'})")
+    with app.app_context():
+        stored = Lead.query.filter(Lead.id >= first_id).count()
+    print(summary('  webhooks  ', write_results) + f", {len(write_results) - stored} leads lost")
+    print(summary('  dashboards', read_results))